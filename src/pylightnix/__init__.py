@@ -6,6 +6,7 @@ warning=logger.warning
 from pylightnix.imports import *
 from pylightnix.types import *
 from pylightnix.utils import *
+from pylightnix.storedb import *
 from pylightnix.core import *
 from pylightnix.build import *
 from pylightnix.bashlike import *
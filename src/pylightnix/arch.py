@@ -16,20 +16,33 @@
 
 from pylightnix.imports import (Popen, dirname, basename, remove, join,
                                 relpath, rename, splitext, mkdtemp, isfile,
-                                isdir, shutil_copy, realpath, normpath)
+                                isdir, shutil_copy, realpath, normpath,
+                                tarfile_open, is_tarfile, TarInfo, TarFile,
+                                BytesIO, json_dumps, json_loads, replace,
+                                ENOTEMPTY, EEXIST, urlopen, urlparse, HTTPError,
+                                makedirs, contextmanager, os_open, os_close,
+                                flock, LOCK_EX, O_RDWR, O_CREAT, url2pathname,
+                                REGTYPE, listdir, lstat)
 from pylightnix.types import (RRef, List, Dict, Path, Iterable, Optional,
                               SPath, Registry, DRef, Config, RConfig, Build,
-                              Set, StorageSettings)
+                              Set, StorageSettings, IO, Any, Tuple, Union,
+                              Context, Iterator)
 
 from pylightnix.core import (drefdeps, rrefdeps, rref2path, dref2path,
                              fsstorage, fstmpdir, storagename, alldrefs,
                              rootdrefs, rootrrefs, rref2dref, cfgdeps,
                              drefcfg_, mkdrv, realize1, realizeMany, instantiate,
                              rrefdata, cfgname, match_exact, drefrrefsC,
-                             resolve, rrefctx)
+                             resolve, rrefctx, drefcfgpath, undref, unrref,
+                             mkrref, mkdref, mkdrv_, fsconfig, trimhash,
+                             rrefdeps1, hasstoredb, storedbpath, storedb_rows_,
+                             storedb_add, context_eq, rrefctx, tmpname_,
+                             cfghash, drefdepsmap, substituter_set_)
 
 from pylightnix.build import (build_markstart, build_wrapper)
-from pylightnix.utils import (try_executable, dirrm)
+from pylightnix.utils import (try_executable, dirrm, dirhash, dirchmod,
+                              kahntsort, dirclone, readjson,
+                              assert_tarmember_safe)
 
 APACK=try_executable('apack',
                      'PYLIGHTNIX_APACK',
@@ -43,7 +56,228 @@ AUNPACK=try_executable('aunpack',
                      '`arch.sunpack` procedure will fail.')
 
 
+#: Compression modes of the native closure archives, keyed by the archive
+#: file suffix. See [spack](#pylightnix.arch.spack).
+PYLIGHTNIX_ARCH_COMPRESSION={'.tar':'', '.tar.gz':'gz', '.tgz':'gz',
+                             '.tar.bz2':'bz2', '.tbz2':'bz2',
+                             '.tar.xz':'xz', '.txz':'xz'}
+
+#: Name of the manifest member of the native closure archives
+PYLIGHTNIX_ARCH_MANIFEST='MANIFEST.json'
+
+def arch_compression(path:str)->Optional[str]:
+  """ Return the compression mode of the native archive `path` based on its
+  suffix, or None if the suffix requires the `atool` engine. """
+  for suffix,comp in PYLIGHTNIX_ARCH_COMPRESSION.items():
+    if path.endswith(suffix):
+      return comp
+  return None
+
+def closure_(roots:List[RRef], S:Optional[StorageSettings]=None
+             )->Tuple[List[DRef],List[RRef]]:
+  """ Return the derivations and the realizations of the closure of `roots`,
+  both in topological order. """
+  rdepsmap={r:rrefdeps1([r],S) for r in rrefdeps(roots,S)|set(roots)}
+  rrefs=kahntsort(rdepsmap.keys(), lambda r:rdepsmap[r])
+  assert rrefs is not None, f"Closure of {roots} has cycles"
+  depsmap=drefdepsmap({rref2dref(rref) for rref in rrefs},S)
+  drefs=kahntsort(depsmap.keys(), lambda d:depsmap[d])
+  assert drefs is not None, f"Closure of {roots} has cycles"
+  return drefs,rrefs
+
+def spack_add_(t:TarFile, path:str, arcname:str, prefix:str)->None:
+  """ Add the file or the folder `path` to the archive `t` as `arcname`,
+  recursively. Hardlinks to the members outside of `prefix` are stored as
+  regular files. """
+  info=t.gettarinfo(path,arcname)
+  if info.islnk() and not (info.linkname+'/').startswith(prefix+'/'):
+    info.type=REGTYPE
+    info.linkname=''
+    info.size=lstat(path).st_size
+  if info.isreg():
+    with open(path,'rb') as f:
+      t.addfile(info,f)
+  else:
+    t.addfile(info)
+  if info.isdir():
+    for name in sorted(listdir(path)):
+      spack_add_(t,join(path,name),join(arcname,name),prefix)
+
+def spack_stream(roots:List[RRef], f:IO[bytes], compression:str='',
+                 S:Optional[StorageSettings]=None,
+                 exclude:Iterable[str]=())->None:
+  """ Write the closure of `roots` into the file object `f` as a tar stream,
+  compressed according to `compression` (`''`, `'gz'`, `'bz2'` or `'xz'`).
+  DRefs and RRefs listed in `exclude` are left out of the archive.
+
+  The stream starts with the `MANIFEST.json` member listing the roots and the
+  contents of the archive. Derivation configs go next, followed by the
+  realization folders in topological order. The data is written in one pass.
+  Files shared between realizations, e.g. by deduplication, are stored in each
+  of them, so hardlink members never point outside of their realization.
+  See [sunpack_stream](#pylightnix.arch.sunpack_stream). """
+  drefs,rrefs=closure_(roots,S)
+  exclude_=set(exclude)
+  drefs=[dref for dref in drefs if dref not in exclude_]
+  rrefs=[rref for rref in rrefs if rref not in exclude_]
+  manifest=json_dumps({'version':1,
+                       'roots':roots,
+                       'drefs':drefs,
+                       'rrefs':rrefs,
+                       'dirhash_version':fsconfig(S)['dirhash_version']},
+                      indent=2).encode('utf-8')
+  with tarfile_open(fileobj=f, mode=f'w|{compression}') as t: # type:ignore
+    info=TarInfo(PYLIGHTNIX_ARCH_MANIFEST)
+    info.size=len(manifest)
+    t.addfile(info, BytesIO(manifest))
+    for dref in drefs:
+      t.add(drefcfgpath(dref,S), arcname=relpath(drefcfgpath(dref,S),
+                                                 fsstorage(S)))
+    for rref in rrefs:
+      arcname=relpath(rref2path(rref,S),fsstorage(S))
+      spack_add_(t,rref2path(rref,S),arcname,arcname)
+
+def dirhash_versions_(preferred:int)->List[int]:
+  return [preferred]+[v for v in [0,1] if v!=preferred]
+
+def rrefverify_(rref:RRef, tmp:Path, versions:List[int])->None:
+  """ Check that the contents of the folder `tmp` match the hash part of
+  `rref`. Any of the dirhash `versions` is accepted, because realizations of a
+  storage may be created under different settings. Remove `tmp` if the check
+  fails. """
+  rhash,_,_=unrref(rref)
+  if not any([trimhash(dirhash(tmp,version=v))==rhash for v in versions]):
+    dirrm(tmp)
+    assert False, f"Contents of the realization {rref} don't match its hash"
+
+def rrefmove_(rref:RRef, tmp:Path, S:Optional[StorageSettings]=None)->None:
+  """ Move the verified folder `tmp` into the storage `S` as the realization
+  `rref`. Remove `tmp` if the realization is already present. """
+  dirchmod(tmp,'rotop' if fsconfig(S)['readonly']=='top' else 'ro')
+  try:
+    replace(tmp,rref2path(rref,S))
+  except OSError as err:
+    if err.errno in [ENOTEMPTY,EEXIST]:
+      dirrm(tmp)
+    else:
+      raise
+
+def rrefcommit_(rref:RRef, tmp:Path, versions:List[int],
+                S:Optional[StorageSettings]=None)->None:
+  """ Move the folder `tmp` into the storage `S` as the realization `rref`
+  after checking that its contents match the hash part of `rref`, see
+  [rrefverify_](#pylightnix.arch.rrefverify_). """
+  rrefverify_(rref,tmp,versions)
+  rrefmove_(rref,tmp,S)
+
+def _extract(t:TarFile, m:TarInfo, path:str, set_attrs:bool=True)->None:
+  try:
+    t.extract(m, path, set_attrs=set_attrs, filter='data') # type:ignore
+  except TypeError:
+    # No extraction filters
+    assert_tarmember_safe(m, path)
+    t.extract(m, path, set_attrs=set_attrs)
+
+def sunpack_stream(f:IO[bytes], S:Optional[StorageSettings]=None,
+                   roots:Optional[List[RRef]]=None,
+                   context:Optional[Context]=None)->List[RRef]:
+  """ Read the closure archive produced by
+  [spack_stream](#pylightnix.arch.spack_stream) from the file object `f` and
+  put its contents into the storage `S`. Return the list of root realizations.
+
+  The stream is read in one pass. Realizations are extracted directly into the
+  storage folder under temporary names and their hashes are verified. If
+  `roots` is set, the roots listed in the manifest must match it. If `context`
+  is set, the roots must have this context. Nothing is moved in place until
+  the whole archive has passed the checks. Objects already present in the
+  storage are skipped. """
+  storage=fsstorage(S)
+  with tarfile_open(fileobj=f, mode='r|*') as t:
+    m=t.next()
+    assert m is not None and m.name==PYLIGHTNIX_ARCH_MANIFEST, (
+      f"Archive doesn't start with {PYLIGHTNIX_ARCH_MANIFEST}")
+    mf=t.extractfile(m)
+    assert mf is not None
+    manifest=json_loads(mf.read().decode('utf-8'))
+    assert manifest['version']==1, (
+      f"Unsupported archive version {manifest['version']}")
+    assert roots is None or manifest['roots']==roots, (
+      f"Archive roots {manifest['roots']} don't match the expected {roots}")
+    drefs=set(manifest['drefs'])
+    rrefs=set(manifest['rrefs'])
+    versions=dirhash_versions_(manifest['dirhash_version'])
+    new_cfgs:List[Config]=[]
+    new_rrefs:List[Tuple[RRef,str]]=[]
+    current:Optional[Tuple[RRef,str]]=None
+
+    def _finalize()->None:
+      nonlocal current
+      if current is None:
+        return
+      rref,tmp=current
+      current=None
+      rrefverify_(rref,Path(tmp),versions)
+      new_rrefs.append((rref,tmp))
+      if context is not None and rref in manifest['roots']:
+        ctx=readjson(join(tmp,'context.json'))
+        assert isinstance(ctx,dict) and context_eq(context,ctx), (
+          f"Context of {rref} doesn't match the expected one")
+
+    try:
+      for m in t:
+        if m.name==PYLIGHTNIX_ARCH_MANIFEST:
+          continue
+        parts=m.name.split('/')
+        dref=DRef('dref:'+parts[0])
+        if len(parts)==2 and parts[1]=='config.json':
+          assert dref in drefs, f"Unexpected archive member '{m.name}'"
+          _finalize()
+          if isdir(dref2path(dref,S)):
+            continue
+          cf=t.extractfile(m)
+          assert cf is not None
+          cfg=Config(json_loads(cf.read().decode('utf-8')))
+          assert mkdref(trimhash(cfghash(cfg)),cfgname(cfg))==dref, (
+            f"Archived config {dref} doesn't match its hash")
+          new_cfgs.append(cfg)
+          continue
+        dhash,nm=undref(dref)
+        rref=RRef(f'rref:{parts[1]}-{dhash}-{nm}')
+        assert rref in rrefs, f"Unexpected archive member '{m.name}'"
+        if current is None or current[0]!=rref:
+          _finalize()
+          if isdir(rref2path(rref,S)):
+            continue
+          tmp=tmpname_(Path(join(storage,f"{parts[0]}_{parts[1]}")))
+          current=(rref,tmp)
+        prefix=join(parts[0],parts[1])
+        tmpprefix=relpath(current[1],storage)
+        m.name=join(tmpprefix,*parts[2:])
+        if m.islnk() and (m.linkname+'/').startswith(prefix+'/'):
+          m.linkname=tmpprefix+m.linkname[len(prefix):]
+        _extract(t, m, storage, set_attrs=not m.isdir())
+      _finalize()
+      for cfg in new_cfgs:
+        mkdrv_(cfg,S)
+      for rref,tmppath in new_rrefs:
+        rrefmove_(rref,Path(tmppath),S)
+    except BaseException:
+      for _,tmppath in new_rrefs+([current] if current is not None else []):
+        if isdir(tmppath):
+          dirrm(Path(tmppath))
+      raise
+
+  if hasstoredb(S):
+    storedb_add(storedbpath(S),*storedb_rows_([],[r for r,_ in new_rrefs],S))
+  return manifest['roots']
+
 def spack(roots:List[RRef], out:Path, S:Optional[StorageSettings]=None)->None:
+  """ Pack the closure of `roots` into the archive `out`.
+
+  Archives with `.tar`, `.tar.gz`, `.tgz`, `.tar.bz2`, `.tbz2`, `.tar.xz` or
+  `.txz` suffixes are written natively, in a single pass, see
+  [spack_stream](#pylightnix.arch.spack_stream). Other formats are handled by
+  the `apack` tool of the `atool` package. """
   rout=realpath(out)
   tmp=splitext(rout)[0]+'_tmp'+splitext(rout)[1]
   try:
@@ -52,6 +286,16 @@ def spack(roots:List[RRef], out:Path, S:Optional[StorageSettings]=None)->None:
     raise
   except Exception:
     pass
+  compression=arch_compression(rout)
+  if compression is not None:
+    try:
+      with open(tmp,'wb') as f:
+        spack_stream(roots, f, compression, S)
+      rename(tmp,rout)
+    finally:
+      if isfile(tmp):
+        remove(tmp)
+    return
   rrefs=rrefdeps(roots,S)
   store_holder=dirname(fsstorage(S))
   done=False
@@ -75,7 +319,20 @@ def spack(roots:List[RRef], out:Path, S:Optional[StorageSettings]=None)->None:
         pass
 
 def sunpack(archive:Path, S=None)->None:
+  """ Unpack the closure archive into the storage `S`. Archives created
+  natively by [spack](#pylightnix.arch.spack) are read by
+  [sunpack_stream](#pylightnix.arch.sunpack_stream) without intermediate
+  copies. Other archives are unpacked with the `aunpack` tool into a temporary
+  folder and copied with [copyclosure](#pylightnix.arch.copyclosure). """
   rin=realpath(archive)
+  if is_tarfile(rin):
+    with tarfile_open(rin,'r|*') as t:
+      m=t.next()
+      native=m is not None and m.name==PYLIGHTNIX_ARCH_MANIFEST
+    if native:
+      with open(rin,'rb') as f:
+        sunpack_stream(f,S)
+      return
   tmppath=Path(mkdtemp(suffix=f"_{basename(rin)}", dir=realpath(fstmpdir(S))))
   try:
     p=Popen([AUNPACK(), '-q', '-X', tmppath, rin], cwd=fstmpdir(S))
@@ -92,52 +349,264 @@ def sunpack(archive:Path, S=None)->None:
     # dirrm(tmppath)
     pass
 
-def deref_(ctxr:RRef, dref:DRef, S):
-  """ query the context for specific dref. If not present - then it must be a
-  context holder itself. """
-  return rrefctx(ctxr,S=S)[dref] \
-          if dref!=rref2dref(ctxr) else [ctxr]
-
 def copyclosure(rrefs_S:Iterable[RRef],
                 S:StorageSettings,
-                D:Optional[StorageSettings]=None)->None:
+                D:Optional[StorageSettings]=None,
+                hardlink:bool=True)->List[RRef]:
   """ Copy the closure of `rrefs` from source storage `S` to the destination
   storage `D`. If `D` is None, use the default global storage as a desitnation.
 
-  TODO: Implement a non-recursive version.
+  The union closure of all the roots is calculated once. Derivations are
+  registered in `D` in topological order, then every missing realization is
+  copied exactly once with [dirclone](#pylightnix.utils.dirclone), verified
+  against its hash and committed, dependencies first. Files are hardlinked if
+  `hardlink` is True and the storages share a filesystem. Note that hardlinked
+  files are shared by both storages. Return the list of copied realizations.
   """
-  for rref_S in rrefs_S:
-    visited_drefs:Set[DRef]=set()
-    dref_S:DRef=rref2dref(rref_S)
-
-    def _stage(dref:DRef,r:Registry)->DRef:
-      nonlocal visited_drefs
-      cfg=drefcfg_(dref,S=S)
-      # print(f"Instantiating {cfg}")
-      if dref not in visited_drefs:
-        for dep_dref in cfgdeps(resolve(cfg,dref)):
-          if dep_dref!=dref:
-            _stage(dep_dref, r)
-
-      def _make(b:Build)->None:
-        """ 'realize1' the derivation in `D` by copying its contents from `S` """
-        rrefs_S=deref_(rref_S, b.dref, S=S)
-        # print(f'Building {b.dref} hoping to get {rrefs_S}')
-        # print(grps_S)
-        ps=build_markstart(b, len(rrefs_S))
-        for rref,p in zip(rrefs_S,ps):
-          for artifact in rrefdata(rref,S):
-            shutil_copy(artifact,p)
-
-      rrefs_S1=deref_(rref_S, dref, S=S)
-      # note(f"Expecting for {dref}(ctx {rref_S}): {list(rrefs_S1)}")
-      dref2=mkdrv(cfg, match_exact(rrefs_S1),
-                  build_wrapper(_make,nouts=None,starttime=None,stoptime=None),
-                  r=r)
-      visited_drefs.add(dref2)
-      assert dref==dref2, f"{dref} != {dref2}"
-      return dref2
-    rrefs_D=realizeMany(instantiate(_stage, dref_S, S=D))
-    assert rrefs_D==[rref_S], f"{rrefs_D}!={[rref_S]}"
+  drefs,rrefs=closure_(list(rrefs_S),S)
+  for dref in drefs:
+    if not isdir(dref2path(dref,D)):
+      dref2=mkdrv_(drefcfg_(dref,S),D)
+      assert dref2==dref, f"Config of {dref} doesn't match its hash"
+  versions=dirhash_versions_(fsconfig(S)['dirhash_version'])
+  new_rrefs=[]
+  for rref in rrefs:
+    if isdir(rref2path(rref,D)):
+      continue
+    tmp=tmpname_(rref2path(rref,D))
+    dirclone(rref2path(rref,S),tmp,hardlink=hardlink)
+    rrefcommit_(rref,tmp,versions,D)
+    new_rrefs.append(rref)
+  if hasstoredb(D):
+    storedb_add(storedbpath(D),*storedb_rows_([],new_rrefs,D))
+  return new_rrefs
+
+
 
+class SyncStream:
+  """ Length-prefixed framing of the [store_sync](#pylightnix.arch.store_sync)
+  protocol. The framing lets the receiver detect the end of an arbitrary-length
+  message, like a compressed tar stream, without closing the connection. """
+  def __init__(self, f:Any)->None:
+    self.f=f
+    self.left=0
+    self.eof=False
+
+  def write(self, data:bytes)->int:
+    if len(data)>0:
+      self.f.write(len(data).to_bytes(8,'big'))
+      self.f.write(data)
+    return len(data)
+
+  def finish(self)->None:
+    """ Terminate the message and flush the underlying stream """
+    self.f.write((0).to_bytes(8,'big'))
+    self.f.flush()
+
+  def read(self, n:int=-1)->bytes:
+    if self.eof:
+      return b''
+    if self.left==0:
+      header=self.f.read(8)
+      assert len(header)==8, "Unexpected end of the sync stream"
+      self.left=int.from_bytes(header,'big')
+      if self.left==0:
+        self.eof=True
+        return b''
+    k=self.left if n<0 else min(n,self.left)
+    data=self.f.read(k)
+    assert len(data)==k, "Unexpected end of the sync stream"
+    self.left-=k
+    return data
+
+  def readall(self)->bytes:
+    acc=[]
+    for chunk in iter(self.read,b''):
+      acc.append(chunk)
+    return b''.join(acc)
+
+def _sync_send(f:Any, msg:dict)->None:
+  s=SyncStream(f)
+  s.write(json_dumps(msg).encode('utf-8'))
+  s.finish()
+
+def _sync_recv(f:Any)->dict:
+  return json_loads(SyncStream(f).readall().decode('utf-8'))
+
+def store_sync_send(roots:List[RRef], fin:IO[bytes], fout:IO[bytes],
+                    compression:str='',
+                    S:Optional[StorageSettings]=None)->List[RRef]:
+  """ The sending side of [store_sync](#pylightnix.arch.store_sync). Talk to
+  [store_sync_recv](#pylightnix.arch.store_sync_recv) by writing to `fout`
+  and reading from `fin`. Return the realizations the receiver didn't have.
+
+  The protocol is: (1) the sender offers the names of all the objects of the
+  closure; (2) the receiver replies with the names it misses; (3) the sender
+  streams the missing objects as a [spack_stream](#pylightnix.arch.spack_stream)
+  archive; (4) the receiver confirms the realizations it has committed. """
+  drefs,rrefs=closure_(roots,S)
+  _sync_send(fout,{'version':1, 'drefs':drefs, 'rrefs':rrefs})
+  missing=set(_sync_recv(fin)['missing'])
+  out=SyncStream(fout)
+  spack_stream(roots, out, compression, S, # type:ignore
+               exclude=[x for x in drefs+rrefs if x not in missing])
+  out.finish()
+  received=_sync_recv(fin)['received']
+  assert set(received)==(missing & set(rrefs)), (
+    f"The receiver failed to commit {(missing & set(rrefs))-set(received)}")
+  return received
+
+def store_sync_recv(fin:IO[bytes], fout:IO[bytes],
+                    S:Optional[StorageSettings]=None)->List[RRef]:
+  """ The receiving side of [store_sync](#pylightnix.arch.store_sync). Talk to
+  [store_sync_send](#pylightnix.arch.store_sync_send) by reading from `fin`
+  and writing to `fout`, put the received objects into the storage `S`.
+  Return the list of realizations received. """
+  offer=_sync_recv(fin)
+  assert offer['version']==1, f"Unsupported sync version {offer['version']}"
+  missing=[dref for dref in offer['drefs'] if not isdir(dref2path(dref,S))]+\
+          [rref for rref in offer['rrefs'] if not isdir(rref2path(rref,S))]
+  _sync_send(fout,{'missing':missing})
+  inp=SyncStream(fin)
+  sunpack_stream(inp,S) # type:ignore
+  inp.readall()
+  received=[rref for rref in offer['rrefs']
+            if rref in set(missing) and isdir(rref2path(rref,S))]
+  _sync_send(fout,{'received':received})
+  return received
+
+def store_sync(roots:List[RRef],
+               S:Optional[StorageSettings],
+               D:Union[Optional[StorageSettings],Tuple[IO[bytes],IO[bytes]]],
+               compression:str='')->List[RRef]:
+  """ Make the closure of `roots` available in the destination `D`,
+  transferring only the objects `D` doesn't have. Storage objects are
+  content-addressed, so they are compared by name. Return the list of the
+  transferred realizations.
+
+  `D` is either the destination [StorageSettings](#pylightnix.types.StorageSettings),
+  or a pair of byte streams `(fin,fout)` connected to a
+  [store_sync_recv](#pylightnix.arch.store_sync_recv) peer. In the former
+  case, the objects are copied with [copyclosure](#pylightnix.arch.copyclosure).
+  In the latter case, `compression` applies to the transferred data.
+
+  Example:
+  ```python
+  p=Popen(['ssh','inference-host','python3','-c',
+           'import sys; from pylightnix.arch import store_sync_recv; '
+           'store_sync_recv(sys.stdin.buffer, sys.stdout.buffer)'],
+          stdin=PIPE, stdout=PIPE)
+  store_sync([rref], None, (p.stdout,p.stdin), compression='gz')
+  ```
+  """
+  if D is None or isinstance(D,StorageSettings):
+    assert S is not None, "Source storage should be specified explicitly"
+    return copyclosure(roots,S,D)
+  else:
+    fin,fout=D
+    return store_sync_send(roots,fin,fout,compression,S)
+
+
+#: Name of the per-derivation index file of the binary caches, see
+#: [store_publish](#pylightnix.arch.store_publish).
+PYLIGHTNIX_SUBST_INDEX='index.json'
+
+@contextmanager
+def _subst_lock(folder:str)->Iterator[None]:
+  fd=os_open(join(folder,PYLIGHTNIX_SUBST_INDEX+'.lock'),O_RDWR|O_CREAT,0o644)
+  try:
+    flock(fd,LOCK_EX)
+    yield
+  finally:
+    os_close(fd)
+
+def store_publish(rrefs:Iterable[RRef], cache:str, compression:str='gz',
+                  S:Optional[StorageSettings]=None)->None:
+  """ Put the realizations `rrefs` into the binary cache folder `cache`, where
+  [substitute](#pylightnix.arch.substitute) can find them. The folder may be
+  shared directly or served over HTTP by a static web server.
+
+  For every derivation, the cache holds a folder named after the derivation
+  folder of the storage. It contains one
+  [spack_stream](#pylightnix.arch.spack_stream) archive per realization and the
+  `index.json` file mapping realizations to their archives and contexts.
+  Concurrent publishers of a derivation update its index one by one.
+  Dependencies are not published implicitly, pass the whole closure in
+  `rrefs` if needed. """
+  ext=[k for k,v in PYLIGHTNIX_ARCH_COMPRESSION.items() if v==compression][0]
+  for rref in rrefs:
+    dref=rref2dref(rref)
+    rhash,_,_=unrref(rref)
+    drefs,rrefs_=closure_([rref],S)
+    folder=join(cache,basename(dref2path(dref,S)))
+    makedirs(folder, exist_ok=True)
+    archive=f"{rhash}{ext}"
+    tmparchive=tmpname_(Path(join(folder,archive)))
+    with open(tmparchive,'wb') as f:
+      spack_stream([rref],f,compression,S,
+                   exclude=[x for x in drefs+rrefs_ if x not in [dref,rref]])
+    replace(tmparchive,join(folder,archive))
+    index_path=join(folder,PYLIGHTNIX_SUBST_INDEX)
+    with _subst_lock(folder):
+      index:Dict[str,Any]={'version':1,'rrefs':{}}
+      if isfile(index_path):
+        with open(index_path) as f:
+          index=json_loads(f.read())
+      index['rrefs'][rref]={'archive':archive, 'context':rrefctx(rref,S)}
+      with open(index_path+'.tmp','w') as f:
+        f.write(json_dumps(index,indent=2))
+      replace(index_path+'.tmp',index_path)
+
+def _subst_open(url:str, name:str,
+                timeout:Optional[float]=None)->Optional[IO[bytes]]:
+  u=urlparse(url)
+  if u.scheme in ['http','https']:
+    try:
+      return urlopen(url.rstrip('/')+'/'+name, timeout=timeout)
+    except HTTPError as e:
+      if e.code==404:
+        return None
+      raise
+  path=join(url2pathname(u.path) if u.scheme=='file' else url,name)
+  return open(path,'rb') if isfile(path) else None
+
+def substitute(url:str, dref:DRef, context:Context,
+               S:Optional[StorageSettings]=None)->List[RRef]:
+  """ Download the realizations of `dref` matching the `context` from the
+  binary cache `url` into the storage `S`. Return the list of realizations
+  downloaded. The cache is either a folder, a `file://` URL or an `http(s)://`
+  URL of a folder populated by [store_publish](#pylightnix.arch.store_publish).
+
+  Realizations are verified against their hashes before they appear in the
+  storage. [realize](#pylightnix.core.realize) calls `substitute` for each of
+  the `substituters` listed in the storage settings, see
+  [fsconfig](#pylightnix.core.fsconfig). Network operations time out after
+  `substituters_timeout` seconds of the same settings. Example:
+
+  ```python
+  store_publish(allrrefs(), '/srv/www/cache')    # On the build host
+  fsconfig_update(substituters=['http://build-host/cache'])
+  realize1(instantiate(mystage))                 # Downloads instead of building
+  ```
+  """
+  folder=basename(dref2path(dref,S))
+  timeout=fsconfig(S)['substituters_timeout']
+  f=_subst_open(url,folder+'/'+PYLIGHTNIX_SUBST_INDEX,timeout)
+  if f is None:
+    return []
+  with f:
+    index=json_loads(f.read().decode('utf-8'))
+  assert index['version']==1, f"Unsupported cache version {index['version']}"
+  received=[]
+  for rref,entry in index['rrefs'].items():
+    if rref2dref(rref)!=dref or isdir(rref2path(rref,S)) or \
+       not context_eq(context,entry['context']):
+      continue
+    a=_subst_open(url,folder+'/'+entry['archive'],timeout)
+    assert a is not None, f"Cache '{url}' misses the archive of {rref}"
+    with a:
+      sunpack_stream(a,S,roots=[rref],context=context)
+    received.append(rref)
+  return received
 
+substituter_set_(substitute)
@@ -20,7 +20,10 @@ from pylightnix.imports import (isfile, isdir, listdir, join, rmtree, environ,
     Popen, rename, getsize, fnmatch, dirname, relpath)
 from pylightnix.core import (dref2path, rref2path, isrref, isdref,
     alldrefs, drefrrefs, drefcfg_, cfgname,
-    instantiate, drefcfgpath, rref2dref, fsstorage)
+    instantiate, drefcfgpath, rref2dref, fsstorage, metacache_clear,
+    allrrefs, unrref, hasstoredb, storedbpath)
+from pylightnix.storedb import (storedb_rrefs, storedb_drefs,
+    storedb_remove_rref, storedb_remove_dref)
 from pylightnix.utils import (dirchmod, dirrm, dirsize, parsetime, timestring,
                               forcelink, isrefpath)
 
@@ -71,16 +74,23 @@ def rmref(r:Union[RRef,DRef], S=None)->None:
   """ Forcebly remove a reference from the storage. Removing
   [DRefs](#pylightnix.types.DRef) also removes all their realizations.
 
-  Currently Pylightnix makes no attempts to synchronize an access to the
-  storage. In scenarious involving parallelization, users are expected to take
-  care of possible race conditions.
+  Pylightnix only synchronizes the realization of derivations, see
+  [dreflock](#pylightnix.core.dreflock). Removing references used by concurrent
+  processes is not synchronized, users are expected to take care of possible
+  race conditions.
   """
   if isrref(r):
-    dirrm(rref2path(RRef(r),S=S), ignore_not_found=False)
+    path=rref2path(RRef(r),S=S)
+    if hasstoredb(S):
+      storedb_remove_rref(storedbpath(S),RRef(r))
   elif isdref(r):
-    dirrm(dref2path(DRef(r),S=S), ignore_not_found=False)
+    path=dref2path(DRef(r),S=S)
+    if hasstoredb(S):
+      storedb_remove_dref(storedbpath(S),DRef(r))
   else:
     assert False, f"Invalid reference {r}"
+  metacache_clear(path)
+  dirrm(path, ignore_not_found=False)
 
 def shell(r:Union[RRef,DRef,Build,Path,str,None]=None, S=None)->None:
   """ Open the Unix Shell in the directory associated with the argument passed.
@@ -120,8 +130,19 @@ def shellref(r:Union[RRef,DRef,None]=None, S=None)->None:
 def du(S=None)->Dict[DRef,Tuple[int,Dict[RRef,int]]]:
   """ Calculates the disk usage, in bytes. For every derivation, return it's
   total disk usage and disk usages per realizations. Note, that total disk usage
-  of a derivation is slightly bigger than sum of it's realization's usages."""
-  res={}
+  of a derivation is slightly bigger than sum of it's realization's usages.
+
+  Realization usages are taken from the storage index if it exists. """
+  res:Dict[DRef,Tuple[int,Dict[RRef,int]]]={}
+  if hasstoredb(S):
+    path=storedbpath(S)
+    for dref in storedb_drefs(path):
+      res[dref]=(getsize(join(dref2path(dref,S=S),'config.json')),{})
+    for rref,dref,_,_,usage in storedb_rrefs(path):
+      dref_total,rref_res=res[dref]
+      rref_res[rref]=usage
+      res[dref]=(dref_total+usage,rref_res)
+    return res
   for dref in alldrefs(S=S):
     rref_res={}
     dref_total=0
@@ -165,27 +186,27 @@ def find(name:Optional[Union[Stage,str]]=None,
       assert len(drefs)==1, \
         f"Only a one-target stages is supported as a name argument"
       name_=cfgname(drefcfg_(drefs[0], S=S))
-  for dref in alldrefs(S=S):
-    for rref in drefrrefs(dref,S=S):
-      if name_ is not None:
-        if not fnmatch(cfgname(drefcfg_(rref2dref(rref),S=S)),name_):
-          continue
-      if newer is not None:
-        if newer<=0:
-          reftime=parsetime(timestring())
-          assert reftime is not None
-          reftime-=abs(newer)
-        else:
-          reftime=newer
-        # FIXME: repair buildtime search
-        # btstr=rrefbtime(rref)
-        # if btstr is None:
-        #   continue
-        # btime=parsetime(btstr) if btstr is not None else None
-        # if btime is not None:
-        #   if btime < reftime:
-        #     continue
-      rrefs.append(rref)
+  for rref in allrrefs(S=S):
+    if name_ is not None:
+      # Reference names are the config names, see `mkdrv_`
+      if not fnmatch(unrref(rref)[2],name_):
+        continue
+    if newer is not None:
+      if newer<=0:
+        reftime=parsetime(timestring())
+        assert reftime is not None
+        reftime-=abs(newer)
+      else:
+        reftime=newer
+      # FIXME: repair buildtime search
+      # btstr=rrefbtime(rref)
+      # if btstr is None:
+      #   continue
+      # btime=parsetime(btstr) if btstr is not None else None
+      # if btime is not None:
+      #   if btime < reftime:
+      #     continue
+    rrefs.append(rref)
   return rrefs
 
 def diff(stageA:Union[RRef,DRef,Stage],
@@ -22,7 +22,12 @@ from pylightnix.imports import (sha256, deepcopy, isdir, islink, makedirs, join,
                                 isfile, relpath, listdir, rmtree, mkdtemp,
                                 replace, split, re_match, ENOTEMPTY, get_ident,
                                 contextmanager, OrderedDict, lstat, maxsize,
-                                readlink, getLogger, format_exc, environ)
+                                readlink, getLogger, format_exc, environ,
+                                ProcessPoolExecutor, mp_get_context, Lock,
+                                BrokenProcessPool, Handler, LogRecord,
+                                QueueHandler, QueueListener, import_module,
+                                pickle_dumps, atexit_register, Event,
+                                makeLogRecord, count)
 
 from pylightnix.utils import (dirhash, assert_serializable, assert_valid_dict,
                               dicthash, scanref_dict, scanref_list, forcelink,
@@ -74,6 +79,9 @@ class BuildError(PylightnixException):
     self.dref=dref
     self.exception=exception
     self.outpaths:List[Path]=outpaths.val if outpaths else []
+  def __reduce__(self):
+    return (BuildError, (self.S, self.dref, Output(self.outpaths),
+                         self.exception, self.args[0] if self.args else ''))
   def __str__(self):
     return f"Failed to realize1 '{self.dref}': {self.exception}"
 
@@ -83,48 +91,205 @@ def mkbuildargs(S:Optional[StorageSettings], dref:DRef, context:Context,
   assert_valid_config(drefcfg(dref,S))
   return BuildArgs(S, dref, context, starttime, stoptime, iarg, rarg)
 
+#: Modules to import in the worker processes of the isolated builds, see
+#: [build_pool](#pylightnix.build.build_pool). Defaults to the space-separated
+#: list of the `PYLIGHTNIX_BUILD_PRELOAD` environment variable.
+PYLIGHTNIX_BUILD_PRELOAD:List[str]=\
+  environ.get('PYLIGHTNIX_BUILD_PRELOAD','').split()
+
+#: Maximum number of seconds to wait for the log records of a finished isolated
+#: build to arrive.
+PYLIGHTNIX_BUILD_LOG_TIMEOUT=10.0
+
+#: The running pool, its log listener, `max_workers` and `preload` modules
+_BUILD_POOL:Optional[Tuple[ProcessPoolExecutor,QueueListener,
+                           Optional[int],List[str]]]=None
+_BUILD_POOL_LOCK=Lock()
+_BUILD_TOKENS=count()
+_BUILD_DONE:Dict[int,Event]={}
+_BUILD_QUEUE:Any=None # The log queue of a worker process
+
+class _LogForwarder(Handler):
+  """ Pass log records received from the worker processes to the loggers of
+  the current process. Records marking the end of builds are consumed. """
+  def emit(self, record:LogRecord)->None:
+    token=getattr(record,'pylightnix_build_done',None)
+    if token is None:
+      getLogger(record.name).handle(record)
+    else:
+      ev=_BUILD_DONE.get(token) # The build may have timed out already
+      if ev is not None:
+        ev.set()
+
+def _build_worker_init(queue:Any, level:int, preload:List[str])->None:
+  global _BUILD_QUEUE
+  _BUILD_QUEUE=queue
+  root=getLogger()
+  root.handlers=[QueueHandler(queue)]
+  root.setLevel(level)
+  for m in preload:
+    import_module(m)
+
+def build_pool(max_workers:Optional[int]=None,
+               preload:Optional[List[str]]=None)->ProcessPoolExecutor:
+  """ Return the pool of worker processes which run the isolated builds, see
+  [build_wrapper](#pylightnix.build.build_wrapper). Start the pool if it is
+  not running. Workers are kept alive between the builds.
+
+  Workers are started by the `forkserver` method of `multiprocessing`.
+  The `preload` modules, [PYLIGHTNIX_BUILD_PRELOAD](#pylightnix.build.PYLIGHTNIX_BUILD_PRELOAD)
+  by default, are imported by the fork server and by every worker once, so
+  heavy imports don't slow down the builds. The fork server is started once
+  per process, so only the `preload` of the first pool takes effect there.
+  Workers of the pools started later import their own `preload` modules
+  without the help of the fork server. Log records of the workers are passed
+  to the loggers of the current process. Call
+  [build_pool_shutdown](#pylightnix.build.build_pool_shutdown) before calling
+  `build_pool` with different arguments, `None` arguments match any running
+  pool. """
+  global _BUILD_POOL
+  with _BUILD_POOL_LOCK:
+    if _BUILD_POOL is not None:
+      _,_,max_workers_,preload_=_BUILD_POOL
+      assert max_workers is None or max_workers==max_workers_, (
+        f"The build pool is running with max_workers={max_workers_}, "
+        f"call build_pool_shutdown() to restart it with {max_workers}")
+      assert preload is None or preload==preload_, (
+        f"The build pool is running with preload={preload_}, "
+        f"call build_pool_shutdown() to restart it with {preload}")
+    else:
+      preload_=PYLIGHTNIX_BUILD_PRELOAD if preload is None else preload
+      ctx=mp_get_context('forkserver')
+      ctx.set_forkserver_preload(['pylightnix']+preload_)
+      queue=ctx.Queue()
+      listener=QueueListener(queue,_LogForwarder())
+      listener.start()
+      pool=ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                               initializer=_build_worker_init,
+                               initargs=(queue,getLogger().getEffectiveLevel(),
+                                         preload_))
+      _BUILD_POOL=(pool,listener,max_workers,preload_)
+    return _BUILD_POOL[0]
+
+def build_pool_shutdown()->None:
+  """ Stop the worker processes of the isolated builds, see
+  [build_pool](#pylightnix.build.build_pool). """
+  global _BUILD_POOL
+  with _BUILD_POOL_LOCK:
+    if _BUILD_POOL is not None:
+      pool,listener,_,_=_BUILD_POOL
+      _BUILD_POOL=None
+      pool.shutdown(wait=True)
+      listener.stop()
+
+atexit_register(build_pool_shutdown)
+
 _B=TypeVar('_B', bound=Build)
+def build_run_(f:Callable[[_B],None],
+               ctr:Callable[[BuildArgs],_B],
+               nouts:Optional[int],
+               ba:BuildArgs)->Output[Path]:
+  """ Run the Build-realizer `f`. Not intended to be called by user. """
+  b=ctr(ba)
+  if nouts is not None:
+    build_markstart(b,nouts)
+  try:
+    f(b)
+  except KeyboardInterrupt:
+    build_markstop_noexcept(b) # type:ignore
+    raise
+  except Exception as e:
+    build_markstop_noexcept(b) # type:ignore
+    error(f"Build wrapper of {ba.dref} raised an exception. Remaining "
+          f"build directories are: {b.outpaths.val if b.outpaths else '?'}")
+    raise BuildError(ba.S,ba.dref,b.outpaths,e)
+  assert b.outpaths is not None, \
+    "Builder should produce at least one output path"
+  build_markstop(b) # type:ignore
+  return b.outpaths
+
+def _build_run_isolated(token:int, f:Callable[[_B],None],
+                        ctr:Callable[[BuildArgs],_B], nouts:Optional[int],
+                        ba:BuildArgs)->Output[Path]:
+  try:
+    return build_run_(f,ctr,nouts,ba)
+  finally:
+    _BUILD_QUEUE.put(makeLogRecord({'name':__name__,
+                                    'pylightnix_build_done':token}))
+
 def build_wrapper_(f:Callable[[_B],None],
                    ctr:Callable[[BuildArgs],_B],
                    nouts:Optional[int]=1,
                    starttime:Optional[str]='AUTO',
-                   stoptime:Optional[str]='AUTO')->Realizer:
+                   stoptime:Optional[str]='AUTO',
+                   isolation:str='none')->Realizer:
   """ Build Adapter which convers user-defined realizers which use
   [Build](#pylightnix.types.Build) API into a low-level
-  [Realizer](#pylightnix.types.Realizer)
+  [Realizer](#pylightnix.types.Realizer). See
+  [build_wrapper](#pylightnix.build.build_wrapper) for the description of
+  `isolation`.
   """
 
   assert starttime is None or isinstance(starttime,str)
   assert stoptime is None or isinstance(stoptime,str)
+  assert isolation in ['none','process'], f"Invalid isolation '{isolation}'"
+  if isolation=='process':
+    try:
+      pickle_dumps((f,ctr))
+    except Exception as e:
+      assert False, (
+        f"Isolated builds require module-level Build functions and classes, "
+        f"but {f} or {ctr} can't be pickled: {e}")
 
   def _wrapper(S:Optional[StorageSettings],dref,context,rarg)->Output:
-    b=ctr(mkbuildargs(S,dref,context,starttime,stoptime,{},rarg))
-    if nouts is not None:
-      build_markstart(b,nouts)
+    ba=mkbuildargs(S,dref,context,starttime,stoptime,{},rarg)
+    if isolation=='none':
+      return build_run_(f,ctr,nouts,ba)
+    token=next(_BUILD_TOKENS)
+    _BUILD_DONE[token]=Event()
     try:
-      f(b)
-    except KeyboardInterrupt:
-      build_markstop_noexcept(b) # type:ignore
-      raise
-    except Exception as e:
-      build_markstop_noexcept(b) # type:ignore
-      error(f"Build wrapper of {dref} raised an exception. Remaining "
-            f"build directories are: {b.outpaths.val if b.outpaths else '?'}")
-      raise BuildError(S,dref,b.outpaths,e)
-    assert b.outpaths is not None, \
-      "Builder should produce at least one output path"
-    build_markstop(b) # type:ignore
-    return b.outpaths
+      fut=build_pool().submit(_build_run_isolated,token,f,ctr,nouts,ba)
+      try:
+        return fut.result()
+      finally:
+        if not isinstance(fut.exception(),BrokenProcessPool):
+          _BUILD_DONE[token].wait(PYLIGHTNIX_BUILD_LOG_TIMEOUT)
+    except BrokenProcessPool as e:
+      build_pool_shutdown()
+      error(f"The worker process building {dref} terminated abruptly")
+      raise BuildError(S,dref,None,e)
+    finally:
+      del _BUILD_DONE[token]
   return output_realizer(_wrapper)
 
 def build_wrapper(f:Callable[[Build],None],
                   nouts:Optional[int]=1,
                   starttime:Optional[str]='AUTO',
-                  stoptime:Optional[str]='AUTO')->Realizer:
+                  stoptime:Optional[str]='AUTO',
+                  isolation:str='none')->Realizer:
   """ Build Adapter which convers user-defined realizers which use
   [Build](#pylightnix.types.Build) API into a low-level
-  [Realizer](#pylightnix.types.Realizer) """
-  return build_wrapper_(f,Build,nouts,starttime,stoptime)
+  [Realizer](#pylightnix.types.Realizer).
+
+  By default, `f` runs in the calling thread. `isolation='process'` runs it in
+  a worker process of the [build_pool](#pylightnix.build.build_pool), so
+  CPU-bound realizers run on separate cores and crashes of native code are
+  reported as [BuildError](#pylightnix.build.BuildError) instead of
+  terminating the caller. `f` should be a module-level function then. Output
+  paths are passed back to the calling process which puts them into the
+  storage.
+
+  Example:
+  ```python
+  def train(b:Build)->None:
+    import tensorflow as tf # Preloaded by the workers
+    ...
+
+  build_pool(max_workers=4, preload=['tensorflow'])
+  mkdrv(config, match_only(), build_wrapper(train, isolation='process'), r)
+  ```
+  """
+  return build_wrapper_(f,Build,nouts,starttime,stoptime,isolation)
 
 def build_config(b:Build)->RConfig:
   """ Return the [Config](#pylightnix.types.RConfig) object of the realization
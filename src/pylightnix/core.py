@@ -14,15 +14,41 @@
 
 """
 Core Pylightnix definitions
+
+[instantiate](#pylightnix.core.instantiate), [mkdrv](#pylightnix.core.mkdrv),
+[realize](#pylightnix.core.realize) and
+[mkrealization](#pylightnix.core.mkrealization) may be called concurrently from
+many threads and processes sharing a storage, and threads may share a
+[Registry](#pylightnix.types.Registry). Storage objects are content-addressed:
+they are prepared under unique temporary names and moved in place atomically,
+so concurrent writers of the same object agree on its contents. Realizers of a
+derivation are serialized by [dreflock](#pylightnix.core.dreflock). Removing
+objects from a storage which is in use is not safe.
 """
 
 from pylightnix.imports import (sha256, deepcopy, isdir, islink, makedirs,
                                 join, json_dump, json_load, json_dumps,
                                 json_loads, isfile, relpath, listdir, rmtree,
                                 mkdtemp, replace, environ, split, re_match,
-                                ENOTEMPTY, get_ident, contextmanager,
-                                OrderedDict, lstat, maxsize, readlink, chain,
-                                getLogger, scandir, threading_local)
+                                remove, ENOTEMPTY, EEXIST, get_ident,
+                                contextmanager, getpid,
+                                stat, utime, time_ns, link, walk, S_IMODE,
+                                chmod,
+                                S_IWRITE,
+                                OrderedDict, defaultdict, lstat, maxsize,
+                                readlink, chain,
+                                getLogger, scandir, threading_local,
+                                ThreadPoolExecutor, ProcessPoolExecutor,
+                                Future, futures_wait, FIRST_COMPLETED,
+                                mp_get_context, count, flock, LOCK_EX,
+                                LOCK_NB, LOCK_UN, os_open, os_close, os_read,
+                                ftruncate, pwrite, fstat, kill,
+                                O_RDWR, O_CREAT, gethostname, sleep, time,
+                                get_running_loop, wrap_future, ensure_future,
+                                gather, Semaphore, CancelledError, asyncio_run,
+                                iscoroutinefunction, asyncio_sleep,
+                                getrlimit, setrlimit, RLIMIT_AS, shield,
+                                RLIM_INFINITY)
 
 from pylightnix.utils import (dirhash, assert_serializable, assert_valid_dict,
                               dicthash, scanref_dict, scanref_list, forcelink,
@@ -30,7 +56,14 @@ from pylightnix.utils import (dirhash, assert_serializable, assert_valid_dict,
                               tryread, encode, dirchmod, dirrm, filero, isrref,
                               isdref, traverse_dict, tryread_def,
                               tryreadjson_def, isrefpath, kahntsort, dagroots,
-                              isselfpath, selfref)
+                              isselfpath, selfref, LRUCache, writejson,
+                              dirsize, filedigest, reflink, vmsize)
+
+from pylightnix.storedb import (storedb_init, storedb_add, storedb_drefs,
+                                storedb_rrefs, storedb_drefdependents,
+                                storedb_rrefdependents, storedb_rootdrefs,
+                                storedb_rootrrefs, storedb_drefdepsall,
+                                storedb_rrefdepsall)
 
 from pylightnix.types import (StorageSettings, Dict, List, Any, Tuple, Union,
                               Optional, Iterable, IO, Path, SPath, Hash, DRef,
@@ -40,7 +73,8 @@ from pylightnix.types import (StorageSettings, Dict, List, Any, Tuple, Union,
                               Realizer, RealizerO, Set, Closure, Generator,
                               BuildArgs, Config, RealizeArg, InstantiateArg,
                               Output, TypeVar, PromiseException, StageResult,
-                              Tuple, Iterator)
+                              Tuple, Iterator, RealizerAsync, MatcherAsync,
+                              Resources)
 
 
 #: *Do not change!*
@@ -54,6 +88,52 @@ PYLIGHTNIX_NAMEPAT="[a-zA-Z0-9_-]"
 #: not normally create or alter files with these names.
 PYLIGHTNIX_RESERVED=['context.json','group.json']
 
+#: Maximum number of parsed `config.json` and `context.json` files kept in the
+#: [METACACHE](#pylightnix.core.METACACHE). May be altered by the
+#: `PYLIGHTNIX_METACACHE_SIZE` environment variable.
+PYLIGHTNIX_METACACHE_SIZE=int(environ.get('PYLIGHTNIX_METACACHE_SIZE','4096'))
+
+#: In-memory cache of the parsed storage metadata, keyed by file paths.
+#: Derivation and realization folders are immutable, so the entries remain
+#: valid until the objects are removed from the storage.
+METACACHE=LRUCache(PYLIGHTNIX_METACACHE_SIZE)
+
+#: Default values of the per-storage settings, see
+#: [fsconfig](#pylightnix.core.fsconfig).
+#: * `dirhash_version` selects the scheme used to hash realizations, see
+#:   [dirshash](#pylightnix.utils.dirshash).
+#: * `dirhash_workers` limits the number of hashing threads, if the scheme
+#:   supports them.
+#: * `dedup` enables the deduplication of realization files, see
+#:   [blobdedup](#pylightnix.core.blobdedup). Valid values are `None`,
+#:   `'hardlink'` and `'reflink'`.
+#: * `dedup_min_size` sets the minimal size of files to deduplicate.
+#: * `readonly` defines the write-protection of new realizations. `'all'` makes
+#:   every file and folder read-only. `'top'` protects only the top-level
+#:   folder, trusting realizers not to modify their outputs afterwards. See
+#:   [dirchmod](#pylightnix.utils.dirchmod).
+#: * `substituters` lists the binary caches to query for missing realizations,
+#:   see [substitute](#pylightnix.arch.substitute). `None` means the
+#:   space-separated list of the `PYLIGHTNIX_SUBSTITUTERS` environment variable.
+#: * `substituters_timeout` limits the time, in seconds, to wait for a network
+#:   operation of an `http(s)://` substituter.
+#: * `lock_timeout` limits the time, in seconds, to wait for other processes
+#:   realizing the same derivation, see [dreflock](#pylightnix.core.dreflock).
+#:   `None` means waiting forever.
+PYLIGHTNIX_FSCONFIG_DEFAULTS:Dict[str,Any]={
+  'dirhash_version':0,
+  'dirhash_workers':None,
+  'dedup':None,
+  'dedup_min_size':64*1024,
+  'readonly':'all',
+  'substituters':None,
+  'substituters_timeout':60.0,
+  'lock_timeout':None}
+
+#: Interval, in seconds, between attempts to take a busy
+#: [derivation lock](#pylightnix.core.dreflock).
+PYLIGHTNIX_LOCK_POLL=0.1
+
 
 logger=getLogger(__name__)
 info=logger.info
@@ -145,18 +225,73 @@ def setregistry(r:Optional[Registry])->Optional[Registry]:
   setattr(TL,'registry',r)
   return old
 
+def fsconfigpath(S:Optional[StorageSettings]=None)->Path:
+  return Path(join(fsstorage(S),'storage.json'))
+
+def storedbpath(S:Optional[StorageSettings]=None)->Path:
+  """ Return the location of the optional [index](#pylightnix.storedb) of the
+  storage. """
+  return Path(join(fsstorage(S),'store.db'))
+
+def hasstoredb(S:Optional[StorageSettings]=None)->bool:
+  """ Check whether the storage `S` is indexed, see
+  [store_reindex](#pylightnix.core.store_reindex). """
+  return isfile(storedbpath(S))
+
+def fsconfig(S:Optional[StorageSettings]=None)->Dict[str,Any]:
+  """ Return the settings of the storage `S`. Settings are kept in the
+  `storage.json` file of the storage folder. Missing fields are taken from
+  [PYLIGHTNIX_FSCONFIG_DEFAULTS](#pylightnix.core.PYLIGHTNIX_FSCONFIG_DEFAULTS).
+  The parsed file is cached until its modification time or inode changes, so
+  updates made by other processes are seen. """
+  path=fsconfigpath(S)
+  try:
+    st=stat(path)
+    version:Optional[Tuple[int,int]]=(st.st_mtime_ns,st.st_ino)
+  except FileNotFoundError:
+    version=None
+  cached=METACACHE.get(path)
+  if cached is None or cached[0]!=version:
+    cfg=deepcopy(PYLIGHTNIX_FSCONFIG_DEFAULTS)
+    cfg.update(tryreadjson_def(path,{}))
+    METACACHE.put(path,(version,cfg))
+  else:
+    cfg=cached[1]
+  cfg=deepcopy(cfg)
+  if cfg['substituters'] is None:
+    cfg['substituters']=environ.get('PYLIGHTNIX_SUBSTITUTERS','').split()
+  return cfg
+
+def fsconfig_update(S:Optional[StorageSettings]=None, **kwargs)->None:
+  """ Update the settings of the storage `S`, see
+  [fsconfig](#pylightnix.core.fsconfig). Settings affect objects which are
+  created after the update. """
+  for k in kwargs.keys():
+    assert k in PYLIGHTNIX_FSCONFIG_DEFAULTS, \
+      f"Unknown storage setting '{k}'"
+  path=fsconfigpath(S)
+  cfg=tryreadjson_def(path,{})
+  cfg.update(kwargs)
+  tmppath=tmpname_(path)
+  writejson(tmppath,cfg,indent=2)
+  replace(tmppath,path)
+  metacache_clear(fsstorage(S))
+
 def fsinit(ss:Optional[Union[str,StorageSettings]]=None,
            check_not_exist:bool=False,
            remove_existing:bool=False,
-           use_as_default:bool=True)->None:
+           use_as_default:bool=True,
+           dirhash_version:Optional[int]=None)->None:
   """ Imperatively create the filesystem storage and temp direcory if they don't
   exist.  Default locations may be altered by `PYLIGHTNIX_STORAGE` and
-  `PYLIGHTNIX_TMP` env variables. """
+  `PYLIGHTNIX_TMP` env variables. Non-default `dirhash_version` is saved into
+  the storage settings, see [fsconfig](#pylightnix.core.fsconfig). """
   P='_pylightnix'
   S:Optional[StorageSettings]=\
     mkSS(Path(join(ss,P) if not ss.endswith(P) else ss)) \
     if isinstance(ss,str) else ss
   if remove_existing:
+    metacache_clear(fsstorage(S))
     dirrm(fsstorage(S))
     dirrm(fstmpdir(S))
     makedirs(fsstorage(S), exist_ok=False)
@@ -164,6 +299,8 @@ def fsinit(ss:Optional[Union[str,StorageSettings]]=None,
   else:
     makedirs(fsstorage(S), exist_ok=False if check_not_exist else True)
     makedirs(fstmpdir(S), exist_ok=False if check_not_exist else True)
+  if dirhash_version is not None:
+    fsconfig_update(S, dirhash_version=dirhash_version)
   if use_as_default:
     setstorage(S)
   assert_valid_storage(S)
@@ -274,7 +411,7 @@ def cfghash(c:Config)->Hash:
 
 def cfgname(c:Config)->Name:
   """ Return a `name` field of a config `c`, defaulting to string "unnmaed". """
-  return mkname(cfgdict(c).get('name','unnamed'))
+  return mkname(c.val.get('name','unnamed'))
 
 def cfgdeps(c:Config)->Set[DRef]:
   drefs,_=scanref_dict(cfgdict(c))
@@ -322,20 +459,44 @@ def rrefpath2path(r:RRef, refpath:RefPath, S=None)->Path:
 def drefcfgpath(r:DRef,S=None)->Path:
   return Path(join(dref2path(r,S),'config.json'))
 
+def metacache_clear(path:Optional[Path]=None)->None:
+  """ Drop the cached metadata of storage objects located under the `path`.
+  Clear the whole [METACACHE](#pylightnix.core.METACACHE) if `path` is None.
+  Functions that remove objects from the storage should call this function. """
+  if path is None:
+    METACACHE.clear()
+  else:
+    prefix=join(path,'')
+    METACACHE.invalidate(lambda k: k.startswith(prefix))
+
+def metacache_stats()->Tuple[int,int]:
+  """ Return the number of hits and misses of the
+  [METACACHE](#pylightnix.core.METACACHE) """
+  return METACACHE.hits,METACACHE.misses
+
 def rrefctx(r:RRef, S=None)->Context:
   """ Return the realization context. """
   assert_valid_rref(r)
-  ctx=readjson(join(rref2path(r,S),'context.json'))
-  assert isinstance(ctx,dict)
-  return ctx
+  path=join(rref2path(r,S),'context.json')
+  ctx=METACACHE.get(path)
+  if ctx is None:
+    ctx=readjson(path)
+    assert isinstance(ctx,dict)
+    METACACHE.put(path,ctx)
+  return {k:list(v) for k,v in ctx.items()}
 
 def drefcfg_(dref:DRef,S=None)->Config:
   """ Return `dref` configuration, selfrefs are _not_ resolved """
-  cfg=readjson(drefcfgpath(dref,S))
-  assert isinstance(cfg,dict)
-  c=Config(cfg)
-  assert_valid_config(c)
-  return c
+  path=drefcfgpath(dref,S)
+  cfg=METACACHE.get(path)
+  if cfg is None:
+    cfg=readjson(path)
+    assert isinstance(cfg,dict)
+    c=Config(cfg)
+    assert_valid_config(c)
+    METACACHE.put(path,c.val)
+    return c
+  return Config(cfg)
 
 def drefcfg(dref:DRef,S=None)->RConfig:
   """ Return `dref` configuration, selfrefs are resolved """
@@ -371,18 +532,33 @@ def rrefdeps1(rrefs:Iterable[RRef],S=None)->Set[RRef]:
       acc|=set(context_deref(rrefctx(rref,S),dref_dep))
   return acc
 
+def drefdepsmap(drefs:Iterable[DRef],S=None)->Dict[DRef,Set[DRef]]:
+  """ Return a dict mapping `drefs` and all of their dependencies to the
+  complete sets of their own dependencies. The `config.json` of every
+  derivation is read only once, so the cost is proportional to the number of
+  edges of the dependency graph. """
+  deps1:Dict[DRef,Set[DRef]]={}
+  frontier=list(drefs)
+  while frontier:
+    dref=frontier.pop()
+    if dref not in deps1:
+      deps1[dref]=drefdeps1([dref],S)
+      frontier.extend(deps1[dref])
+  topsorted=kahntsort(deps1.keys(), lambda x:deps1[x])
+  assert topsorted is not None, (
+    f"Falied to topologically sort the dependencies of {list(drefs)}. This "
+    f"probably means that the storage is damaged")
+  acc:Dict[DRef,Set[DRef]]={}
+  for dref in topsorted:
+    acc[dref]=set(deps1[dref]).union(*[acc[d] for d in deps1[dref]])
+  return acc
+
 def drefdeps(drefs:Iterable[DRef],S=None)->Set[DRef]:
   """ Return the complete set of `drefs`'s dependencies, not including `drefs`
   themselves. """
-  frontier=drefdeps1(drefs,S)
-  processed=set()
-  while frontier:
-    ref = frontier.pop()
-    processed.add(ref)
-    for dep in drefdeps1([ref],S):
-      if dep not in processed:
-        frontier.add(dep)
-  return processed
+  drefs_=list(drefs)
+  depsmap=drefdepsmap(drefs_,S)
+  return set().union(*[depsmap[dref] for dref in drefs_])
 
 def rrefdeps(rrefs:Iterable[RRef],S=None)->Set[RRef]:
   """ Return the complete set of rrefs's dependencies, not including `rrefs`
@@ -400,21 +576,119 @@ def rrefdeps(rrefs:Iterable[RRef],S=None)->Set[RRef]:
 
 def alldrefs(S=None)->Iterable[DRef]:
   """ Iterates over all derivations of the storage located at `S`
-  (PYLIGHTNIX_STORE env is used by default) """
+  (PYLIGHTNIX_STORE env is used by default). Queries the index of the storage
+  if it exists. """
+  if hasstoredb(S):
+    for dref in storedb_drefs(storedbpath(S)):
+      yield dref
+  else:
+    for dref in alldrefs_(S):
+      yield dref
+
+def alldrefs_(S=None)->Iterable[DRef]:
+  """ Iterates over all derivations by scanning the storage folder. The index
+  is not used. """
   store_path_=fsstorage(S)
   for dirname in listdir(store_path_):
-    if dirname[-4:]!='.tmp' and isdir(join(store_path_,dirname)):
+    if dirname[-4:]!='.tmp' and dirname[0]!='_' and \
+       isdir(join(store_path_,dirname)):
       yield mkdref(HashPart(dirname[:32]), Name(dirname[32+1:]))
 
 def allrrefs(S=None)->Iterable[RRef]:
   """ Iterates over all realization references in `S` (PYLIGHTNIX_STORE env is
-  used by default) """
-  for dref in alldrefs(S):
-    for rref in drefrrefs(dref,S):
+  used by default). Queries the index of the storage if it exists. """
+  if hasstoredb(S):
+    for rref,_,_,_,_ in storedb_rrefs(storedbpath(S)):
       yield rref
+  else:
+    for dref in alldrefs_(S):
+      for rref in drefrrefs(dref,S):
+        yield rref
+
+def drefdependentsmap(S=None)->Dict[DRef,Set[DRef]]:
+  """ Return a dict mapping derivations to the sets of derivations which
+  immediately depend on them. Derivations without dependents are omitted.
+  Queries the index of the storage if it exists, otherwise scans the configs of
+  all derivations once. """
+  acc:Dict[DRef,Set[DRef]]=defaultdict(set)
+  if hasstoredb(S):
+    for dref,dep in storedb_drefdepsall(storedbpath(S)):
+      acc[dep].add(dref)
+  else:
+    for dref in alldrefs_(S):
+      for dep in drefdeps1([dref],S):
+        acc[dep].add(dref)
+  return dict(acc)
+
+def rrefdependentsmap(S=None)->Dict[RRef,Set[RRef]]:
+  """ Return a dict mapping realizations to the sets of realizations which
+  immediately depend on them. Realizations without dependents are omitted.
+  Queries the index of the storage if it exists, otherwise scans the contexts
+  of all realizations once. """
+  acc:Dict[RRef,Set[RRef]]=defaultdict(set)
+  if hasstoredb(S):
+    for rref,dep in storedb_rrefdepsall(storedbpath(S)):
+      acc[dep].add(rref)
+  else:
+    for rref in allrrefs(S):
+      for dep in rrefdeps1([rref],S):
+        acc[dep].add(rref)
+  return dict(acc)
+
+def dependents_(roots:Iterable[Any],
+                dependents1:Callable[[Set[Any]],Set[Any]])->Set[Any]:
+  acc:Set[Any]=set()
+  frontier=set(roots)
+  while frontier:
+    frontier=dependents1(frontier)-acc
+    acc|=frontier
+  return acc
+
+def drefdependents1(drefs:Iterable[DRef],S=None)->Set[DRef]:
+  """ Return a set of derivations which immediately depend on `drefs`. Queries
+  the index of the storage if it exists, otherwise scans the configs of all
+  derivations. """
+  drefs_=set(drefs)
+  if hasstoredb(S):
+    return storedb_drefdependents(storedbpath(S),list(drefs_))
+  m=drefdependentsmap(S)
+  return set().union(*[m.get(d,set()) for d in drefs_])
+
+def rrefdependents1(rrefs:Iterable[RRef],S=None)->Set[RRef]:
+  """ Return a set of realizations which immediately depend on `rrefs`. Queries
+  the index of the storage if it exists, otherwise scans the contexts of all
+  realizations. """
+  rrefs_=set(rrefs)
+  if hasstoredb(S):
+    return storedb_rrefdependents(storedbpath(S),list(rrefs_))
+  m=rrefdependentsmap(S)
+  return set().union(*[m.get(r,set()) for r in rrefs_])
+
+def drefdependents(drefs:Iterable[DRef],S=None)->Set[DRef]:
+  """ Return the complete set of derivations which depend on `drefs`, not
+  including `drefs` themselves. In other words, return the derivations which
+  are affected by changes in `drefs`. Without the index, the storage is scanned
+  only once. """
+  if hasstoredb(S):
+    return dependents_(drefs, lambda ds: drefdependents1(ds,S))
+  m=drefdependentsmap(S)
+  return dependents_(drefs, lambda ds: set().union(*[m.get(d,set())
+                                                     for d in ds]))
+
+def rrefdependents(rrefs:Iterable[RRef],S=None)->Set[RRef]:
+  """ Return the complete set of realizations which depend on `rrefs`, not
+  including `rrefs` themselves. Without the index, the storage is scanned only
+  once. """
+  if hasstoredb(S):
+    return dependents_(rrefs, lambda rs: rrefdependents1(rs,S))
+  m=rrefdependentsmap(S)
+  return dependents_(rrefs, lambda rs: set().union(*[m.get(r,set())
+                                                     for r in rs]))
 
 def rootdrefs(S:Optional[StorageSettings]=None)->Set[DRef]:
   """ Return root DRefs of the storage `S` as a set """
+  if hasstoredb(S):
+    return storedb_rootdrefs(storedbpath(S))
   def _inb(x):
     return drefdeps1([x],S=S)
   topsorted=kahntsort(alldrefs(S), _inb)
@@ -425,6 +699,8 @@ def rootdrefs(S:Optional[StorageSettings]=None)->Set[DRef]:
 
 def rootrrefs(S:Optional[StorageSettings]=None)->Set[RRef]:
   """ Return root RRefs of the storage `S` as a set """
+  if hasstoredb(S):
+    return storedb_rootrrefs(storedbpath(S))
   def _inb(x):
     return rrefdeps1([x],S=S)
   topsorted=kahntsort(allrrefs(S), _inb)
@@ -433,6 +709,26 @@ def rootrrefs(S:Optional[StorageSettings]=None)->Set[RRef]:
     f"probably means that the storage is damaged")
   return dagroots(topsorted, _inb)
 
+def rreftouch(rrefs:Iterable[RRef],S=None)->None:
+  """ Mark realizations as recently used by updating the access time of their
+  folders. [realize](#pylightnix.core.realize) and
+  [Lens.syspath](#pylightnix.lens.Lens.syspath) call this function, so the
+  eviction policy of the [garbage collector](#pylightnix.garb.gc_evict) could
+  rank realizations by their usage. Failures, e.g. those caused by read-only
+  shared storages, are ignored. """
+  now=time_ns()
+  for rref in rrefs:
+    path=rref2path(rref,S)
+    try:
+      utime(path, ns=(now,stat(path).st_mtime_ns))
+    except OSError:
+      pass
+
+def rrefatime(rref:RRef,S=None)->float:
+  """ Return the last access time of a realization, in seconds since the Epoch.
+  See [rreftouch](#pylightnix.core.rreftouch). """
+  return stat(rref2path(rref,S)).st_atime
+
 def rrefdata(rref:RRef,S=None)->Iterable[Path]:
   """ Iterate over top-level artifacts paths, ignoring reserved files. """
   root=rref2path(rref,S)
@@ -467,32 +763,83 @@ def store_gc(keep_drefs:List[DRef],
 
   Default location of `S` may be changed.
 
+  The collection makes a single marking pass over the dependencies of the
+  roots, followed by a single sweeping pass over the storage. Derivations of
+  `keep_drefs` and their dependencies are kept together with all their
+  realizations. Realizations of `keep_rrefs`, their dependencies and the
+  derivations of those are kept as well.
+
   See also [rmref](#pylightnix.bashlike.rmref)"""
-  clo_drefs=drefdeps(set(keep_drefs),S) | set(keep_drefs)
+  # Mark
+  clo_drefs=set(drefdepsmap(set(keep_drefs),S).keys())
   clo_rrefs=rrefdeps(set(keep_rrefs),S) | set(keep_rrefs)
-
-  clo_drefs2=clo_drefs | {rref2dref(rref) for rref in clo_rrefs}
-  clo_rrefs2=clo_rrefs | \
-    set.union(set(),*[drefrrefs(dref,S) for dref in clo_drefs]) # type:ignore
+  live_drefs=clo_drefs | {rref2dref(rref) for rref in clo_rrefs}
+  # Sweep
   remove_drefs=set()
   remove_rrefs=set()
   for dref in alldrefs(S):
-    if dref not in clo_drefs2:
+    if dref in clo_drefs:
+      continue
+    rrefs=drefrrefs(dref,S)
+    if dref not in live_drefs:
       remove_drefs.add(dref)
-      for rref in drefrrefs(dref,S):
-        remove_rrefs.add(rref)
+      remove_rrefs|=rrefs
     else:
-      for rref in drefrrefs(dref,S):
-        if rref not in clo_rrefs2:
-          remove_rrefs.add(rref)
+      remove_rrefs|=rrefs-clo_rrefs
   return remove_drefs,remove_rrefs
 
+def store_reindex(S:Optional[StorageSettings]=None)->None:
+  """ Build the SQLite [index](#pylightnix.storedb) of the storage `S` from
+  scratch by scanning the storage folder. Once the index exists,
+  [mkdrv](#pylightnix.core.mkdrv), [mkrealization](#pylightnix.core.mkrealization)
+  and [rmref](#pylightnix.bashlike.rmref) keep it up to date, and the storage
+  queries like [alldrefs](#pylightnix.core.alldrefs) or
+  [find](#pylightnix.bashlike.find) use it instead of scanning the storage.
+
+  Re-run this function to repair the index after removing storage objects
+  by other means. """
+  path=storedbpath(S)
+  tmppath=Path(path+'.tmp')
+  for p in [tmppath,tmppath+'-wal',tmppath+'-shm']:
+    if isfile(p):
+      remove(p)
+  drefs=list(alldrefs_(S))
+  storedb_init(tmppath)
+  storedb_add(tmppath,*storedb_rows_(
+    drefs,chain.from_iterable([drefrrefs(dref,S) for dref in drefs]),S))
+  replace(tmppath,path)
+
+def storedb_rows_(drefs:Iterable[DRef], rrefs:Iterable[RRef], S=None
+                  )->Tuple[list,list,list,list]:
+  """ Read the storage objects `drefs` and `rrefs` and prepare the index rows
+  in the format of [storedb_add](#pylightnix.storedb.storedb_add) arguments. """
+  drows=[]
+  rrows=[]
+  drefedges=[]
+  rrefedges=[]
+  for dref in drefs:
+    c=drefcfg_(dref,S)
+    drows.append((dref,cfgname(c),cfghash(c)))
+    drefedges.extend([(dref,dep) for dep in cfgdeps(c)])
+  for rref in rrefs:
+    rrefpath=rref2path(rref,S)
+    rrows.append((rref,rref2dref(rref),
+                  tryread_def(Path(join(rrefpath,'context.json')),''),
+                  tryread(Path(join(rrefpath,'__buildstart__.txt'))),
+                  dirsize(rrefpath)))
+    rrefedges.extend([(rref,dep) for dep in rrefdeps1([rref],S)])
+  return drows,rrows,drefedges,rrefedges
+
+
+def tmpname_(path:Path)->Path:
+  """ Return the temporary name for the storage object `path` which is unique
+  among threads and processes. Storage scanners skip the `.tmp` names. """
+  return Path(f"{path}.{getpid()}-{get_ident()}.tmp")
 
 def mkdrv_(c:Config,S=None)->DRef:
   """ See [mkdrv](#pylightnix.core.mkdrv) """
 
   # FIXME: Assert or handle possible (but improbable) hash collision [*]
-  # FIXME: Could the replace fail if two processes call it simultaneously?
   assert_valid_storage(S)
   assert_valid_config(c)
   assert_rref_deps(c)
@@ -508,17 +855,20 @@ def mkdrv_(c:Config,S=None)->DRef:
 
   filero(Path(join(o,'config.json')))
   drefpath=dref2path(dref,S)
-  dreftmp=Path(drefpath+'.tmp')
+  dreftmp=tmpname_(drefpath)
   replace(o,dreftmp) # [**]
 
   try:
     replace(dreftmp, drefpath)
   except OSError as err:
-    if err.errno == ENOTEMPTY:
+    if err.errno in [ENOTEMPTY,EEXIST]:
       # Existing folder means that it has a matched content [*]
       dirrm(dreftmp, ignore_not_found=False)
     else:
       raise
+  if hasstoredb(S):
+    storedb_add(storedbpath(S),drefs=[(dref,refname,dhash)],
+                drefedges=[(dref,dep) for dep in cfgdeps(c)])
   return dref
 
 def mkrealization(dref:DRef, l:Context, o:Path, S=None)->RRef:
@@ -554,18 +904,20 @@ def mkrealization(dref:DRef, l:Context, o:Path, S=None)->RRef:
   with open(reserved(o,'context.json'), 'w') as f:
     f.write(context_serialize(l))
 
-  rhash=dirhash(o)
+  fscfg=fsconfig(S)
+  rhash=dirhash(o,version=fscfg['dirhash_version'],
+                nworkers=fscfg['dirhash_workers'])
   rref=mkrref(trimhash(rhash),dhash,nm)
   rrefpath=rref2path(rref,S)
-  rreftmp=Path(rrefpath+'.tmp')
+  rreftmp=tmpname_(rrefpath)
 
   replace(o,rreftmp)
-  dirchmod(rreftmp,'ro')
+  dirchmod(rreftmp,'rotop' if fscfg['readonly']=='top' else 'ro')
 
   try:
     replace(rreftmp,rrefpath)
   except OSError as err:
-    if err.errno == ENOTEMPTY:
+    if err.errno in [ENOTEMPTY,EEXIST]:
       # Folder name contain the hash of the content, so getting here
       # probably[*] means that we already have this object in storage so we
       # just remove temp folder.
@@ -577,8 +929,112 @@ def mkrealization(dref:DRef, l:Context, o:Path, S=None)->RRef:
       dirchmod(rreftmp,'rw')
       replace(rreftmp,o)
       raise
+  else:
+    # Deduplicate only the committed realizations. Blobs are shared, so they
+    # must not be touched by the roll-back and the collision handling above.
+    if fscfg['dedup'] is not None:
+      blobdedup(rrefpath,fscfg['dedup'],fscfg['dedup_min_size'],S)
+  if hasstoredb(S):
+    storedb_add(storedbpath(S),
+                rrefs=[(rref,dref,context_serialize(l),
+                        tryread(Path(join(rrefpath,'__buildstart__.txt'))),
+                        dirsize(rrefpath))],
+                rrefedges=[(rref,dep) for dep in rrefdeps1([rref],S)])
   return rref
 
+#  ____  _       _
+# | __ )| | ___ | |__  ___
+# |  _ \| |/ _ \| '_ \/ __|
+# | |_) | | (_) | |_) \__ \
+# |____/|_|\___/|_.__/|___/
+
+def fsblobs(S=None)->Path:
+  """ Return the location of the content-addressed blob folder of the storage.
+  Blobs are the hardlinks to the deduplicated realization files, see
+  [blobdedup](#pylightnix.core.blobdedup). """
+  return Path(join(fsstorage(S),'_blobs'))
+
+def blobdedup(root:Path, mode:str='hardlink', min_size:int=0, S=None)->int:
+  """ Deduplicate regular files of the `root` folder which are at least
+  `min_size` bytes long against the blob folder of the storage `S`. A file
+  which content and permissions match an existing blob is replaced by a
+  hardlink to the blob (`mode='hardlink'`) or by its copy-on-write clone
+  (`mode='reflink'`). Other files are registered as new blobs. Files become
+  read-only. Return the number of bytes saved.
+
+  Realizations are deduplicated by
+  [mkrealization](#pylightnix.core.mkrealization) if the `dedup` setting of
+  the storage is set, see [fsconfig](#pylightnix.core.fsconfig). Existing
+  realizations may be deduplicated by
+  [store_dedup](#pylightnix.core.store_dedup). """
+  assert mode in ['hardlink','reflink'], f"Invalid dedup mode '{mode}'"
+  blobs=fsblobs(S)
+  makedirs(blobs, exist_ok=True)
+  saved=0
+  for dirpath, dirnames, filenames in walk(root):
+    dirmode=stat(dirpath).st_mode
+    try:
+      for f in filenames:
+        path=join(dirpath,f)
+        st=lstat(path)
+        if islink(path) or st.st_size<min_size:
+          continue
+        fmode=S_IMODE(st.st_mode) & 0o555
+        blob=join(blobs,f"{filedigest(path)}-{fmode:o}")
+        try:
+          bst=stat(blob)
+          if (bst.st_ino,bst.st_dev)==(st.st_ino,st.st_dev):
+            continue
+          if not dirmode & S_IWRITE:
+            chmod(dirpath, dirmode|S_IWRITE)
+          tmp=path+'.dedup'
+          if mode=='hardlink':
+            link(blob,tmp)
+          else:
+            reflink(blob,tmp)
+            chmod(tmp,fmode)
+          replace(tmp,path)
+          saved+=st.st_size
+        except FileNotFoundError:
+          chmod(path,fmode)
+          try:
+            link(path,blob)
+          except FileExistsError:
+            pass
+        except OSError as err:
+          warning(f"Failed to deduplicate '{path}': {err}")
+    finally:
+      if not dirmode & S_IWRITE:
+        chmod(dirpath, dirmode)
+  return saved
+
+def blobs_prune(S=None)->int:
+  """ Remove blobs which are not used by any realization. Return the number of
+  bytes freed. """
+  blobs=fsblobs(S)
+  freed=0
+  if not isdir(blobs):
+    return freed
+  for e in scandir(blobs):
+    st=e.stat(follow_symlinks=False)
+    if st.st_nlink==1:
+      try:
+        remove(e.path)
+        freed+=st.st_size
+      except FileNotFoundError:
+        pass
+  return freed
+
+def store_dedup(mode:str='hardlink', min_size:int=0, S=None)->int:
+  """ Deduplicate the files of existing realizations of the storage `S`, see
+  [blobdedup](#pylightnix.core.blobdedup). Unused blobs are removed. Return the
+  number of bytes saved. """
+  saved=0
+  for rref in allrrefs(S):
+    saved+=blobdedup(rref2path(rref,S),mode,min_size,S)
+  blobs_prune(S)
+  return saved
+
 #   ____            _            _
 #  / ___|___  _ __ | |_ _____  _| |_
 # | |   / _ \| '_ \| __/ _ \ \/ / __|
@@ -586,6 +1042,109 @@ def mkrealization(dref:DRef, l:Context, o:Path, S=None)->RRef:
 #  \____\___/|_| |_|\__\___/_/\_\\__|
 
 
+def fslocks(S=None)->Path:
+  """ Return the location of the derivation lock files of the storage, see
+  [dreflock](#pylightnix.core.dreflock). """
+  return Path(join(fsstorage(S),'_locks'))
+
+def dreflockpath(dref:DRef, S=None)->Path:
+  dhash,nm=undref(dref)
+  return Path(join(fslocks(S),f"{dhash}-{nm}.lock"))
+
+def dreflock_holder_(fd:int)->Tuple[str,int]:
+  try:
+    host,pid=os_read(fd,1024).decode('utf-8').split()
+    return host,int(pid)
+  except ValueError:
+    return '',0
+
+def dreflock_stale_(fd:int)->bool:
+  """ Check whether a busy lock is held by a dead process of this host. This
+  happens when a lock file descriptor is inherited by a forked process which
+  outlives its parent. """
+  host,pid=dreflock_holder_(fd)
+  if host!=gethostname() or pid<=0:
+    return False
+  try:
+    kill(pid,0)
+    return False
+  except ProcessLookupError:
+    return True
+  except PermissionError:
+    return False
+
+def dreflock_acquire(dref:DRef, S=None,
+                     timeout:Optional[float]=None)->Optional[int]:
+  """ Take the lock of the derivation `dref`, waiting for at most `timeout`
+  seconds or forever if `timeout` is `None`. Return the file descriptor of the
+  lock or `None` on timeout. See [dreflock](#pylightnix.core.dreflock). """
+  makedirs(fslocks(S), exist_ok=True)
+  path=dreflockpath(dref,S)
+  deadline=None if timeout is None else time()+timeout
+  nstale=0
+  while True:
+    fd=os_open(path,O_RDWR|O_CREAT,0o644)
+    try:
+      flock(fd,LOCK_EX|LOCK_NB)
+      try:
+        if fstat(fd).st_ino==stat(path).st_ino:
+          ftruncate(fd,0)
+          pwrite(fd,f"{gethostname()} {getpid()}".encode('utf-8'),0)
+          return fd
+      except FileNotFoundError:
+        pass
+      flock(fd,LOCK_UN) # The stale file was removed, try the new one
+      os_close(fd)
+      continue
+    except BlockingIOError:
+      pass
+    # Require two observations in a row, because the new holder may have not
+    # written its pid yet.
+    nstale=nstale+1 if dreflock_stale_(fd) else 0
+    os_close(fd)
+    if nstale>=2:
+      warning(f"Breaking the stale lock of {dref}")
+      try:
+        remove(path)
+      except FileNotFoundError:
+        pass
+      nstale=0
+      continue
+    if deadline is not None and time()>=deadline and nstale==0:
+      return None
+    sleep(PYLIGHTNIX_LOCK_POLL)
+
+def dreflock_release(fd:int)->None:
+  """ Release the lock taken by
+  [dreflock_acquire](#pylightnix.core.dreflock_acquire). """
+  flock(fd,LOCK_UN)
+  os_close(fd)
+
+@contextmanager
+def dreflock(dref:DRef, S=None, timeout:Optional[float]=None)->Iterator[None]:
+  """ Hold the exclusive advisory lock of the derivation `dref` for the inner
+  scoped code. [realize](#pylightnix.core.realize) and its analogs take the
+  lock before calling the realizer, so concurrent processes sharing the storage
+  don't realize the same derivation twice. Late arrivals wait for the lock and
+  re-run their matchers, typically picking the winner's realizations.
+
+  Locks are `flock` locks on the files of the `_locks` folder of the storage,
+  so the OS releases them when the holding process terminates. A lock held by a
+  dead process of the same host, e.g. via the descriptor inherited by an
+  orphaned subprocess, is considered stale and is broken. Waiting for more than
+  `timeout` seconds raises an error. """
+  fd=dreflock_acquire(dref,S,timeout)
+  if fd is None:
+    with open(dreflockpath(dref,S)) as f:
+      holder=f.read()
+    assert False, (
+      f"Timeout while waiting for the lock of {dref}, held by '{holder}'")
+  try:
+    yield
+  finally:
+    dreflock_release(fd)
+
+
 def mkcontext()->Context:
   return {}
 
@@ -655,10 +1214,41 @@ def output_matcher(r:MatcherO)->Matcher:
     return res.val if res is not None else None
   return _m
 
+def async_realizer(f:RealizerAsync)->Realizer:
+  """ Convert an `async def` realizer into a regular
+  [Realizer](#pylightnix.types.Realizer). [realize_async](#pylightnix.core.realize_async)
+  awaits `f` in its event loop, other realization functions run it in a new
+  event loop. """
+  def _r(S:Optional[StorageSettings], dref:DRef, ctx:Context,
+         ra:RealizeArg)->List[Path]:
+    return asyncio_run(f(S,dref,ctx,ra)) # type:ignore
+  _r.pylightnix_async=f # type:ignore
+  return _r
+
+def async_matcher(f:MatcherAsync)->Matcher:
+  """ Convert an `async def` matcher into a regular
+  [Matcher](#pylightnix.types.Matcher), see
+  [async_realizer](#pylightnix.core.async_realizer). """
+  def _m(S:Optional[StorageSettings], rrefs:List[RRef])->Optional[List[RRef]]:
+    return asyncio_run(f(S,rrefs)) # type:ignore
+  _m.pylightnix_async=f # type:ignore
+  return _m
+
+def asyncfn_(f:Callable)->Optional[Callable]:
+  """ Return the `async def` function behind the realizer or matcher `f`, if
+  any """
+  fa=getattr(f,'pylightnix_async',None)
+  return fa if fa is not None else (f if iscoroutinefunction(f) else None)
+
+def syncfn_(f:Callable)->Callable:
+  """ Return the regular version of the realizer or matcher `f` """
+  return (lambda *args: asyncio_run(f(*args))) if iscoroutinefunction(f) else f
+
 def mkdrv(config:Config,
           matcher:Matcher,
           realizer:Realizer,
-          r:Optional[Registry]=None)->DRef:
+          r:Optional[Registry]=None,
+          resources:Optional[Resources]=None)->DRef:
   """ Construct a [Derivation](#pylightnix.types.Derivation) object out of
   [Config](#pylightnix.types.Config), [Matcher](#pylightnix.types.Matcher) and
   [Realizer](#pylightnix.types.Realizer). Register the derivation in the
@@ -667,6 +1257,9 @@ def mkdrv(config:Config,
 
   Arguments:
   - `r:Registry`: A Registry to update with a new derivation
+  - `resources:Optional[Resources]=None`: [Resources](#pylightnix.types.Resources)
+    required by the realizer, e.g. `{'cpu':4, 'mem':60*2**30}`. Resources
+    don't affect the DRef. See [realizeParallel](#pylightnix.core.realizeParallel).
 
   Example:
   ```python
@@ -682,11 +1275,14 @@ def mkdrv(config:Config,
   # FIXME: check that all config's dependencies are known to the Registry
   r=tlregistry(r)
   assert r is not None, "Default registry is not set"
+  resources_=assert_valid_resources(dict(resources or {}))
   dref=mkdrv_(config,S=r.S)
-  if dref in r.builders:
+  with r.lock:
+    overwrite=dref in r.builders
+    r.builders[dref]=Derivation(dref, matcher, realizer, resources_)
+  if overwrite:
     warning(f"Overwriting the derivation of '{dref}'. This could be a "
             f"result of calling the same `mkdrv` twice with the same Registry.")
-  r.builders[dref]=Derivation(dref, matcher, realizer)
   return dref
 
 @contextmanager
@@ -714,11 +1310,21 @@ def current_storage(S:Optional[StorageSettings])->Iterator[Optional[StorageSetti
     setstorage(old)
 
 
+def closuredeps_(closure:Closure)->Dict[DRef,Set[DRef]]:
+  """ Return the dependency index of the `closure`, computing it if the closure
+  doesn't have one. """
+  if closure.deps is not None:
+    return closure.deps
+  return drefdepsmap(closure.targets,closure.S)
+
 def mkclosure(result:Any,r:Registry)->Closure:
   targets,_=scanref_dict({'result':result})
   assert len(targets)>0, f"No DRefs to instantiate in {result}"
-  assert_have_realizers(r,targets)
-  return Closure(result,targets,list(r.builders.values()),S=r.S)
+  deps=drefdepsmap(targets,r.S)
+  assert_have_realizers(r,targets,deps)
+  with r.lock:
+    derivations=list(r.builders.values())
+  return Closure(result,targets,derivations,S=r.S,deps=deps)
 
 
 _A=TypeVar('_A')
@@ -756,10 +1362,11 @@ def instantiate(stage:Union[_A,Callable[...,Any]], # <-- [*]
       assert S==r.S, (
         f"S should match the Registry's if specified. 'S={S}' while "
         f"registry has '{r.S}'")
-  assert not r.in_instantiate, (
+  assert get_ident() not in r.in_instantiate, (
     "Recursion detected. `instantiate` should not be called recursively "
     "by stage functions with the same `Registry` as argument")
-  r.in_instantiate=True
+  with r.lock:
+    r.in_instantiate.add(get_ident())
   try:
     if callable(stage):
       result=stage(*args,r=r,**kwargs)
@@ -768,7 +1375,8 @@ def instantiate(stage:Union[_A,Callable[...,Any]], # <-- [*]
       # assert isdref(stage)
       result=stage
   finally:
-    r.in_instantiate=False
+    with r.lock:
+      r.in_instantiate.discard(get_ident())
   return result,mkclosure(result,r)
 
 
@@ -787,8 +1395,6 @@ def realize1(closure:Union[Closure,Tuple[StageResult,Closure]],
   """ [Realize](#pylightnix.core.realize) a closure, assuming that it returns a
   single realization. """
 
-  # FIXME: Stage's context is calculated inefficiently. Maybe one should track
-  # dep.tree to avoid calling `drefdeps` within the cycle.
   # FIXME: Update derivation's matcher after forced rebuilds. Matchers should
   # remember and reproduce user's preferences.
   rrefs=realizeMany(closure, force_rebuild,
@@ -823,6 +1429,18 @@ def unpack_closure_arg_(arg:Union[Closure,Tuple[StageResult,Closure]]
     result_=closure_.result
   return (result_,closure_)
 
+def unpack_force_rebuild_arg_(closure:Closure,
+                              force_rebuild:Union[List[DRef],bool]
+                              )->List[DRef]:
+  force_interrupt:List[DRef]
+  if isinstance(force_rebuild,bool):
+    force_interrupt=closure.targets if force_rebuild else []
+  elif isinstance(force_rebuild,list):
+    force_interrupt=force_rebuild
+  else:
+    assert False, "Ivalid type of `force_rebuild` argument"
+  return force_interrupt
+
 
 def realize(closure:Union[Closure,Tuple[StageResult,Closure]],
             force_rebuild:Union[List[DRef],bool]=[],
@@ -840,10 +1458,15 @@ def realize(closure:Union[Closure,Tuple[StageResult,Closure]],
   references, and the
   resulting [Context](#pylightnix.types.Context).
 
+  Before calling a realizer, the realizations are looked up in the binary
+  caches listed in the `substituters` [setting](#pylightnix.core.fsconfig) of
+  the storage.
+
   `realize` is the most generic version of the realization algorithm. The
   simplified or specialized versions are [realizeU](#pylightnix.deco.realizeU),
   [realize1](#pylightnix.core.realize1),
   [realizeMany](#pylightnix.core.realizeMany),
+  [realizeParallel](#pylightnix.core.realizeParallel),
   [repl_realize](#pylightnix.repl.repl_realize).
 
   Example:
@@ -858,13 +1481,7 @@ def realize(closure:Union[Closure,Tuple[StageResult,Closure]],
   """
   # FIXME: define a Closure as a datatype and simplify the below line
   result_,closure_=unpack_closure_arg_(closure)
-  force_interrupt:List[DRef]
-  if isinstance(force_rebuild,bool):
-    force_interrupt=closure_.targets if force_rebuild else []
-  elif isinstance(force_rebuild,list):
-    force_interrupt=force_rebuild
-  else:
-    assert False, "Ivalid type of `force_rebuild` argument"
+  force_interrupt=unpack_force_rebuild_arg_(closure_,force_rebuild)
   try:
     gen=realizeSeq(closure_, force_interrupt, assert_realized, realize_args,
                    dry_run)
@@ -873,6 +1490,8 @@ def realize(closure:Union[Closure,Tuple[StageResult,Closure]],
       gen.send((None,False)) # Ask for the default action
   except StopIteration as e:
     ctx=e.value
+  rreftouch(chain.from_iterable([v for v in ctx.values() if v is not None]),
+            closure_.S)
   return result_,closure_,ctx
 
 
@@ -892,14 +1511,13 @@ def realizeSeq(closure:Closure,
   S=closure.S
   assert_valid_closure(closure)
   force_interrupt_:Set[DRef]=set(force_interrupt)
+  deps=closuredeps_(closure)
   context_acc:Context={}
-  target_drefs=closure.targets
-  target_deps=drefdeps(target_drefs,S)
   for drv in closure.derivations:
     dref=drv.dref
     rrefs:Optional[List[RRef]]
-    if dref in target_deps or dref in target_drefs:
-      dref_deps=drefdeps([dref],S)
+    if dref in deps:
+      dref_deps=deps[dref]
       dref_context={k:v for k,v in context_acc.items() if k in dref_deps} # I
       if dref in force_interrupt_:
         rrefs,abort=yield (S,dref,dref_context,drv,realize_args.get(dref,{}))
@@ -908,35 +1526,443 @@ def realizeSeq(closure:Closure,
       else:
         rrefs=drv.matcher(S, list(drefrrefsC(dref,dref_context,S)))
       if rrefs is None and not dry_run:
-        assert dref not in assert_realized, (
-          f"Stage '{dref}' was assumed to be already realized. "
-          f"Unfortunately, it is not the case. Config:\n"
-          f"{drefcfg_(dref)}")
-        rrefs_existed=drefrrefsC(dref,dref_context,S)
-        rpaths:List[Path]=drv.realizer(S,dref,dref_context,
-                                       realize_args.get(dref,{}))
-        rrefs_built:List[RRef]=[mkrealization(dref,dref_context,rp,S)
-                                for rp in rpaths]
-        if len(rpaths)!=len(set(rrefs_built)):
-          warning(f"Realizer of {dref} produced duplicated realizations")
-        rrefs_matched=drv.matcher(S,list(drefrrefsC(dref,dref_context,S)))
-        assert rrefs_matched is not None, (
-          f"The matcher of '{dref}' is not satisfied with its realizatons. "
-          f"The following newly obtained realizations were ignored:\n"
-          f"  {rrefs_built}\n"
-          f"The following realizations currently exist:\n"
-          f"  {list(rrefs_existed)}")
-        if (set(rrefs_built) & set(rrefs_matched)) == set() and \
-           (set(rrefs_built) | set(rrefs_matched)) != set():
-          warning(f"None of the newly obtained {dref} realizations "
-                  f"were matched by the matcher. To capture those "
-                  f"realizations explicitly, try `matcher([exact(..)])`")
-        rrefs=rrefs_matched
+        with dreflock(dref,S,fsconfig(S)['lock_timeout']):
+          if dref not in force_interrupt_:
+            # Another process may have realized the derivation meanwhile
+            rrefs=drv.matcher(S, list(drefrrefsC(dref,dref_context,S)))
+            if rrefs is None:
+              rrefs=realize_substitute_(drv,dref_context,S)
+          if rrefs is None:
+            assert dref not in assert_realized, (
+              f"Stage '{dref}' was assumed to be already realized. "
+              f"Unfortunately, it is not the case. Config:\n"
+              f"{drefcfg_(dref,S)}")
+            rpaths:List[Path]=drv.realizer(S,dref,dref_context,
+                                           realize_args.get(dref,{}))
+            rrefs=realize_commit_(drv,dref_context,rpaths,S)
       context_acc=context_add(context_acc,dref,rrefs)
   assert dry_run or all((context_acc[t] is not None) for t in closure.targets)
   return context_acc
 
 
+def realize_commit_(drv:Derivation, dref_context:Context, rpaths:List[Path],
+                    S=None)->List[RRef]:
+  """ Move the output paths of a realizer into the storage and run the
+  matcher over the updated set of realizations. Not intended to be called by
+  user. """
+  dref=drv.dref
+  rrefs_built:List[RRef]=[mkrealization(dref,dref_context,rp,S)
+                          for rp in rpaths]
+  if len(rpaths)!=len(set(rrefs_built)):
+    warning(f"Realizer of {dref} produced duplicated realizations")
+  rrefs_matched=drv.matcher(S,list(drefrrefsC(dref,dref_context,S)))
+  assert rrefs_matched is not None, (
+    f"The matcher of '{dref}' is not satisfied with its realizatons. "
+    f"The following newly obtained realizations were ignored:\n"
+    f"  {rrefs_built}\n"
+    f"The following realizations currently exist:\n"
+    f"  {list(drefrrefsC(dref,dref_context,S))}")
+  if (set(rrefs_built) & set(rrefs_matched)) == set() and \
+     (set(rrefs_built) | set(rrefs_matched)) != set():
+    warning(f"None of the newly obtained {dref} realizations "
+            f"were matched by the matcher. To capture those "
+            f"realizations explicitly, try `matcher([exact(..)])`")
+  return rrefs_matched
+
+
+#: Function downloading the realizations of a derivation from a binary cache,
+#: see [substitute](#pylightnix.arch.substitute). The archive code depends on
+#: the core, so `pylightnix.arch` sets it on import by calling
+#: [substituter_set_](#pylightnix.core.substituter_set_).
+_SUBSTITUTE:Optional[Callable[[str,DRef,Context,Optional[StorageSettings]],
+                              List[RRef]]]=None
+
+def substituter_set_(f:Callable[[str,DRef,Context,Optional[StorageSettings]],
+                                List[RRef]])->None:
+  """ Set the function used by
+  [realize_substitute_](#pylightnix.core.realize_substitute_). Not intended to
+  be called by user. """
+  global _SUBSTITUTE
+  _SUBSTITUTE=f
+
+def realize_substitute_(drv:Derivation, dref_context:Context,
+                        S=None)->Optional[List[RRef]]:
+  """ Query the substituters of the storage for realizations of `drv` and run
+  the matcher over each updated set of realizations. Return the first
+  non-`None` match or `None` if caches don't help. Unavailable or broken caches
+  are reported and skipped. Not intended to be called by user. """
+  substituters=fsconfig(S)['substituters']
+  if len(substituters)==0:
+    return None
+  substitute=_SUBSTITUTE
+  assert substitute is not None, (
+    "Substituters require `pylightnix.arch` which failed to import")
+  for url in substituters:
+    try:
+      if len(substitute(url,drv.dref,dref_context,S))==0:
+        continue
+    except Exception as e:
+      warning(f"Substituter '{url}' failed to provide {drv.dref}: {e}")
+      continue
+    rrefs=drv.matcher(S,list(drefrrefsC(drv.dref,dref_context,S)))
+    if rrefs is not None:
+      return rrefs
+  return None
+
+
+#: Realizers of the closures being realized by
+#: [realizeParallel](#pylightnix.core.realizeParallel) in the `process` mode.
+#: Worker processes inherit this table when they are forked.
+_PARALLEL_REALIZERS:Dict[int,Dict[DRef,Realizer]]={}
+_PARALLEL_TOKENS=count()
+
+def _realizeParallel_thread(S:Optional[StorageSettings], drv:Derivation,
+                            dref_context:Context,
+                            rarg:RealizeArg)->List[Path]:
+  with current_storage(S):
+    return drv.realizer(S,drv.dref,dref_context,rarg)
+
+def _realizeParallel_process(token:int, S:Optional[StorageSettings],
+                             dref:DRef, dref_context:Context,
+                             rarg:RealizeArg,
+                             resources:Optional[Resources]=None)->List[Path]:
+  realizer=_PARALLEL_REALIZERS[token][dref]
+  limit=getrlimit(RLIMIT_AS)
+  if resources is not None and 'mem' in resources:
+    # The address space of the worker already includes the interpreter and
+    # the libraries. Soft limit, because the worker is re-used by other
+    # realizers.
+    mem=vmsize()+int(resources['mem'])
+    setrlimit(RLIMIT_AS,(mem if limit[1]==RLIM_INFINITY else
+                         min(mem,limit[1]),limit[1]))
+  try:
+    with current_storage(S):
+      return realizer(S,dref,dref_context,rarg)
+  finally:
+    setrlimit(RLIMIT_AS,limit)
+
+
+def realizeParallel(closure:Union[Closure,Tuple[StageResult,Closure]],
+                    force_rebuild:Union[List[DRef],bool]=[],
+                    assert_realized:List[DRef]=[],
+                    realize_args:Dict[DRef,RealizeArg]={},
+                    dry_run:bool=False,
+                    max_workers:Optional[int]=None,
+                    executor:str='thread',
+                    budget:Optional[Resources]=None
+                    )->Tuple[StageResult,Closure,Context]:
+  """ A version of [realize](#pylightnix.core.realize) which runs the
+  realizers of independent derivations concurrently. Returns the same values
+  as `realize` does.
+
+  The scheduler runs in the calling thread. A derivation is scheduled as soon
+  as all of its dependencies appear in the context. Matchers and
+  [mkrealization](#pylightnix.core.mkrealization) are called by the scheduler,
+  realizers are called by the executor.
+
+  Arguments:
+  - `max_workers:Optional[int]=None`: The maximum number of realizers to run
+    simultaneously. Defaults to the executor's default.
+  - `executor:str='thread'`: Either `'thread'` or `'process'`. In the `process`
+    mode, realizers are called in the forked worker processes. Their output
+    paths are passed back to the parent process which puts them into the
+    storage.
+  - `budget:Optional[Resources]=None`: The total amounts of
+    [Resources](#pylightnix.types.Resources) available to the realizers. A
+    derivation is scheduled only if its declared resources, see
+    [mkdrv](#pylightnix.core.mkdrv), fit into the remaining budget.
+    Derivations which don't fit wait, while the smaller ones may pass ahead.
+    Resources missing from the budget are not limited. In the `process` mode,
+    the `mem` declaration is also enforced by the `RLIMIT_AS` limit of the
+    worker process: the realizer may grow the address space of the worker by
+    `mem` bytes.
+
+  Example:
+  ```python
+  _,_,ctx=realizeParallel(instantiate(mystage), max_workers=4,
+                          budget={'cpu':16, 'mem':128*2**30, 'gpu':2})
+  ```
+  """
+  result_,closure_=unpack_closure_arg_(closure)
+  force_interrupt_:Set[DRef]=set(unpack_force_rebuild_arg_(closure_,
+                                                           force_rebuild))
+  S=tlstorage(closure_.S)
+  assert_valid_closure(closure_)
+  target_drefs=closure_.targets
+  deps=closuredeps_(closure_)
+  drvs:Dict[DRef,Derivation]=OrderedDict()
+  for drv in closure_.derivations:
+    if drv.dref in deps:
+      drvs[drv.dref]=drv
+  resources:Dict[DRef,Resources]={dref:drv.resources or {}
+                                  for dref,drv in drvs.items()}
+  budget_=assert_valid_resources(dict(budget or {}))
+  for drv in drvs.values():
+    for k,v in resources[drv.dref].items():
+      assert v<=budget_.get(k,v), (
+        f"Derivation {drv.dref} requires {v} of '{k}', which exceeds the "
+        f"budget of {budget_[k]}")
+  used:Resources={k:0 for k in budget_}
+  def _fits(res:Resources)->bool:
+    return all(used[k]+v<=budget_[k] for k,v in res.items() if k in budget_)
+  def _use(res:Resources, sign:int)->None:
+    for k,v in res.items():
+      if k in budget_:
+        used[k]+=sign*v
+
+  token=next(_PARALLEL_TOKENS)
+  pool:Union[ThreadPoolExecutor,ProcessPoolExecutor]
+  if executor=='thread':
+    pool=ThreadPoolExecutor(max_workers=max_workers)
+  elif executor=='process':
+    _PARALLEL_REALIZERS[token]={dref:drv.realizer for dref,drv in drvs.items()}
+    pool=ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=mp_get_context('fork'))
+  else:
+    assert False, f"Invalid executor '{executor}'"
+
+  context_acc:Context={}
+  started:Set[DRef]=set()
+  running:Dict[Future,Tuple[Derivation,Context]]={}
+  locks:Dict[DRef,int]={}
+  lock_timeout=fsconfig(S)['lock_timeout']
+  lock_waits:Dict[DRef,float]={}
+  try:
+    while len(context_acc)<len(drvs):
+      progress=True
+      while progress:
+        progress=False
+        for dref,drv in drvs.items():
+          if dref in started or not deps[dref]<=set(context_acc.keys()):
+            continue
+          dref_context={k:v for k,v in context_acc.items() if k in deps[dref]}
+          rrefs:Optional[List[RRef]]=None
+          if dref not in force_interrupt_:
+            rrefs=drv.matcher(S, list(drefrrefsC(dref,dref_context,S)))
+          if rrefs is None and not dry_run:
+            if not _fits(resources[dref]):
+              continue # Wait for the running realizers to free resources
+            fd=dreflock_acquire(dref,S,timeout=0)
+            if fd is None:
+              # Locked by a concurrent process, re-try after a while
+              waiting=time()-lock_waits.setdefault(dref,time())
+              assert lock_timeout is None or waiting<lock_timeout, (
+                f"Timeout while waiting for the lock of {dref}")
+              continue
+            locks[dref]=fd
+            if dref not in force_interrupt_:
+              rrefs=drv.matcher(S, list(drefrrefsC(dref,dref_context,S)))
+              if rrefs is None:
+                rrefs=realize_substitute_(drv,dref_context,S)
+            if rrefs is not None:
+              dreflock_release(locks.pop(dref))
+          started.add(dref)
+          if rrefs is not None or dry_run:
+            context_acc=context_add(context_acc,dref,rrefs)
+            progress=True
+            continue
+          assert dref not in assert_realized, (
+            f"Stage '{dref}' was assumed to be already realized. "
+            f"Unfortunately, it is not the case. Config:\n"
+            f"{drefcfg_(dref,S)}")
+          rarg=realize_args.get(dref,{})
+          fut=pool.submit(_realizeParallel_process,
+                          token,S,dref,dref_context,rarg,resources[dref]) \
+              if executor=='process' else \
+              pool.submit(_realizeParallel_thread,S,drv,dref_context,rarg)
+          running[fut]=(drv,dref_context)
+          _use(resources[dref],1)
+      if len(context_acc)==len(drvs):
+        break
+      nwaiting=len([d for d in lock_waits if d not in started])
+      assert len(running)>0 or nwaiting>0, (
+        f"Failed to schedule the realization of {set(drvs)-started}")
+      if len(running)==0:
+        sleep(PYLIGHTNIX_LOCK_POLL)
+        continue
+      done,_=futures_wait(list(running.keys()), return_when=FIRST_COMPLETED,
+                          timeout=PYLIGHTNIX_LOCK_POLL if nwaiting>0 else None)
+      for fut in done:
+        drv,dref_context=running.pop(fut)
+        _use(resources[drv.dref],-1)
+        try:
+          rpaths=fut.result()
+          context_acc=context_add(context_acc,drv.dref,
+                                  realize_commit_(drv,dref_context,rpaths,S))
+        finally:
+          dreflock_release(locks.pop(drv.dref))
+  finally:
+    for fut in running:
+      fut.cancel()
+    pool.shutdown(wait=True)
+    _PARALLEL_REALIZERS.pop(token,None)
+    for fd in locks.values():
+      dreflock_release(fd)
+  assert dry_run or all((context_acc[t] is not None) for t in target_drefs)
+  rreftouch(chain.from_iterable([v for v in context_acc.values()
+                                 if v is not None]), S)
+  return result_,closure_,context_acc
+
+
+def _realizeAsync_thread(S:Optional[StorageSettings], f:Callable,
+                         *args:Any)->Any:
+  with current_storage(S):
+    return f(*args)
+
+async def realize_async(closure:Union[Closure,Tuple[StageResult,Closure]],
+                        force_rebuild:Union[List[DRef],bool]=[],
+                        assert_realized:List[DRef]=[],
+                        realize_args:Dict[DRef,RealizeArg]={},
+                        dry_run:bool=False,
+                        max_workers:Optional[int]=None
+                        )->Tuple[StageResult,Closure,Context]:
+  """ An `asyncio` version of [realize](#pylightnix.core.realize) which
+  doesn't block the event loop. Returns the same values as `realize` does.
+
+  Each derivation is realized by a separate task, so independent derivations
+  are realized concurrently. `async def` realizers and matchers, possibly
+  wrapped with [async_realizer](#pylightnix.core.async_realizer) and
+  [async_matcher](#pylightnix.core.async_matcher), are awaited in the event
+  loop. Regular realizers and matchers, as well as the storage and the lock
+  operations, run in a thread pool of at most `max_workers` threads.
+  `max_workers` also limits the number of concurrently running `async def`
+  realizers.
+
+  Realizers receive storage settings with a private temporary folder. If
+  `realize_async` is cancelled or fails, the folder is removed along with the
+  output paths created there. For regular realizers, the removal happens after
+  they return. Realizers creating their outputs elsewhere should clean them up
+  on their own.
+
+  Example:
+  ```python
+  async def main():
+    _,_,ctx=await realize_async(instantiate(mystage))
+  ```
+  """
+  result_,closure_=unpack_closure_arg_(closure)
+  force_interrupt_:Set[DRef]=set(unpack_force_rebuild_arg_(closure_,
+                                                           force_rebuild))
+  S=tlstorage(closure_.S)
+  assert_valid_closure(closure_)
+  deps=closuredeps_(closure_)
+  drvs:Dict[DRef,Derivation]=OrderedDict()
+  for drv in closure_.derivations:
+    if drv.dref in deps:
+      drvs[drv.dref]=drv
+  pool=ThreadPoolExecutor(max_workers=max_workers)
+  slots=Semaphore(max_workers) if max_workers is not None else None
+  tasks:Dict[DRef,Any]={}
+
+  async def _thread(f:Callable, *args:Any)->Any:
+    return await wrap_future(pool.submit(_realizeAsync_thread,S,f,*args))
+
+  lock_timeout=(await _thread(fsconfig,S))['lock_timeout']
+
+  async def _match(drv:Derivation, dref_context:Context)->Optional[List[RRef]]:
+    rrefs=await _thread(lambda: list(drefrrefsC(drv.dref,dref_context,S)))
+    fa=asyncfn_(drv.matcher)
+    return await fa(S,rrefs) if fa is not None else \
+           await _thread(drv.matcher,S,rrefs)
+
+  async def _realize(drv:Derivation)->Optional[List[RRef]]:
+    dref=drv.dref
+    dref_context:Context={}
+    for dep in deps[dref]:
+      dref_context=context_add(dref_context,dep,await tasks[dep])
+    rrefs:Optional[List[RRef]]=None
+    if dref not in force_interrupt_:
+      rrefs=await _match(drv,dref_context)
+    if rrefs is not None or dry_run:
+      return rrefs
+
+    tmp:Optional[Path]=None
+    fd:Optional[int]=None
+    def _mktmp()->Path:
+      nonlocal tmp
+      tmp=Path(mkdtemp(prefix='async_',dir=fstmpdir(S)))
+      return tmp
+    def _lock()->Optional[int]:
+      # May sleep while checking a stale lock
+      nonlocal fd
+      fd=dreflock_acquire(dref,S,timeout=0)
+      return fd
+    def _cleanup(*_)->None:
+      if tmp is not None:
+        dirrm(tmp)
+      if fd is not None:
+        dreflock_release(fd)
+    deferred=False
+    async def _step(f:Callable, *args:Any, S=S)->Any:
+      # Threads can't be interrupted, the cleanup waits for them
+      nonlocal deferred
+      fut=pool.submit(_realizeAsync_thread,S,f,*args)
+      try:
+        return await wrap_future(fut)
+      except CancelledError:
+        deferred=True
+        fut.add_done_callback(_cleanup)
+        raise
+    try:
+      tmp_=await _step(_mktmp)
+      waiting=0.0
+      while await _step(_lock) is None:
+        assert lock_timeout is None or waiting<lock_timeout, (
+          f"Timeout while waiting for the lock of {dref}")
+        await asyncio_sleep(PYLIGHTNIX_LOCK_POLL)
+        waiting+=PYLIGHTNIX_LOCK_POLL
+      if dref not in force_interrupt_:
+        rrefs=await _match(drv,dref_context)
+        if rrefs is None:
+          rrefs=await _step(realize_substitute_,drv,dref_context,S)
+      if rrefs is None:
+        if dref in assert_realized:
+          assert False, (
+            f"Stage '{dref}' was assumed to be already realized. "
+            f"Unfortunately, it is not the case. Config:\n"
+            f"{await _thread(drefcfg_,dref,S)}")
+        S_=StorageSettings(fsroot(S),fsstorage(S),tmp_)
+        rarg=realize_args.get(dref,{})
+        fa=asyncfn_(drv.realizer)
+        if fa is not None:
+          if slots is not None:
+            async with slots:
+              rpaths=await fa(S_,dref,dref_context,rarg)
+          else:
+            rpaths=await fa(S_,dref,dref_context,rarg)
+        else:
+          rpaths=await _step(drv.realizer,S_,dref,dref_context,rarg,S=S_)
+        rrefs=await _step(realize_commit_,
+                          drv._replace(matcher=syncfn_(drv.matcher)),
+                          dref_context,rpaths,S)
+      return rrefs
+    finally:
+      if not deferred:
+        # Shielded, so that the cleanup is not cancelled before it starts
+        await shield(wrap_future(pool.submit(_cleanup)))
+
+  for drv in drvs.values():
+    tasks[drv.dref]=ensure_future(_realize(drv))
+  try:
+    try:
+      await gather(*tasks.values())
+    except BaseException:
+      for t in tasks.values():
+        t.cancel()
+      await gather(*tasks.values(), return_exceptions=True)
+      raise
+    context_acc:Context={}
+    for dref,t in tasks.items():
+      context_acc=context_add(context_acc,dref,t.result())
+    assert dry_run or all((context_acc[t] is not None)
+                          for t in closure_.targets)
+    await _thread(rreftouch, list(chain.from_iterable(
+      [v for v in context_acc.values() if v is not None])), S)
+  finally:
+    pool.shutdown(wait=False)
+  return result_,closure_,context_acc
+
+
 def evaluate(stage, *args, **kwargs)->RRef:
   return realize1(instantiate(stage,*args,**kwargs))
 
@@ -1078,6 +2104,13 @@ def assert_valid_context(c:Context)->None:
     for rref in rrefs:
       assert_valid_rref(rref)
 
+def assert_valid_resources(res:Resources)->Resources:
+  for k,v in res.items():
+    assert isinstance(k,str), f"Resource names should be strings, not {k}"
+    assert isinstance(v,(int,float)) and v>=0, (
+      f"Amount of resource '{k}' should be a non-negative number, not {v}")
+  return res
+
 def assert_valid_closure(closure:Closure)->None:
   assert len(closure.derivations)>0, \
     "Closure can not be empty"
@@ -1094,9 +2127,12 @@ def assert_rref_deps(c:Config)->None:
     f"realizations, because Pylightnix doesn't keep "
     f"records of how did we build it.\n")
 
-def assert_have_realizers(r:Registry, drefs:List[DRef])->None:
-  have_drefs=set(r.builders.keys())
-  need_drefs=drefdeps(drefs,r.S) | set(drefs)
+def assert_have_realizers(r:Registry, drefs:List[DRef],
+                          deps:Optional[Dict[DRef,Set[DRef]]]=None)->None:
+  with r.lock:
+    have_drefs=set(r.builders.keys())
+  need_drefs=set(deps.keys() if deps is not None else
+                 drefdepsmap(drefs,r.S).keys())
   missing=list(need_drefs-have_drefs)
   assert len(missing)==0, (
     f"The following derivations don't have realizers associated with them:\n"
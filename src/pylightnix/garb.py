@@ -4,14 +4,15 @@ from pylightnix.imports import (sha256, deepcopy, isdir, islink, makedirs, join,
                                 replace, environ, split, re_match, ENOTEMPTY,
                                 get_ident, contextmanager, OrderedDict, lstat,
                                 maxsize, readlink, chain, getLogger, walk,
-                                abspath)
+                                abspath, ThreadPoolExecutor, time, scandir)
 
 from pylightnix.utils import (dirhash, assert_serializable, assert_valid_dict,
                               dicthash, scanref_dict, scanref_list, forcelink,
                               timestring, parsetime, datahash, readjson,
                               tryread, encode, dirchmod, dirrm, filero, isrref,
                               isdref, traverse_dict, tryread_def,
-                              tryreadjson_def, isrefpath, dirsize)
+                              tryreadjson_def, isrefpath, dirinodes,
+                              dirlinks)
 
 from pylightnix.types import (Dict, List, Any, Tuple, Union, Optional, Iterable,
                               IO, Path, SPath, Hash, DRef, RRef, RefPath,
@@ -22,9 +23,14 @@ from pylightnix.types import (Dict, List, Any, Tuple, Union, Optional, Iterable,
                               InstantiateArg)
 
 from pylightnix.core import (instantiate, realize1, path2rref, path2dref,
-                             store_gc, rref2path)
+                             store_gc, rref2path, rref2dref, rrefatime,
+                             rrefdependentsmap, dependents_, blobs_prune,
+                             allrrefs, hasstoredb, fsblobs)
 
-from pylightnix.bashlike import (rmref)
+from pylightnix.bashlike import (rmref, du)
+
+logger=getLogger(__name__)
+warning=logger.warning
 
 
 def diskspace_h(sz:int)->str:
@@ -39,14 +45,14 @@ def gc_exceptions(keep_paths:List[Path])->Tuple[List[DRef],List[RRef]]:
   keep_drefs:List[DRef]=[]
   keep_rrefs:List[RRef]=[]
 
-  def _check(f:str):
+  def _check(f:Path):
     nonlocal keep_drefs, keep_rrefs
-    if islink(a):
-      rref=path2rref(a)
+    if islink(f):
+      rref=path2rref(f)
       if rref is not None:
         keep_rrefs.append(rref)
       else:
-        dref=path2dref(a)
+        dref=path2dref(f)
         if dref is not None:
           keep_drefs.append(dref)
 
@@ -72,47 +78,155 @@ def gc_candidates(keep:Tuple[List[DRef],List[RRef]],S=None)->Tuple[Set[DRef],Set
   return store_gc(keep_drefs=keep[0], keep_rrefs=keep[1], S=S)
 
 
+def rrefsizes_(S=None)->Dict[RRef,int]:
+  """ Return the disk usages of the realizations of the storage, see
+  [du](#pylightnix.bashlike.du). """
+  return {rref:sz for _,(_,rr) in du(S=S).items() for rref,sz in rr.items()}
+
+
+def gc_evict(keep:Tuple[List[DRef],List[RRef]],
+             budget:Optional[int]=None,
+             max_age:Optional[float]=None,
+             S=None)->List[Tuple[RRef,int]]:
+  """ Query the eviction policy of the garbage collector. Select the
+  realizations to be removed in order to fit the realizations of the storage
+  into `budget` bytes and to drop those which were not accessed for more than
+  `max_age` seconds. Only the [gc_candidates](#pylightnix.garb.gc_candidates)
+  are considered. Least recently used candidates are selected first, larger
+  ones go first among the equally old. See
+  [rreftouch](#pylightnix.core.rreftouch) for the details of access tracking.
+
+  The size of the storage is the sum of the sizes of its realizations, as
+  reported by [du](#pylightnix.bashlike.du). The sizes are taken from the
+  [index](#pylightnix.storedb) if the storage has one. Otherwise they are
+  computed, if `budget` is set.
+
+  Realizations that depend on a selected realization are selected together
+  with it. Return the selected realizations and the disk space freed by their
+  removal, in the order of selection. A file is freed when all of its
+  hardlinks are removed. The links of the deduplication blobs are removed
+  afterwards by [blobs_prune](#pylightnix.core.blobs_prune), which
+  [gc](#pylightnix.garb.gc) calls. """
+  sizes:Dict[RRef,int]={}
+  if hasstoredb(S) or budget is not None:
+    sizes=rrefsizes_(S)
+  total=sum(sizes.values())
+  blobinodes:Set[Tuple[int,int]]=set()
+  if isdir(fsblobs(S)):
+    for e in scandir(fsblobs(S)):
+      st=e.stat(follow_symlinks=False)
+      blobinodes.add((st.st_dev,st.st_ino))
+  _,candidates=gc_candidates(keep,S=S)
+  atimes={rref:rrefatime(rref,S) for rref in candidates}
+  depmap=rrefdependentsmap(S)
+  now=time()
+  nlinks:Dict[Tuple[int,int],int]={}
+  acc:List[Tuple[RRef,int]]=[]
+  selected:Set[RRef]=set()
+  for rref in sorted(candidates, key=lambda r:(atimes[r],-sizes.get(r,0))):
+    if rref in selected:
+      continue
+    expired=max_age is not None and now-atimes[rref]>max_age
+    overflow=budget is not None and total>budget
+    if not (expired or overflow):
+      break
+    dependents=dependents_([rref], lambda rs: set().union(
+      *[depmap.get(r,set()) for r in rs]))
+    for r in [rref]+sorted(dependents & (candidates-selected)):
+      freed=0
+      for k,(sz,nlink,n) in dirlinks(rref2path(r,S)).items():
+        if k not in nlinks:
+          nlinks[k]=nlink-(1 if k in blobinodes else 0)
+        nlinks[k]-=n
+        if nlinks[k]==0:
+          freed+=sz
+      selected.add(r)
+      acc.append((r,freed))
+      total-=sizes.get(r,0)
+  return acc
+
+
 def gc(keep_dirs:List[Path],
        interactive:bool=True,
        verbose:bool=True,
-       S=None)->None:
+       dry_run:bool=False,
+       max_workers:Optional[int]=None,
+       budget:Optional[int]=None,
+       max_age:Optional[float]=None,
+       S=None)->int:
   """ Simple console garbage collector. `gc` removes any model which is not
   symlinked under `keep_dir` and is not in short list of pre-defined models.
 
   Pass `interactive=False` to delete the data without request for confirmation.
+  Pass `dry_run=True` to only report the objects to be removed.
+
+  If `budget` (in bytes) or `max_age` (in seconds) are set, only the
+  realizations selected by the [eviction policy](#pylightnix.garb.gc_evict)
+  are removed. The size of the storage is checked against the `budget` again
+  after the unused deduplication blobs are removed, a warning is reported if
+  it still doesn't fit, e.g. because of the kept realizations.
+
+  Sizing and removal of objects are performed on a pool of `max_workers`
+  threads. Realizations of removed derivations are removed together with their
+  derivations. Deduplication blobs which become unused are removed afterwards.
+
+  Return the number of bytes reclaimed, or to be reclaimed in the `dry_run`
+  mode.
 
   FIXME: move to bashlike?
   """
   import sys
-  assert (not interactive) or sys.__stdin__.isatty(), (
+  assert dry_run or (not interactive) or sys.__stdin__.isatty(), (
     "`gc` needs TTY to be called with `interactive=True`" )
   assert not (interactive and not verbose), (
     "gc: `interactive=True` implies `verbose=True`" )
 
-  drefs,rrefs=gc_candidates(gc_exceptions(keep_dirs),S=S)
-
-  if verbose:
-    total=0
-    if len(drefs)+len(rrefs)>0:
-      print("Objects to be removed:")
-    rrefs_pairs=sorted([(rref, dirsize(rref2path(rref,S))) for rref in rrefs],
-             key=lambda x:x[1])
-    for dref in drefs:
-      print(f"\t{dref}")
-    for rref,sz in rrefs_pairs:
-      print(f"{diskspace_h(sz)}\t{rref}")
-      total+=sz
-    print(f"{diskspace_h(total)}\ttotal")
-
-  if interactive:
-    print("Confirm removal? [yN]")
-    ans=input()
-    if ans.lower() != 'y':
-      print("Cancelled by user")
-      return
-
-  for rref in rrefs:
-    rmref(rref,S=S)
-  for dref in drefs:
-    rmref(dref,S=S)
-
+  keep=gc_exceptions(keep_dirs)
+  evicted:Optional[List[Tuple[RRef,int]]]=None
+  if budget is None and max_age is None:
+    drefs,rrefs=gc_candidates(keep,S=S)
+  else:
+    evicted=gc_evict(keep,budget,max_age,S=S)
+    drefs,rrefs=set(),{rref for rref,_ in evicted}
+
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    if evicted is None:
+      inodes=list(pool.map(lambda r:dirinodes(rref2path(r,S)), rrefs))
+      rrefs_pairs=sorted(zip(rrefs,[sum(i.values()) for i in inodes]),
+                         key=lambda x:x[1])
+      # Files shared by hardlinks are counted once
+      total=sum({k:v for i in inodes for k,v in i.items()}.values())
+    else:
+      rrefs_pairs=sorted(evicted, key=lambda x:x[1])
+      total=sum(sz for _,sz in evicted)
+
+    if verbose:
+      if len(drefs)+len(rrefs)>0:
+        print("Objects to be removed:")
+      for dref in drefs:
+        print(f"\t{dref}")
+      for rref,sz in rrefs_pairs:
+        print(f"{diskspace_h(sz)}\t{rref}")
+      print(f"{diskspace_h(total)}\ttotal")
+
+    if dry_run:
+      return total
+
+    if interactive:
+      print("Confirm removal? [yN]")
+      ans=input()
+      if ans.lower() != 'y':
+        print("Cancelled by user")
+        return 0
+
+    # Realizations of the removed derivations go away with their folders
+    list(pool.map(lambda r:rmref(r,S=S),
+                  [rref for rref in rrefs if rref2dref(rref) not in drefs]))
+    list(pool.map(lambda d:rmref(d,S=S), drefs))
+  blobs_prune(S)
+  if budget is not None:
+    size=sum(rrefsizes_(S).values())
+    if size>budget:
+      warning(f"The realizations take {size} bytes after the garbage "
+              f"collection, which exceeds the budget of {budget} bytes")
+  return total
@@ -16,41 +16,69 @@
 
 from json import ( loads as json_loads, dumps as json_dumps, dump as json_dump,
     load as json_load )
-from time import strftime, strptime, gmtime
+from time import strftime, strptime, gmtime, time, time_ns, sleep
 from calendar import timegm
 from errno import EEXIST
 from os import (
     mkdir, makedirs, replace, listdir, rmdir, symlink, rename, remove, environ,
-    walk, lstat, chmod, stat, readlink, scandir )
+    walk, lstat, chmod, stat, readlink, scandir, utime, link, umask,
+    open as os_open, close as os_close, read as os_read, ftruncate, pwrite,
+    fstat, getpid, kill, O_RDWR, O_CREAT )
 from os.path import (
     basename, join, isfile, isdir, islink, relpath, abspath, dirname, split,
     getsize, isabs, splitext, normpath, realpath )
 from stat import ( S_IWRITE, S_IREAD, S_IRGRP, S_IROTH, S_IXUSR, S_IXGRP,
-    S_IXOTH, ST_MODE, S_IWGRP, S_IWRITE, S_IWOTH )
+    S_IXOTH, ST_MODE, S_IWGRP, S_IWRITE, S_IWOTH, S_IMODE, S_ISLNK )
+from fcntl import ioctl, flock, LOCK_EX, LOCK_NB, LOCK_UN
+from socket import gethostname
 from hashlib import sha1, sha256
 from copy import deepcopy
 from tempfile import mkdtemp
-from shutil import rmtree, copyfile, copytree, copy as shutil_copy
+from shutil import rmtree, copyfile, copytree, copy as shutil_copy, copyfileobj
 from unicodedata import normalize
 from re import sub as re_sub, match as re_match
 from distutils.spawn import find_executable
 from subprocess import Popen
 from urllib.parse import urlparse
+from urllib.request import Request, urlopen, url2pathname, pathname2url
+from urllib.error import HTTPError
 from errno import ENOTEMPTY
-from threading import get_ident, local as threading_local
-from contextlib import contextmanager
+from threading import get_ident, local as threading_local, Lock, Event
+from contextlib import contextmanager, nullcontext
 from collections import OrderedDict, defaultdict
 from sys import maxsize
 from datetime import datetime
 from fnmatch import fnmatch
 from functools import partial
-from itertools import chain
-from logging import getLogger
+from itertools import chain, count
+from logging import getLogger, Handler, LogRecord, makeLogRecord
+from logging.handlers import QueueHandler, QueueListener
 from traceback import format_exc
 from queue import PriorityQueue
 from inspect import getsourcelines
 from dataclasses import dataclass
 from ast import parse, dump as ast_dump
 from textwrap import dedent
-from inspect import signature, Parameter as InspectParameter
+from inspect import ( signature, Parameter as InspectParameter,
+    iscoroutinefunction )
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+    Future, wait as futures_wait, FIRST_COMPLETED)
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context as mp_get_context
+from asyncio import (get_running_loop, wrap_future, ensure_future, gather,
+    Semaphore, CancelledError, run as asyncio_run, sleep as asyncio_sleep,
+    shield)
+from resource import getrlimit, setrlimit, RLIMIT_AS, RLIM_INFINITY
+from importlib import import_module
+from pickle import dumps as pickle_dumps
+from atexit import register as atexit_register
 
+from sqlite3 import connect as sqlite3_connect, Connection as SQLiteConnection
+
+from tarfile import ( open as tarfile_open, is_tarfile, TarInfo, TarFile,
+    REGTYPE )
+from io import BytesIO
+from zipfile import ZipFile, is_zipfile
+from gzip import open as gzip_open
+from bz2 import open as bz2_open
+from lzma import open as lzma_open
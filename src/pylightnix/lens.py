@@ -22,7 +22,7 @@ from pylightnix.types import (Any, Dict, List, Build, DRef, RRef, Optional,
 from pylightnix.utils import (isrefpath, isdref, isrref, tryreadjson )
 from pylightnix.core import (rref2dref, rref2path, cfgdict,
                              dref2path, rrefctx, context_deref,
-                             context_add, drefcfg)
+                             context_add, drefcfg, rreftouch, closuredeps_)
 from pylightnix.build import (build_outpaths, build_config, build_context)
 
 
@@ -91,9 +91,11 @@ def val2path(v:Any, ctx:LensContext)->Path:
       if dref in context:
         rrefs=context_deref(context,dref)
         assert len(rrefs)==1, "Lens doesn't support multirealization dependencies"
+        rreftouch(rrefs,S)
         return Path(rref2path(rrefs[0],S=S))
     return dref2path(dref,S=S)
   elif isrref(v):
+    rreftouch([RRef(v)],S)
     return rref2path(RRef(v),S=S)
   elif isrefpath(v):
     refpath=list(v) # RefPath is list
@@ -103,6 +105,7 @@ def val2path(v:Any, ctx:LensContext)->Path:
       if refpath[0] in context:
         rrefs=context_deref(context,refpath[0])
         assert len(rrefs)==1, "Lens doesn't support multirealization dependencies"
+        rreftouch(rrefs,S)
         return Path(join(rref2path(rrefs[0],S), *refpath[1:]))
       else:
         if bpath is not None:
@@ -247,14 +250,18 @@ class Lens:
 
   @property
   def closure(self)->Closure:
-    """ Constructs a closure of the DRef which this lens points to.
-    FIXME: Filter the closure derivations from unrelated entries.
-    """
+    """ Constructs a closure of the DRef which this lens points to. The
+    closure contains only this DRef and its dependencies. """
     r=lens_repr(self,'closure')
     v=traverse(self, r)
     assert isdref(v), f"Lens {r} expected a dref, but got '{v}'"
     assert self._ctx.closure is not None
-    return Closure(v,[v],self._ctx.closure.derivations,self._ctx.S)
+    deps=closuredeps_(self._ctx.closure)
+    assert v in deps, f"Lens {r} points to {v} which is not in the closure"
+    deps_={d:deps[d] for d in {v}|deps[v]}
+    return Closure(v,[v],[d for d in self._ctx.closure.derivations
+                          if d.dref in deps_],
+                   self._ctx.S, deps_)
 
 
 def mklens(x:Any, o:Optional[Path]=None,
@@ -1,4 +1,5 @@
 from pylightnix.stages.trivial import *
+from pylightnix.stages.fetchcache import *
 from pylightnix.stages.fetch import *
 from pylightnix.stages.fetch2 import *
 
@@ -15,7 +15,8 @@
 """ Builtin stages for fetching things from the Internet """
 
 from pylightnix.imports import (sha256 as sha256sum, sha1 as sha1sum, urlparse,
-    Popen, remove, basename, join, rename, isfile, copyfile, environ, getLogger )
+    Popen, remove, basename, join, rename, isfile, environ, getLogger,
+    nullcontext )
 from pylightnix.types import ( DRef, Registry, Build, Context, Name,
     Path, Optional, List, Config )
 from pylightnix.core import ( mkconfig, mkdrv, match_only, cfgcattrs,
@@ -23,8 +24,12 @@ from pylightnix.core import ( mkconfig, mkdrv, match_only, cfgcattrs,
 from pylightnix.build import ( build_outpath, build_paths, build_deref_,
                               build_wrapper, build_wrapper,
                               build_config )
-from pylightnix.utils import ( try_executable, makedirs )
+from pylightnix.utils import ( try_executable, makedirs, filedigest, filecopy,
+                               urldownload, extract_archive )
 from pylightnix.lens import ( mklens )
+from pylightnix.stages.fetchcache import ( fetchcache_get, fetchcache_put,
+                                          fetchcache_move, fetchcache_partpath,
+                                          fetchcache_partlock )
 
 logger=getLogger(__name__)
 info=logger.info
@@ -39,14 +44,15 @@ AUNPACK=try_executable('aunpack',
                        'PYLIGHTNIX_AUNPACK',
                        '`aunpack` executable not found. Please install `atool` '
                        'system package or set PYLIGHTNIX_AUNPACK env var.',
-                       '`fetchurl` and `fetchlocal` stages will fail in its '
-                       '`unpack` mode')
+                       '`fetchurl` and `fetchlocal` stages will fail to '
+                       'unpack the formats not supported natively')
 
 def _unpack_inplace(o:str, fullpath:str, remove_file:bool):
   info(f"Unpacking {fullpath}..")
-  p=Popen([AUNPACK(), fullpath], cwd=o)
-  p.wait()
-  assert p.returncode == 0, f"Unpack failed, errcode '{p.returncode}'"
+  if not extract_archive(fullpath, o):
+    p=Popen([AUNPACK(), fullpath], cwd=o)
+    p.wait()
+    assert p.returncode == 0, f"Unpack failed, errcode '{p.returncode}'"
   if remove_file:
     info(f"Removing {fullpath}..")
     remove(fullpath)
@@ -60,18 +66,26 @@ def fetchurl(url:str,
              filename:Optional[str]=None,
              force_download:bool=False,
              check_promises:bool=True,
+             backend:str='wget',
+             nconnections:int=1,
              r:Optional[Registry]=None,
              **kwargs)->DRef:
   """ Download and unpack an URL addess.
 
   Downloading is done by calling `wget` application. Optional unpacking is
-  performed with the `aunpack` script from `atool` package. `sha256` defines the
-  expected SHA-256 hashsum of the stored data. `mode` allows to tweak the
-  stage's behavior: adding word 'unpack' instructs fetchurl to unpack the
-  package, adding 'remove' instructs it to remove the archive after unpacking.
+  performed in-process by [extract_archive](#pylightnix.utils.extract_archive).
+  The `aunpack` script from `atool` package is used for the formats it doesn't
+  recognize. `sha256` defines the expected SHA-256 hashsum of the stored data.
+  `mode` allows to tweak the stage's behavior: adding word 'unpack' instructs
+  fetchurl to unpack the package, adding 'remove' instructs it to remove the
+  archive after unpacking.
 
   If 'unpack' is not expected, then the promise named 'out_path' is created.
 
+  If the `PYLIGHTNIX_FETCH_CACHE` environment variable is set, the downloaded
+  files are shared between storages via the download cache, see
+  [fetchcache_get](#pylightnix.stages.fetchcache.fetchcache_get).
+
   Agruments:
   - `r:Registry` the dependency resolution [Registry](#pylightnix.types.Registry).
   - `url:str` URL to download from. Should point to a single file.
@@ -84,6 +98,11 @@ def fetchurl(url:str,
   - `force_download:bool=False` If False, resume the last download if
     possible.
   - `check_promises:bool=True` Passed to `mkdrv` as-is.
+  - `backend:str='wget'` Either `'wget'` or `'python'`. The latter downloads
+    the file in-process with [urldownload](#pylightnix.utils.urldownload).
+    Doesn't affect the configuration.
+  - `nconnections:int=1` Number of parallel range requests made by the
+    `'python'` backend.
 
   Example:
   ```python
@@ -109,9 +128,9 @@ def fetchurl(url:str,
                         "Try specifying a valid `filename` argument")
 
   def _instantiate()->Config:
-    assert WGET() is not None
-    if 'unpack' in mode:
-      assert AUNPACK() is not None
+    assert backend in ['wget','python'], f"Unsupported backend '{backend}'"
+    if backend=='wget':
+      assert WGET() is not None
     assert (sha256 is None) or (sha1 is None)
     makedirs(tmpfetchdir, exist_ok=True)
     if sha256 is not None:
@@ -135,30 +154,43 @@ def fetchurl(url:str,
     o=build_outpath(b)
 
     download_dir=o if force_download else tmpfetchdir
+    algo,digest=('sha256',c.sha256) if sha256 is not None else ('sha1',c.sha1)
+    fullpath=join(o,fname)
 
     try:
-      partpath=join(download_dir,fname+'.tmp')
-      p=Popen([WGET(), "--continue", '--output-document', partpath, c.url],
-              cwd=download_dir)
-      p.wait()
-
-      assert p.returncode == 0, f"Download failed, errcode '{p.returncode}'"
-      assert isfile(partpath), f"Can't find output file '{partpath}'"
+      partpath=join(o,fname+'.tmp') if force_download else \
+               fetchcache_partpath(algo,digest,download_dir,fname)
+      mkhash=sha256sum if sha256 is not None else sha1sum
+      with nullcontext() if force_download else fetchcache_partlock(partpath):
+        cached=not force_download and fetchcache_get(algo,digest,fullpath)
+        if cached:
+          info(f"Using the cached copy of {c.url}")
+          realhash=digest
+        else:
+          if backend=='python':
+            realhash=urldownload(c.url, partpath, mkhash,
+                                 nconnections=nconnections)
+          else:
+            p=Popen([WGET(), "--continue", '--output-document', partpath,
+                     c.url], cwd=download_dir)
+            p.wait()
+            assert p.returncode == 0, (f"Download failed, errcode "
+                                       f"'{p.returncode}'")
+            assert isfile(partpath), f"Can't find output file '{partpath}'"
+            realhash=filedigest(partpath,mkhash)
 
-      with open(partpath,"rb") as f:
         if sha256 is not None:
-          realhash=sha256sum(f.read()).hexdigest()
-          assert realhash==c.sha256, (f"Expected sha256 checksum '{c.sha256}', "
-                                      f"but got '{realhash}'")
+          assert realhash==c.sha256, (f"Expected sha256 checksum "
+                                      f"'{c.sha256}', but got '{realhash}'")
         elif sha1 is not None:
-          realhash=sha1sum(f.read()).hexdigest()
           assert realhash==c.sha1, (f"Expected sha1 checksum '{c.sha1}', "
-                                      f"but got '{realhash}'")
+                                    f"but got '{realhash}'")
         else:
           assert False, 'Either sha256 or sha1 arguments should be set'
 
-      fullpath=join(o,fname)
-      rename(partpath, fullpath)
+        if not cached:
+          fetchcache_move(partpath, fullpath)
+          fetchcache_put(algo, digest, fullpath)
 
       if 'unpack' in c.mode:
         _unpack_inplace(o, fullpath, 'remove' in c.mode)
@@ -179,6 +211,7 @@ def fetchlocal(sha256:str,
                name:Optional[str]=None,
                filename:Optional[str]=None,
                check_promises:bool=True,
+               hardlink:bool=False,
                r:Optional[Registry]=None,
                **kwargs)->DRef:
   """ Copy local file into Pylightnix storage. This function is typically
@@ -187,6 +220,14 @@ def fetchlocal(sha256:str,
 
   See `fetchurl` for arguments description.
 
+  The file is read once: it is copied with
+  [filecopy](#pylightnix.utils.filecopy) which prefers copy-on-write cloning
+  and calculates the hash while copying otherwise. Setting `hardlink` to True
+  allows the stage to hardlink the file into the storage if the file is on the
+  same filesystem. Note that the read-only protection of the realization then
+  applies to the original file as well. `hardlink` doesn't affect the
+  configuration.
+
   If 'unpack' is not expected, then the promise named 'out_path' is created.
 
   FIXME: Switch regular `fetchurl` to `curl` and call it with `file://` URLs.
@@ -206,8 +247,6 @@ def fetchlocal(sha256:str,
                         "Try specifying a valid `filename` argument")
 
   def _instantiate()->Config:
-    if 'unpack' in mode:
-      assert AUNPACK() is not None
     assert path is not None or envname is not None, (
       "Either `path` or `envname` argument must be specified")
     assert path is None or envname is None, (
@@ -231,13 +270,10 @@ def fetchlocal(sha256:str,
       partpath=join(o,fname)+'.tmp'
       fullpath=join(o,fname)
 
-      copyfile(path_, partpath)
+      realhash=filecopy(path_, partpath, sha256sum, hardlink=hardlink)
       assert isfile(partpath), f"Can't copy '{path_}' to '{partpath}'"
-
-      with open(partpath,"rb") as f:
-        realhash=sha256sum(f.read()).hexdigest()
-        assert realhash==c.sha256, (f"Expected sha256 checksum '{c.sha256}', "
-                                    f"but got '{realhash}'")
+      assert realhash==c.sha256, (f"Expected sha256 checksum '{c.sha256}', "
+                                  f"but got '{realhash}'")
       rename(partpath,fullpath)
 
       if 'unpack' in c.mode:
@@ -17,16 +17,23 @@
 from pylightnix.imports import (sha256 as sha256sum, sha1 as sha1sum, urlparse,
                                 Popen, remove, basename, join, rename, isfile,
                                 copyfile, environ, getLogger, isabs, isdir,
-                                splitext, re_sub )
+                                splitext, re_sub, nullcontext, url2pathname,
+                                pathname2url )
 from pylightnix.types import ( DRef, Registry, Build, Context, Name,
-    Path, Optional, List, Config, RefPath )
+    Path, Optional, List, Config, RefPath, Closure, Union, Tuple, Any,
+    Derivation )
 from pylightnix.core import ( mkconfig, mkdrv, match_only,
                              PYLIGHTNIX_NAMEPAT, cfgcattrs, selfref,
-                             fstmpdir, tlregistry )
+                             fstmpdir, tlregistry, drefcfg_, realizeParallel,
+                             unpack_closure_arg_, closuredeps_ )
 from pylightnix.build import ( build_outpath,
     build_paths, build_deref_, build_config, build_wrapper, build_wrapper )
-from pylightnix.utils import ( try_executable, makedirs, filehash )
+from pylightnix.utils import ( try_executable, makedirs, filehash, filedigest,
+                              filecopy, urldownload, dirrm, extract_archive )
 from pylightnix.lens import ( mklens )
+from pylightnix.stages.fetchcache import ( fetchcache_get, fetchcache_put,
+                                          fetchcache_move, fetchcache_partpath,
+                                          fetchcache_partlock )
 
 logger=getLogger(__name__)
 info=logger.info
@@ -42,7 +49,8 @@ AUNPACK=try_executable('aunpack',
                        'PYLIGHTNIX_AUNPACK',
                        '`aunpack` executable not found. Please install `atool` '
                        'system package or set PYLIGHTNIX_AUNPACK env var.',
-                       '`unpack` stage will fail')
+                       '`unpack` stage will fail to unpack the formats not '
+                       'supported natively')
 
 def fetchurl2(url:str,
               sha256:Optional[str]=None,
@@ -50,12 +58,22 @@ def fetchurl2(url:str,
               name:Optional[str]=None,
               filename:Optional[str]=None,
               force_download:bool=False,
+              backend:str='curl',
+              nconnections:int=1,
               r:Optional[Registry]=None,
               **kwargs)->DRef:
   """ Download file given it's URL addess.
 
   Downloading is done by calling `curl` application. The path to the executable
-  may be altered by setting the `PYLIGHTNIX_CURL` environment variable.
+  may be altered by setting the `PYLIGHTNIX_CURL` environment variable. Local
+  files and `file://` URLs are copied without `curl` by
+  [filecopy](#pylightnix.utils.filecopy) which hashes the data while copying.
+
+  If the `PYLIGHTNIX_FETCH_CACHE` environment variable is set, the cache is
+  checked before downloading and the downloaded file is added to it, see
+  [fetchcache_get](#pylightnix.stages.fetchcache.fetchcache_get). The cache
+  directory also holds the partial downloads. Concurrent downloads of the same
+  file are serialized by [fetchcache_partlock](#pylightnix.stages.fetchcache.fetchcache_partlock).
 
   Agruments:
   - `r:Registry` the dependency resolution [Registry](#pylightnix.types.Registry).
@@ -67,8 +85,17 @@ def fetchurl2(url:str,
     Stage will attempt to deduced it if not specified.
   - `force_download:bool=False` If False, resume the last download if
     possible.
+  - `backend:str='curl'` Either `'curl'` or `'python'`. The latter downloads
+    the file in-process with [urldownload](#pylightnix.utils.urldownload),
+    hashing the data while it arrives.
+  - `nconnections:int=1` Number of parallel range requests made by the
+    `'python'` backend.
   - `check_promises:bool=True` Passed to `mkdrv` as-is.
 
+  Neither `backend` nor `nconnections` affect the configuration. The
+  derivation declares the `'net'` [resource](#pylightnix.types.Resources), which
+  lets [prefetch](#pylightnix.stages.fetch2.prefetch) find it.
+
   Example:
   ```python
   def hello_src(r:Registry)->DRef:
@@ -92,7 +119,6 @@ def fetchurl2(url:str,
   filename_=filename or basename(urlparse(url).path)
   assert len(filename_)>0, ("Downloadable filename shouldn't be empty. "
                             "Try specifying a valid `filename` argument")
-  assert CURL() is not None
   makedirs(tmpfetchdir, exist_ok=True)
 
   if name is None:
@@ -101,10 +127,13 @@ def fetchurl2(url:str,
   if sha256 is None and sha1 is None:
     if isfile(url):
       sha256=filehash(Path(url))
-      url=f'file://{url}'
+      url=f'file://{pathname2url(url)}'
     else:
       assert False, ("Either `sha256` or `sha1` arguments should be specified "
                      "for URLs")
+  assert backend in ['curl','python'], f"Unsupported backend '{backend}'"
+  if urlparse(url).scheme!='file' and backend=='curl':
+    assert CURL() is not None
 
   def _config()->dict:
     args:dict={'name':name}
@@ -119,28 +148,51 @@ def fetchurl2(url:str,
   def _make(b:Build)->None:
     c=cfgcattrs(build_config(b))
     o=build_outpath(b)
+    mkhash=sha256sum if sha256 is not None else sha1sum
+    algo,digest=('sha256',c.sha256) if sha256 is not None else ('sha1',c.sha1)
+    fullpath=join(o,filename_)
 
     download_dir=o if force_download else tmpfetchdir
-    partpath=join(download_dir,filename_+'.tmp')
+    partpath=join(o,filename_+'.tmp') if force_download else \
+             fetchcache_partpath(algo,digest,download_dir,filename_)
+
+    if urlparse(url).scheme=='file':
+      partpath=join(o,filename_+'.tmp')
+    shared=not force_download and urlparse(url).scheme!='file'
 
     try:
-      p=Popen([CURL(), "--continue-at", "-", "--output", partpath, url],
-              cwd=download_dir)
-      p.wait()
-      assert p.returncode == 0, f"Download failed, errcode '{p.returncode}'"
-      assert isfile(partpath), f"Can't find output file '{partpath}'"
+      with fetchcache_partlock(partpath) if shared else nullcontext():
+        cached=False
+        if urlparse(url).scheme=='file':
+          realhash=filecopy(url2pathname(urlparse(url).path), partpath,
+                            mkhash)
+        elif not force_download and fetchcache_get(algo,digest,fullpath):
+          info(f"Using the cached copy of {url}")
+          cached=True
+          realhash=digest
+        elif backend=='python':
+          realhash=urldownload(url, partpath, mkhash,
+                               nconnections=nconnections)
+        else:
+          p=Popen([CURL(), "--continue-at", "-", "--output", partpath, url],
+                  cwd=download_dir)
+          p.wait()
+          assert p.returncode == 0, f"Download failed, errcode '{p.returncode}'"
+          assert isfile(partpath), f"Can't find output file '{partpath}'"
+          realhash=filedigest(partpath,mkhash)
 
-      with open(partpath,"rb") as f:
         if sha256 is not None:
-          realhash=sha256sum(f.read()).hexdigest()
           assert realhash==c.sha256, (f"Expected sha256 checksum '{c.sha256}', "
                                       f"but got '{realhash}'")
         if sha1 is not None:
-          realhash=sha1sum(f.read()).hexdigest()
+          realhash=realhash if sha256 is None else \
+                   filedigest(fullpath if cached else partpath,sha1sum)
           assert realhash==c.sha1, (f"Expected sha1 checksum '{c.sha1}', "
                                     f"but got '{realhash}'")
-      fullpath=join(o,filename_)
-      rename(partpath, fullpath)
+        if not cached:
+          fetchcache_move(partpath, fullpath)
+          if urlparse(url).scheme!='file':
+            fetchcache_put(algo,digest,fullpath)
 
     except Exception as e:
       error(f"Download failed: {e}")
@@ -150,7 +202,44 @@ def fetchurl2(url:str,
   return mkdrv(mkconfig(_config()),
                match_only(),
                build_wrapper(_make),
-               r)
+               r, resources={'net':1})
+
+
+def prefetch(closure:Union[Closure,Tuple[Any,Closure]],
+             max_parallel:Optional[int]=None)->Context:
+  """ Realize the download derivations of a closure concurrently, so that the
+  network transfers overlap. Download derivations are the derivations without
+  dependencies, having either the `url` field in their configs, like the ones
+  created by [fetchurl](#pylightnix.stages.fetch.fetchurl), or the `'net'`
+  [resource](#pylightnix.types.Resources), like the ones created by
+  [fetchurl2](#pylightnix.stages.fetch2.fetchurl2). The realization is
+  performed by [realizeParallel](#pylightnix.core.realizeParallel) using up to
+  `max_parallel` threads. Already realized derivations are only matched.
+
+  Returns the context of the download derivations. A subsequent
+  [realize](#pylightnix.core.realize) of the closure finds them realized.
+
+  Example:
+  ```python
+  closure=instantiate(mystage)
+  prefetch(closure, max_parallel=8)
+  rref=realize1(closure)
+  ```
+  """
+  _,closure_=unpack_closure_arg_(closure)
+  S=closure_.S
+  deps=closuredeps_(closure_)
+  def _isfetch(drv:Derivation)->bool:
+    return drv.dref in deps and len(deps[drv.dref])==0 and \
+           ('net' in (drv.resources or {}) or
+            'url' in drefcfg_(drv.dref,S).val)
+  drvs=[drv for drv in closure_.derivations if _isfetch(drv)]
+  if len(drvs)==0:
+    return {}
+  drefs=[drv.dref for drv in drvs]
+  _,_,ctx=realizeParallel(Closure(drefs,drefs,drvs,S),
+                          max_workers=max_parallel)
+  return ctx
 
 
 def unpack(path:Optional[str]=None,
@@ -159,8 +248,18 @@ def unpack(path:Optional[str]=None,
            sha256:Optional[str]=None,
            sha1:Optional[str]=None,
            aunpack_args:List[str]=[],
+           nworkers:int=1,
            r:Optional[Registry]=None,
            **kwargs)->DRef:
+  """ Unpack the archive given either by the filesystem `path` or by the
+  `refpath` pointing into another derivation.
+
+  The archive is extracted in-process by
+  [extract_archive](#pylightnix.utils.extract_archive), zip archives are
+  extracted using `nworkers` threads. The `aunpack` script of the `atool`
+  package is called if the format is not supported natively or if
+  `aunpack_args` are not empty. `nworkers` doesn't affect the configuration.
+  """
 
   if path:
     assert refpath is None
@@ -187,8 +286,10 @@ def unpack(path:Optional[str]=None,
       fullpath=mklens(b).get('path').syspath
     assert fullpath is not None
     info(f"Unpacking {fullpath}..")
-    p=Popen([AUNPACK(), fullpath]+aunpack_args, cwd=mklens(b).syspath)
-    p.wait()
-    assert p.returncode == 0, f"Unpack failed, errcode '{p.returncode}'"
+    if len(aunpack_args)>0 or \
+       not extract_archive(fullpath, mklens(b).syspath, nworkers=nworkers):
+      p=Popen([AUNPACK(), fullpath]+aunpack_args, cwd=mklens(b).syspath)
+      p.wait()
+      assert p.returncode == 0, f"Unpack failed, errcode '{p.returncode}'"
   return mkdrv(mkconfig(_config()), match_only(), build_wrapper(_make), r)
 
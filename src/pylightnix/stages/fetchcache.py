@@ -0,0 +1,160 @@
+# Copyright 2020, Sergey Mironov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Download cache shared by the fetch stages of all storages """
+
+from pylightnix.imports import (sha256 as sha256sum, sha1 as sha1sum, remove,
+                                join, rename, isfile, environ, getLogger,
+                                isdir, replace, utime, mkdtemp, listdir, stat,
+                                contextmanager, os_open, os_close, flock,
+                                LOCK_EX, O_RDWR, O_CREAT, fstat )
+from pylightnix.types import ( Path, Optional, Iterator )
+from pylightnix.utils import ( makedirs, filecopy, dirrm )
+
+logger=getLogger(__name__)
+error=logger.error
+
+#: Hash functions supported by the download cache
+_FETCH_HASHES={'sha256':sha256sum, 'sha1':sha1sum}
+
+def fetchcache_dir()->Optional[str]:
+  """ Return the path to the download cache directory, shared by the fetch
+  stages of all storages. The cache is enabled by setting the
+  `PYLIGHTNIX_FETCH_CACHE` environment variable. """
+  return environ.get('PYLIGHTNIX_FETCH_CACHE')
+
+def fetchcache_get(algo:str, digest:str, dst:str,
+                   cache:Optional[str]=None)->bool:
+  """ Copy the cached file with the `algo` (`'sha256'` or `'sha1'`) hash
+  `digest` to the new file `dst`, verifying the hash. The file is cloned with
+  [reflink](#pylightnix.utils.reflink) if possible. It is never hardlinked,
+  because the realizations change the permissions of their files. Return False
+  if there is no such file in the cache. Corrupted entries are removed. """
+  cache=cache or fetchcache_dir()
+  if cache is None:
+    return False
+  path=join(cache,algo,digest)
+  if not isfile(path):
+    return False
+  realhash=filecopy(path, dst, _FETCH_HASHES[algo])
+  if realhash!=digest:
+    error(f"Removing corrupted cache entry '{path}'")
+    remove(dst)
+    remove(path)
+    return False
+  try:
+    utime(path)
+  except PermissionError:
+    pass # Entries of other users keep their access times
+  return True
+
+def fetchcache_put(algo:str, digest:str, src:str,
+                   cache:Optional[str]=None,
+                   max_size:Optional[int]=None)->None:
+  """ Atomically insert the file `src` into the download cache as the file
+  having `algo` hash `digest`. The file is hardlinked if possible. Evict the
+  least recently used entries if the cache gets larger than `max_size` bytes
+  which defaults to the value of the `PYLIGHTNIX_FETCH_CACHE_SIZE` environment
+  variable. """
+  cache=cache or fetchcache_dir()
+  if cache is None:
+    return
+  makedirs(join(cache,algo), exist_ok=True)
+  makedirs(join(cache,'tmp'), exist_ok=True)
+  tmpdir=mkdtemp(dir=join(cache,'tmp'))
+  try:
+    realhash=filecopy(src, join(tmpdir,digest), _FETCH_HASHES[algo],
+                      hardlink=True)
+    assert realhash==digest, (f"Expected {algo} checksum '{digest}', "
+                              f"but got '{realhash}'")
+    replace(join(tmpdir,digest), join(cache,algo,digest))
+  finally:
+    dirrm(Path(tmpdir))
+  if max_size is None and 'PYLIGHTNIX_FETCH_CACHE_SIZE' in environ:
+    max_size=int(environ['PYLIGHTNIX_FETCH_CACHE_SIZE'])
+  if max_size is not None:
+    fetchcache_evict(max_size, cache)
+
+def fetchcache_evict(max_size:int, cache:Optional[str]=None)->int:
+  """ Remove the least recently used entries of the download cache until its
+  size fits into `max_size` bytes. Return the number of entries removed. """
+  cache=cache or fetchcache_dir()
+  if cache is None:
+    return 0
+  entries=[]
+  for algo in _FETCH_HASHES.keys():
+    if isdir(join(cache,algo)):
+      for digest in listdir(join(cache,algo)):
+        st=stat(join(cache,algo,digest))
+        entries.append((st.st_mtime,st.st_size,join(cache,algo,digest)))
+  total=sum([e[1] for e in entries])
+  nremoved=0
+  for _,size,path in sorted(entries):
+    if total<=max_size:
+      break
+    remove(path)
+    total-=size
+    nremoved+=1
+  return nremoved
+
+def fetchcache_move(src:str, dst:str)->None:
+  """ Move the downloaded file to its destination which may reside on a
+  different filesystem if the download cache is enabled. """
+  try:
+    rename(src, dst)
+  except OSError:
+    filecopy(src, dst)
+    remove(src)
+
+def fetchcache_partpath(algo:str, digest:str, download_dir:str,
+                        filename:str)->str:
+  """ Return the path for the partially downloaded file. Partial downloads are
+  kept in the download cache if it is enabled, so they may be resumed by other
+  storages. They are keyed by the hash to avoid collisions between different
+  files having the same name. Writers should hold
+  [fetchcache_partlock](#pylightnix.stages.fetchcache.fetchcache_partlock) while
+  using the file. """
+  cache=fetchcache_dir()
+  if cache is not None:
+    makedirs(join(cache,'tmp'), exist_ok=True)
+    return join(cache,'tmp',f'{algo}-{digest}')
+  return join(download_dir,f'{digest}-{filename}.tmp')
+
+@contextmanager
+def fetchcache_partlock(partpath:str)->Iterator[None]:
+  """ Hold an exclusive lock on the partially downloaded file `partpath`.
+  Writers of the same file wait until the current writer moves the complete
+  file to its destination and puts it into the download cache. The lock is
+  taken on a separate `.lock` file because the partial file itself is moved
+  away. The holder removes the `.lock` file before releasing it, so waiters
+  which have locked a removed file try again. """
+  lockpath=partpath+'.lock'
+  while True:
+    fd=os_open(lockpath, O_RDWR|O_CREAT)
+    try:
+      flock(fd,LOCK_EX)
+      try:
+        if stat(lockpath).st_ino==fstat(fd).st_ino:
+          break
+      except FileNotFoundError:
+        pass
+    except BaseException:
+      os_close(fd)
+      raise
+    os_close(fd)
+  try:
+    yield
+  finally:
+    remove(lockpath)
+    os_close(fd)
@@ -88,12 +88,11 @@ def redefine(stage:Any,
     dref=stage(*args,r=r,**kwargs) # type:ignore
     d=cfgdict(drefcfg_(dref,S=r.S))
     new_config(d)
-    new_matcher_=new_matcher if new_matcher is not None\
-                             else r.builders[dref].matcher
-    new_realizer_=new_realizer if new_realizer is not None\
-                               else r.builders[dref].realizer
-    del r.builders[dref] # Pretend that it did not exist
-    return mkdrv(mkconfig(d), new_matcher_, new_realizer_, r)
+    with r.lock:
+      drv=r.builders.pop(dref) # Pretend that it did not exist
+    new_matcher_=new_matcher if new_matcher is not None else drv.matcher
+    new_realizer_=new_realizer if new_realizer is not None else drv.realizer
+    return mkdrv(mkconfig(d), new_matcher_, new_realizer_, r, drv.resources)
   return _new_stage
 
 def realized(stage:Any)->Stage:
@@ -0,0 +1,144 @@
+# Copyright 2020, Sergey Mironov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Optional SQLite index of the storage metadata. Functions of this module
+operate on the index file directly, the storage-level API is provided by the
+core, see [storedbpath](#pylightnix.core.storedbpath) and
+[store_reindex](#pylightnix.core.store_reindex). """
+
+from pylightnix.imports import (sqlite3_connect, SQLiteConnection,
+                                contextmanager)
+from pylightnix.types import (DRef, RRef, Name, Hash, List, Tuple, Optional,
+                              Iterator, Set)
+
+#: Number of seconds to wait for a lock held by a concurrent writer.
+PYLIGHTNIX_STOREDB_TIMEOUT=60.0
+
+@contextmanager
+def storedb_connect(path:str)->Iterator[SQLiteConnection]:
+  """ Open the index located at `path`. Statements executed within the context
+  form a single transaction. """
+  con=sqlite3_connect(path, timeout=PYLIGHTNIX_STOREDB_TIMEOUT)
+  try:
+    with con:
+      yield con
+  finally:
+    con.close()
+
+def storedb_init(path:str)->None:
+  """ Create the tables of an empty index at `path`. """
+  with storedb_connect(path) as con:
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("CREATE TABLE IF NOT EXISTS drefs("
+                "dref TEXT PRIMARY KEY, name TEXT, cfghash TEXT)")
+    con.execute("CREATE TABLE IF NOT EXISTS rrefs("
+                "rref TEXT PRIMARY KEY, dref TEXT, context TEXT, "
+                "buildstart TEXT, size INTEGER)")
+    con.execute("CREATE TABLE IF NOT EXISTS drefdeps(dref TEXT, dep TEXT, "
+                "PRIMARY KEY(dref,dep))")
+    con.execute("CREATE TABLE IF NOT EXISTS rrefdeps(rref TEXT, dep TEXT, "
+                "PRIMARY KEY(rref,dep))")
+    con.execute("CREATE INDEX IF NOT EXISTS drefs_name ON drefs(name)")
+    con.execute("CREATE INDEX IF NOT EXISTS rrefs_dref ON rrefs(dref)")
+    con.execute("CREATE INDEX IF NOT EXISTS drefdeps_dep ON drefdeps(dep)")
+    con.execute("CREATE INDEX IF NOT EXISTS rrefdeps_dep ON rrefdeps(dep)")
+
+def storedb_add(path:str,
+                drefs:List[Tuple[DRef,Name,Hash]]=[],
+                rrefs:List[Tuple[RRef,DRef,str,Optional[str],int]]=[],
+                drefedges:List[Tuple[DRef,DRef]]=[],
+                rrefedges:List[Tuple[RRef,RRef]]=[])->None:
+  """ Register derivations and realizations in the index in one transaction.
+  `drefs` contain derivation references, names and config hashes. `rrefs`
+  contain realization references, their derivations, serialized contexts,
+  build start times and disk usages. `drefedges` and `rrefedges` contain pairs
+  of references and their immediate dependencies. Existing records are kept
+  intact. """
+  with storedb_connect(path) as con:
+    con.executemany("INSERT OR IGNORE INTO drefs VALUES (?,?,?)", drefs)
+    con.executemany("INSERT OR IGNORE INTO rrefs VALUES (?,?,?,?,?)", rrefs)
+    con.executemany("INSERT OR IGNORE INTO drefdeps VALUES (?,?)", drefedges)
+    con.executemany("INSERT OR IGNORE INTO rrefdeps VALUES (?,?)", rrefedges)
+
+def storedb_remove_dref(path:str, dref:DRef)->None:
+  """ Remove the derivation and all its realizations from the index """
+  with storedb_connect(path) as con:
+    con.execute("DELETE FROM rrefdeps WHERE rref IN "
+                "(SELECT rref FROM rrefs WHERE dref=?)", (dref,))
+    con.execute("DELETE FROM rrefs WHERE dref=?", (dref,))
+    con.execute("DELETE FROM drefdeps WHERE dref=?", (dref,))
+    con.execute("DELETE FROM drefs WHERE dref=?", (dref,))
+
+def storedb_remove_rref(path:str, rref:RRef)->None:
+  with storedb_connect(path) as con:
+    con.execute("DELETE FROM rrefdeps WHERE rref=?", (rref,))
+    con.execute("DELETE FROM rrefs WHERE rref=?", (rref,))
+
+def storedb_drefs(path:str)->List[DRef]:
+  with storedb_connect(path) as con:
+    return [DRef(r[0]) for r in con.execute("SELECT dref FROM drefs")]
+
+def storedb_rrefs(path:str)->List[Tuple[RRef,DRef,Name,Optional[str],int]]:
+  """ Return all the realizations of the index together with the names of
+  their derivations, build start times and disk usages. """
+  with storedb_connect(path) as con:
+    return [(RRef(r[0]),DRef(r[1]),Name(r[2]),r[3],r[4]) for r in
+      con.execute("SELECT rrefs.rref, rrefs.dref, drefs.name, "
+                  "rrefs.buildstart, rrefs.size FROM rrefs "
+                  "JOIN drefs ON rrefs.dref=drefs.dref")]
+
+def storedb_drefdependents(path:str, drefs:List[DRef])->Set[DRef]:
+  """ Return derivations which immediately depend on any of `drefs` """
+  acc:Set[DRef]=set()
+  with storedb_connect(path) as con:
+    for dref in drefs:
+      acc.update(DRef(r[0]) for r in
+        con.execute("SELECT dref FROM drefdeps WHERE dep=?", (dref,)))
+  return acc
+
+def storedb_rrefdependents(path:str, rrefs:List[RRef])->Set[RRef]:
+  """ Return realizations which immediately depend on any of `rrefs` """
+  acc:Set[RRef]=set()
+  with storedb_connect(path) as con:
+    for rref in rrefs:
+      acc.update(RRef(r[0]) for r in
+        con.execute("SELECT rref FROM rrefdeps WHERE dep=?", (rref,)))
+  return acc
+
+def storedb_drefdepsall(path:str)->List[Tuple[DRef,DRef]]:
+  """ Return all the `(dref, dependency)` pairs of the index """
+  with storedb_connect(path) as con:
+    return [(DRef(r[0]),DRef(r[1])) for r in
+      con.execute("SELECT dref, dep FROM drefdeps")]
+
+def storedb_rrefdepsall(path:str)->List[Tuple[RRef,RRef]]:
+  """ Return all the `(rref, dependency)` pairs of the index """
+  with storedb_connect(path) as con:
+    return [(RRef(r[0]),RRef(r[1])) for r in
+      con.execute("SELECT rref, dep FROM rrefdeps")]
+
+def storedb_rootdrefs(path:str)->Set[DRef]:
+  """ Return derivations which have no dependents """
+  with storedb_connect(path) as con:
+    return {DRef(r[0]) for r in
+      con.execute("SELECT dref FROM drefs WHERE dref NOT IN "
+                  "(SELECT dep FROM drefdeps)")}
+
+def storedb_rootrrefs(path:str)->Set[RRef]:
+  """ Return realizations which have no dependents """
+  with storedb_connect(path) as con:
+    return {RRef(r[0]) for r in
+      con.execute("SELECT rrefs.rref FROM rrefs JOIN drefs "
+                  "ON rrefs.dref=drefs.dref WHERE rrefs.rref NOT IN "
+                  "(SELECT dep FROM rrefdeps)")}
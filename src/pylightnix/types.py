@@ -15,11 +15,11 @@
 """ All main types which we use in Pylightnix are defined here. """
 
 
-from pylightnix.imports import ( deepcopy, OrderedDict )
+from pylightnix.imports import ( deepcopy, OrderedDict, Lock )
 
 from typing import (List, Any, Tuple, Union, Optional, Iterable, IO, Callable,
                     Dict, NamedTuple, Set, Generator, TypeVar, NewType,
-                    SupportsAbs, Generic, Iterator)
+                    SupportsAbs, Generic, Iterator, Awaitable)
 
 class Path(str):
   """ `Path` is an alias for string. It is used in pylightnix to
@@ -142,6 +142,8 @@ class PromiseException(PylightnixException):
       f"to be referenced as {['/'.join(f[1][1:]) for f in failed]}")
     self.dref=dref
     self.failed=failed
+  def __reduce__(self):
+    return (PromiseException, (self.dref, self.failed))
 
 #: Type variable intended to be either a `Path` or `RRef`
 _REF=TypeVar('_REF')
@@ -244,35 +246,60 @@ MatcherO = Callable[[Optional[StorageSettings],Output[RRef]],
 Realizer = Callable[[Optional[StorageSettings],DRef,Context,RealizeArg],List[Path]]
 RealizerO = Callable[[Optional[StorageSettings],DRef,Context,RealizeArg],Output[Path]]
 
-#: Derivation is a core Pylightnix entity. It holds the information required to
-#: produce artifacts of individual [Stage](#pylightnix.types.stage).
-#:
-#: Fields include:
-#: * [Configuration](#pylightnix.types.Config) objects serialized on disk.
-#: * [Matcher](#pylightnix.types.Matcher) Python function
-#: * [Realizer](#pylightnix.core.realize1) Python function
-#:
-#: The actual configuration is stored in the Pylightnix filesystem storage.
-#: Derivation holds the [DRef](#pylightnix.types.DRef) access key.
-#:
-#: Derivations normally appear as a result of [mkdrv](#pylightnix.core.mkdrv)
-#: calls.
-Derivation = NamedTuple('Derivation', [('dref',DRef),
-                                       ('matcher',Matcher),
-                                       ('realizer',Realizer)])
+#: Asynchronous versions of [Realizer](#pylightnix.types.Realizer) and
+#: [Matcher](#pylightnix.types.Matcher). See
+#: [realize_async](#pylightnix.core.realize_async).
+RealizerAsync = Callable[[Optional[StorageSettings],DRef,Context,RealizeArg],
+                         Awaitable[List[Path]]]
+MatcherAsync = Callable[[Optional[StorageSettings],List[RRef]],
+                        Awaitable[Optional[List[RRef]]]]
+
+#: Resources are the amounts of CPU cores (`'cpu'`), memory in bytes (`'mem'`)
+#: and application-defined slots (like `'gpu'`) required by a realizer. See
+#: [realizeParallel](#pylightnix.core.realizeParallel).
+Resources = Dict[str,float]
+
+class Derivation(NamedTuple):
+  """ Derivation is a core Pylightnix entity. It holds the information required
+  to produce artifacts of individual [Stage](#pylightnix.types.stage).
+
+  Fields include:
+  * [Configuration](#pylightnix.types.Config) objects serialized on disk.
+  * [Matcher](#pylightnix.types.Matcher) Python function
+  * [Realizer](#pylightnix.core.realize1) Python function
+  * [Resources](#pylightnix.types.Resources) required by the realizer. They
+    are not the part of the configuration and don't affect the DRef. `None`
+    by default, which means no resources.
+
+  The actual configuration is stored in the Pylightnix filesystem storage.
+  Derivation holds the [DRef](#pylightnix.types.DRef) access key.
+
+  Derivations normally appear as a result of [mkdrv](#pylightnix.core.mkdrv)
+  calls. """
+  dref:DRef
+  matcher:Matcher
+  realizer:Realizer
+  resources:Optional[Resources]=None
 # TODO: Think about storing Stage function here as well. This would allow us to
 # organize catamorphism-like mappers.
 
-#: Closure describes the build plan for one or many
-#: [Derivations](#pylightnix.types.Derivation).
-#:
-#: Closures are typically obtained as a result of the
-#: [instantiate](#pylightnix.core.instantiate) and are consumed by the
-#: call to [realize](#pylightnix.core.realize) or it's analogs.
-Closure = NamedTuple('Closure', [('result',Any),
-                                 ('targets',List[DRef]),
-                                 ('derivations',List[Derivation]),
-                                 ('S',Optional[StorageSettings])])
+class Closure(NamedTuple):
+  """ Closure describes the build plan for one or many
+  [Derivations](#pylightnix.types.Derivation).
+
+  Closures are typically obtained as a result of the
+  [instantiate](#pylightnix.core.instantiate) and are consumed by the
+  call to [realize](#pylightnix.core.realize) or it's analogs.
+
+  The optional `deps` field maps the targets and all of their dependencies to
+  the complete sets of their own dependencies. It is computed once by
+  [mkclosure](#pylightnix.core.mkclosure). If it is `None`, the realization
+  functions compute it with [drefdepsmap](#pylightnix.core.drefdepsmap). """
+  result:Any
+  targets:List[DRef]
+  derivations:List[Derivation]
+  S:Optional[StorageSettings]
+  deps:Optional[Dict[DRef,Set[DRef]]]=None
 
 class Config:
   """ Config is a JSON-serializable dict-like object containing user-defined
@@ -419,11 +446,16 @@ class Registry:
   Registry doesn't requre any special operations besides creating and passing
   around. By convention, Registry objects are first arguments of user-defined
   stage functions and the `mkdrv` API function of Pylightnix.
+
+  Registries may be shared between threads. `builders` should be accessed
+  under the `lock`. `in_instantiate` holds the identifiers of the threads
+  running [instantiate](#pylightnix.core.instantiate) with this registry.
   """
   def __init__(self, S:Optional[StorageSettings]=None):
     self.builders:Dict[DRef,Derivation]=OrderedDict()
     self.S:Optional[StorageSettings]=S
-    self.in_instantiate:bool=False
+    self.in_instantiate:Set[int]=set()
+    self.lock=Lock()
 
 
 #: DRefLike is a type variable holding DRefs or any of its derivatives
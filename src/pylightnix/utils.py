@@ -23,11 +23,15 @@ from pylightnix.imports import (datetime, gmtime, timegm, join, makedirs,
     S_IREAD, S_IRGRP, S_IROTH, S_IXUSR, S_IXGRP, S_IXOTH, stat, ST_MODE,
     S_IWGRP, S_IWOTH, rmtree, rename, getsize, readlink, partial, copytree,
     chain, getLogger, environ, defaultdict, PriorityQueue, getsourcelines,
-    parse, dedent, ast_dump)
+    parse, dedent, ast_dump, OrderedDict, Lock, relpath, ThreadPoolExecutor,
+    ioctl, scandir, link, Request, urlopen, HTTPError, tarfile_open,
+    is_tarfile, ZipFile, is_zipfile, gzip_open, bz2_open, lzma_open,
+    copyfileobj, mkdtemp, listdir, normpath, shutil_copy, lstat, S_ISLNK,
+    umask, isabs, TarInfo, realpath)
 
 from pylightnix.types import (Union, Hash, Path, List, Any, Optional,
                               Iterable, IO, DRef, RRef, Tuple, Callable,
-                              Set)
+                              Set, Dict)
 
 from typing import TypeVar
 from pylightnix.tz import tzlocal
@@ -36,6 +40,20 @@ from pylightnix.tz import tzlocal
 #: `__buildtime__.txt` files. Do not change!
 PYLIGHTNIX_TIME="%y%m%d-%H:%M:%S:%f%z"
 
+#: Size of chunks, in bytes, in which files are read when calculating hashes.
+PYLIGHTNIX_HASH_CHUNK=1024*1024
+
+#: Linux `FICLONE` ioctl request code, see `ioctl_ficlone(2)`.
+FICLONE=0x40049409
+
+#: Archive suffixes recognized by
+#: [extract_archive](#pylightnix.utils.extract_archive). Single-file compressed
+#: formats are mapped to their decompressors.
+PYLIGHTNIX_ARCHIVE_SUFFIXES:Dict[str,Optional[Callable[...,Any]]]={
+  '.tar.gz':None, '.tar.bz2':None, '.tar.xz':None, '.tgz':None, '.tbz2':None,
+  '.txz':None, '.tar':None, '.zip':None,
+  '.gz':gzip_open, '.bz2':bz2_open, '.xz':lzma_open, '.lzma':lzma_open }
+
 #: Placeholder for self-reference
 PYLIGHTNIX_SELF_TAG = "__self__"
 
@@ -122,6 +140,25 @@ def datahash(data:Iterable[Tuple[str,bytes]],
     warning("datahash() was called with empty iterator")
   return Hash(e.hexdigest())
 
+def filechunks(path:str, chunk_size:int=PYLIGHTNIX_HASH_CHUNK)->Iterable[bytes]:
+  """ Read the file in chunks of at most `chunk_size` bytes. Empty files
+  produce a single empty chunk. """
+  with open(path,'rb') as f:
+    chunk=f.read(chunk_size)
+    yield chunk
+    while len(chunk)>0:
+      chunk=f.read(chunk_size)
+      if len(chunk)>0:
+        yield chunk
+
+def filedigest(path:str, mkhash:Callable[[],Any]=sha256)->str:
+  """ Calculate the hex digest of a file contents in constant memory. `mkhash`
+  should return a `hashlib`-compatible hash object. """
+  e=mkhash()
+  for chunk in filechunks(path):
+    e.update(chunk)
+  return e.hexdigest()
+
 def dirhash_iter(path:Path)->Iterable[Tuple[str,bytes]]:
   assert isdir(path), f"dirhash() expects directory path, not '{path}'"
   for root, dirs, filenames in walk(abspath(path), topdown=True):
@@ -130,28 +167,79 @@ def dirhash_iter(path:Path)->Iterable[Tuple[str,bytes]]:
         localpath=abspath(join(root, filename))
         if islink(localpath):
           yield (f'link:{localpath}',encode(readlink(localpath)))
-        with open(localpath,'rb') as f:
-          yield (localpath,f.read())
+        for chunk in filechunks(localpath):
+          yield (localpath,chunk)
+
+def dirhash_entries(path:Path)->Iterable[Tuple[str,str,bool]]:
+  """ Iterate over the files of a directory which are subject to hashing, in a
+  deterministic order. Yields tuples of the absolute path, the path relative to
+  `path`, and the symlink flag. """
+  assert isdir(path), f"dirhash() expects directory path, not '{path}'"
+  root_=abspath(path)
+  for root, dirs, filenames in walk(root_, topdown=True):
+    dirs.sort()
+    for filename in sorted(filenames):
+      if len(filename)>0 and filename[0] != '_':
+        localpath=join(root, filename)
+        yield (localpath, relpath(localpath, root_), islink(localpath))
+
+def dirhash_v1(paths:Iterable[Path], nworkers:Optional[int]=None,
+               verbose:bool=False)->Hash:
+  """ Calculate the version-1 hash of directories. Digests of individual files
+  are calculated on a pool of `nworkers` threads (Python's default pool size
+  if None). The resulting hash is a SHA256 of the list of relative file names,
+  symlink targets and file digests, so it does not depend on the pool
+  scheduling. """
+  entries=list(chain.from_iterable([dirhash_entries(p) for p in paths]))
+  def _digest(path:str)->bytes:
+    return bytes.fromhex(filedigest(path))
+  with ThreadPoolExecutor(max_workers=nworkers) as pool:
+    digests=pool.map(_digest, [e[0] for e in entries])
+    e=sha256()
+    for (localpath,rpath,link),digest in zip(entries,digests):
+      if link:
+        e.update(encode(f'link:{rpath}\0{readlink(localpath)}\0'))
+      else:
+        e.update(encode(f'file:{rpath}\0'))
+      e.update(digest)
+      if verbose:
+        debug(f'Adding {localpath}: {e.hexdigest()}')
+  return Hash(e.hexdigest())
 
-def dirshash(paths:Iterable[Path], verbose:bool=False)->Hash:
+def dirshash(paths:Iterable[Path], verbose:bool=False, version:int=0,
+             nworkers:Optional[int]=None)->Hash:
   """ Calculate recursive SHA256 hash of a directory. Ignore files with names
   starting with underscope ('_'). For symbolic links, hash the result of
-  `readlink(link)`.
+  `readlink(link)` followed by the contents of the target.
+
+  Two hashing schemes are supported:
+
+  * `version=0` hashes the concatenated contents of files in a single thread.
+    It is the default scheme of Pylightnix storages.
+  * `version=1` additionally hashes relative file names and processes files on
+    a thread pool of `nworkers` threads. See
+    [dirhash_v1](#pylightnix.utils.dirhash_v1).
+
+  Both schemes read files in chunks, so memory consumption doesn't depend on
+  file sizes.
 
-  FIXME: Include file/directory names the into hash data.
   FIXME: Figure out how does sha265sum handle symlinks and do the same thing.
-  FIXME: Stop loading whole files in memory for calculating hashes
   """
-  return datahash(chain.from_iterable([dirhash_iter(p) for p in paths]),
-                  verbose=verbose)
+  if version==0:
+    return datahash(chain.from_iterable([dirhash_iter(p) for p in paths]),
+                    verbose=verbose)
+  elif version==1:
+    return dirhash_v1(paths, nworkers=nworkers, verbose=verbose)
+  else:
+    assert False, f"Unsupported dirhash version {version}"
 
-def dirhash(path:Path, verbose:bool=False)->Hash:
-  return dirshash([path], verbose=verbose)
+def dirhash(path:Path, verbose:bool=False, version:int=0,
+            nworkers:Optional[int]=None)->Hash:
+  return dirshash([path], verbose=verbose, version=version, nworkers=nworkers)
 
 def filehash(path:Path)->Hash:
   assert isfile(path), f"filehash() expects a file path, not '{path}'"
-  with open(path,'rb') as f:
-    return datahash([(path,f.read())])
+  return datahash((path,chunk) for chunk in filechunks(path))
 
 def pyobjhash(pyobjs:List[Any])->Hash:
   """ Return the hash of the Python source code of the argument objects as a
@@ -168,44 +256,302 @@ def filero(f:Path)->None:
   assert isfile(f), f"'{f}' is not a file"
   chmod(f, stat(f)[ST_MODE] & ~(S_IWRITE | S_IWGRP | S_IWOTH))
 
+def dirchmod_(o:Path, setmask:int, clearmask:int, files:bool=True)->None:
+  """ Set bits of the `setmask` and clear bits of the `clearmask` in the
+  permissions of directory `o` and of everything inside it. Traverse the tree
+  with `scandir` once, issuing at most one `stat` and one `chmod` syscall per
+  entry, and skipping the `chmod` if the permissions already match. Leave file
+  permissions intact if `files` is False. """
+  symlinks=0
+  def _chmod(path:str, mode:int)->None:
+    mode2=(mode|setmask)&~clearmask
+    if mode2!=mode:
+      chmod(path, mode2)
+  def _walk(path:str)->None:
+    nonlocal symlinks
+    with scandir(path) as it:
+      for e in it:
+        if e.is_symlink():
+          symlinks+=1
+        elif e.is_dir(follow_symlinks=False):
+          _walk(e.path)
+          _chmod(e.path, e.stat(follow_symlinks=False).st_mode)
+        elif files:
+          _chmod(e.path, e.stat(follow_symlinks=False).st_mode)
+  _walk(o)
+  _chmod(o, stat(o).st_mode)
+  if symlinks>0:
+    warning(f"Pylightnix doesn't guarantee the consistency of {symlinks} "
+            f"symlinks found in '{o}'")
+
 def dirro(o:Path)->None:
-  for root, dirs, files in walk(o):
-    for d in dirs:
-      mode=stat(join(root, d))[ST_MODE]
-      chmod(join(root, d), mode & ~(S_IWRITE | S_IWGRP | S_IWOTH) )
-    for f in files:
-      if isfile(f):
-        filero(Path(join(root, f)))
-      if islink(f):
-        warning(f"Pylightnix doesn't guarantee the consistency of symlink '{f}'")
-  chmod(o, stat(o)[ST_MODE] & ~(S_IWRITE | S_IWGRP | S_IWOTH) )
+  """ Make the directory tree read-only """
+  dirchmod_(o, 0, S_IWRITE | S_IWGRP | S_IWOTH)
 
 def dirrw(o:Path)->None:
-  for root, dirs, files in walk(o):
-    for d in dirs:
-      mode=stat(join(root, d))[ST_MODE]
-      chmod(join(root, d), mode | (S_IWRITE) )
-    for f in files:
-      if isfile(f):
-        filerw(Path(join(root, f)))
-      if islink(f):
-        warning(f"Pylightnix doesn't guarantee the consistency of symlink '{f}'")
-  chmod(o, stat(o)[ST_MODE] | (S_IWRITE | S_IWGRP | S_IWOTH) )
-
+  """ Make the directory tree writable by the user """
+  dirchmod_(o, S_IWRITE, 0)
+
+def dirinodes(o:Path)->Dict[Tuple[int,int],int]:
+  """ Return the sizes of files of the directory tree `o`, keyed by their
+  `(st_dev,st_ino)` pairs, so that hardlinked files appear once. Symlinks are
+  skipped. """
+  acc:Dict[Tuple[int,int],int]={}
+  for dirpath, dirnames, filenames in walk(o):
+    for f in filenames:
+      st=lstat(join(dirpath, f))
+      if not S_ISLNK(st.st_mode):
+        acc[(st.st_dev,st.st_ino)]=st.st_size
+  return acc
 
-def dirsize(o:Path)->int:
-  """ Return size in bytes """
-  total_size=0
+def dirlinks(o:Path)->Dict[Tuple[int,int],Tuple[int,int,int]]:
+  """ Return the sizes, the link counts and the numbers of links found in the
+  directory tree `o` of its files, keyed by their `(st_dev,st_ino)` pairs.
+  Symlinks are skipped. """
+  acc:Dict[Tuple[int,int],Tuple[int,int,int]]={}
   for dirpath, dirnames, filenames in walk(o):
     for f in filenames:
-      fp=join(dirpath, f)
-      if not islink(fp):
-        total_size += getsize(fp)
-  return total_size
+      st=lstat(join(dirpath, f))
+      if not S_ISLNK(st.st_mode):
+        k=(st.st_dev,st.st_ino)
+        acc[k]=(st.st_size,st.st_nlink,acc[k][2]+1 if k in acc else 1)
+  return acc
+
+def dirsize(o:Path)->int:
+  """ Return size in bytes. Hardlinked files are counted once. """
+  return sum(dirinodes(o).values())
+
+def reflink(src:str, dst:str)->None:
+  """ Create a new file `dst` as a copy-on-write clone of `src`. Raise `OSError`
+  if the filesystem doesn't support cloning, `dst` is not created in this case.
+  """
+  with open(src,'rb') as fsrc, open(dst,'xb') as fdst:
+    try:
+      ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+      remove(dst)
+      raise
+
+def filecopy(src:str, dst:str, mkhash:Callable[[],Any]=sha256,
+             hardlink:bool=False)->str:
+  """ Copy file `src` to a new file `dst` and return the hex digest of the
+  contents, reading the data only once. If `hardlink` is True, try to link
+  `dst` to `src` first. Next, try to clone the file with
+  [reflink](#pylightnix.utils.reflink). In both cases the result is hashed
+  without copying. Otherwise, fall back to the streamed copy which updates the
+  hash on the fly. """
+  if hardlink:
+    try:
+      link(src,dst)
+      return filedigest(dst,mkhash)
+    except OSError:
+      pass
+  try:
+    reflink(src,dst)
+    return filedigest(dst,mkhash)
+  except OSError:
+    pass
+  e=mkhash()
+  with open(dst,'xb') as fdst:
+    for chunk in filechunks(src):
+      e.update(chunk)
+      fdst.write(chunk)
+  return e.hexdigest()
+
+def urldownload(url:str, path:str, mkhash:Callable[[],Any]=sha256,
+                nconnections:int=1, resume:bool=True,
+                timeout:Optional[float]=None)->str:
+  """ Download `url` into the file `path` using the Python standard library
+  and return the hex digest of the data. In the single-connection mode the
+  hash is updated while the data is streamed. If `resume` is True, an existing
+  `path` is treated as the beginning of the data and only the remainder is
+  requested using the HTTP `Range` header.
+
+  If `nconnections` is greater than one and the server accepts byte ranges,
+  the data is split into `nconnections` parts which are downloaded in
+  parallel into `path.N` files. Parts are resumed individually, then joined
+  into `path` and hashed in one pass. """
+  if nconnections>1:
+    with urlopen(Request(url, method='HEAD'), timeout=timeout) as resp:
+      size=int(resp.headers.get('Content-Length') or 0)
+      ranges=resp.headers.get('Accept-Ranges')
+    if ranges=='bytes' and size>=nconnections:
+      partsize=(size+nconnections-1)//nconnections
+      parts=[(f'{path}.{i}',i*partsize,min(size,(i+1)*partsize)-1)
+             for i in range(nconnections)]
+      def _part(ppath:str, start:int, end:int)->None:
+        have=getsize(ppath) if resume and isfile(ppath) else 0
+        if start+have>end:
+          return
+        req=Request(url, headers={'Range':f'bytes={start+have}-{end}'})
+        with urlopen(req, timeout=timeout) as resp, \
+             open(ppath,'ab' if have>0 else 'wb') as f:
+          assert resp.status==206, (
+            f"Expected partial content from '{url}', got '{resp.status}'")
+          for chunk in iter(partial(resp.read,PYLIGHTNIX_HASH_CHUNK),b''):
+            f.write(chunk)
+      with ThreadPoolExecutor(max_workers=nconnections) as ex:
+        list(ex.map(lambda p:_part(*p), parts))
+      e=mkhash()
+      with open(path,'wb') as f:
+        for ppath,_,_ in parts:
+          for chunk in filechunks(ppath):
+            e.update(chunk)
+            f.write(chunk)
+      assert getsize(path)==size, (
+        f"Expected {size} bytes from '{url}', got {getsize(path)}")
+      for ppath,_,_ in parts:
+        remove(ppath)
+      return e.hexdigest()
+
+  have=getsize(path) if resume and isfile(path) else 0
+  try:
+    resp=urlopen(Request(url, headers={'Range':f'bytes={have}-'}
+                         if have>0 else {}), timeout=timeout)
+  except HTTPError as err:
+    if err.code==416 and have>0:
+      # The range is not satisfiable: the file is already complete
+      return filedigest(path,mkhash)
+    raise
+  e=mkhash()
+  with resp:
+    if have>0 and resp.status==206:
+      for chunk in filechunks(path):
+        e.update(chunk)
+      mode='ab'
+    else:
+      mode='wb'
+    with open(path,mode) as fout:
+      for chunk in iter(partial(resp.read,PYLIGHTNIX_HASH_CHUNK),b''):
+        e.update(chunk)
+        fout.write(chunk)
+  return e.hexdigest()
+
+def getumask()->int:
+  """ Return the file mode creation mask of the process. """
+  m=umask(0)
+  umask(m)
+  return m
+
+def vmsize()->int:
+  """ Return the size of the virtual address space of the current process, in
+  bytes, as reported by `/proc/self/status`. Return 0 if it is not available.
+  """
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmSize:'):
+          return int(line.split()[1])*1024
+  except OSError:
+    pass
+  return 0
+
+def assert_tarmember_safe(m:TarInfo, path:str)->None:
+  """ Check that the tar member `m` stays within the folder `path` when
+  extracted. Absolute names, `..` components, links pointing outside of `path`
+  and device files are rejected. Symlinks already extracted into `path` are
+  resolved. Used where the `tarfile` extraction filters are not available. """
+  root=realpath(path)
+  def _inside(p:str)->bool:
+    p=realpath(p)
+    return p==root or p.startswith(root+'/')
+  assert not isabs(m.name) and '..' not in m.name.split('/') and \
+    _inside(join(root,dirname(m.name))), (
+    f"Archive member '{m.name}' points outside of '{path}'")
+  if m.issym():
+    assert not isabs(m.linkname) and \
+      _inside(join(root,dirname(m.name),m.linkname)), (
+      f"Archive symlink '{m.name}' points outside of '{path}'")
+  elif m.islnk():
+    assert not isabs(m.linkname) and _inside(join(root,m.linkname)), (
+      f"Archive hardlink '{m.name}' points outside of '{path}'")
+  assert m.isfile() or m.isdir() or m.issym() or m.islnk(), (
+    f"Archive member '{m.name}' is a special file")
+
+def extract_archive(path:str, dst:str, nworkers:int=1)->bool:
+  """ Extract the archive `path` into the directory `dst` in-process, using
+  `tarfile`, `zipfile`, `gzip`, `bz2` and `lzma` modules of the standard
+  library. Return False if the format is not recognized, leaving `dst`
+  untouched.
+
+  The placement follows the `aunpack` conventions: a single top-level entry is
+  put directly into `dst`, multiple entries are put into a sub-directory named
+  after the archive. Tar archives are extracted in a single streaming pass,
+  members of zip archives are extracted by `nworkers` threads. """
+  name=basename(path)
+  stem,decompress=name+'.out',None
+  for suffix,dec in PYLIGHTNIX_ARCHIVE_SUFFIXES.items():
+    if name.endswith(suffix) and len(name)>len(suffix):
+      stem,decompress=name[:-len(suffix)],dec
+      break
+  istar=is_tarfile(path)
+  iszip=(not istar) and is_zipfile(path)
+  if not (istar or iszip or decompress is not None):
+    return False
+  tmp=mkdtemp(dir=dst, prefix='.unpack')
+  try:
+    # mkdtemp creates the folder with 0700 permissions, which would stick
+    # after the rename below
+    chmod(tmp, 0o777 & ~getumask())
+    if istar:
+      with tarfile_open(path,'r|*') as t:
+        try:
+          t.extractall(tmp, filter='data') # type:ignore
+        except TypeError:
+          # Older Pythons have no extraction filters
+          for m in t:
+            assert_tarmember_safe(m,tmp)
+            t.extract(m, tmp, set_attrs=not m.isdir())
+    elif iszip:
+      with ZipFile(path) as z:
+        names=z.namelist()
+        for n in names:
+          # Create the directories beforehand to avoid races between workers
+          d=normpath(join(tmp,dirname(n)))
+          if d.startswith(tmp):
+            makedirs(d, exist_ok=True)
+      def _extract(names_:List[str])->None:
+        with ZipFile(path) as z:
+          for n in names_:
+            if not n.endswith('/'):
+              # ZipFile doesn't restore the unix permissions, unlike unzip
+              mode=(z.getinfo(n).external_attr>>16)&0o777
+              p=z.extract(n,tmp)
+              if mode!=0:
+                chmod(p,mode)
+      with ThreadPoolExecutor(max_workers=nworkers) as ex:
+        list(ex.map(_extract, [names[i::nworkers] for i in range(nworkers)]))
+    else:
+      assert decompress is not None
+      with decompress(path,'rb') as fi, open(join(tmp,stem),'xb') as fo:
+        copyfileobj(fi, fo, PYLIGHTNIX_HASH_CHUNK)
+    entries=listdir(tmp)
+    if len(entries)==1:
+      assert not islink(join(dst,entries[0])) and \
+             not isdir(join(dst,entries[0])) and \
+             not isfile(join(dst,entries[0])), \
+        f"Can't extract '{entries[0]}' into '{dst}': the path exists"
+      rename(join(tmp,entries[0]), join(dst,entries[0]))
+    else:
+      assert not isdir(join(dst,stem)) and not isfile(join(dst,stem)), \
+        f"Can't extract '{name}' into '{dst}': the '{stem}' path exists"
+      rename(tmp, join(dst,stem))
+  finally:
+    if isdir(tmp):
+      dirrm(Path(tmp))
+  return True
 
 def dirchmod(o:Path, mode:str)->None:
+  """ Change the permissions of a directory tree. Supported modes are:
+  * `'ro'` makes the whole tree read-only.
+  * `'rotop'` makes only the top directory read-only, which protects it from
+    being renamed, removed or populated with new entries.
+  * `'rw'` makes the whole tree writable.
+  """
   if mode=='ro':
     dirro(o)
+  elif mode=='rotop':
+    chmod(o, stat(o).st_mode & ~(S_IWRITE | S_IWGRP | S_IWOTH))
   elif mode=='rw':
     dirrw(o)
   else:
@@ -213,17 +559,51 @@ def dirchmod(o:Path, mode:str)->None:
 
 def dirrm(path:Path, ignore_not_found:bool=True)->None:
   """ Powerful folder remover. Firts rename it to the temporary name. Deal with
-  possible write-protection. """
+  possible write-protection: write permissions are added to directories on
+  demand, file permissions are not changed because files may be shared with
+  other folders by hardlinks. """
   # FIXME: May fail with 'Directory not empty' if tmppath is not empty.
+  def _onerror(func, p, exc_info)->None:
+    if not issubclass(exc_info[0],PermissionError):
+      raise exc_info[1]
+    parent=dirname(p)
+    chmod(parent, stat(parent).st_mode | S_IWRITE)
+    func(p)
   try:
     tmppath=Path(path+'.tmp')
     rename(path,tmppath)
-    dirrw(tmppath)
-    rmtree(tmppath)
+    chmod(tmppath, stat(tmppath).st_mode | S_IWRITE)
+    rmtree(tmppath, onerror=_onerror)
   except FileNotFoundError:
     if not ignore_not_found:
       raise
 
+def dirclone(src:Path, dst:Path, hardlink:bool=True)->None:
+  """ Re-create the directory tree `src` as a new directory `dst`. Files are
+  hardlinked if `hardlink` is True and both trees reside on the same
+  filesystem. Otherwise, files are cloned with
+  [reflink](#pylightnix.utils.reflink) or copied. Symlinks are re-created as
+  they are. """
+  mkdir(dst)
+  with scandir(src) as it:
+    for e in it:
+      d=join(dst,e.name)
+      if e.is_symlink():
+        symlink(readlink(e.path),d)
+      elif e.is_dir(follow_symlinks=False):
+        dirclone(Path(e.path),Path(d),hardlink)
+      else:
+        if hardlink:
+          try:
+            link(e.path,d)
+            continue
+          except OSError:
+            pass
+        try:
+          reflink(e.path,d)
+        except OSError:
+          shutil_copy(e.path,d)
+
 def dircp(src:Path, dst:Path, make_rw:bool=False)->None:
   """ Powerful folder copyier. """
   assert isdir(src)
@@ -253,7 +633,7 @@ def isselfpath(p:Any)->bool:
     p[0]==PYLIGHTNIX_SELF_TAG
 
 def isclosure(x:Any)->bool:
-  return isinstance(x,tuple) and len(x)==4 and \
+  return isinstance(x,tuple) and len(x)==5 and \
          isinstance(x[2],list) and all([isdref(r) for r in x[1]]) and \
          isinstance(x[2],list)
 
@@ -371,6 +751,53 @@ def trycatch(f:Callable[[],_A], default:_A, mp:Callable[[_A],_B])->_B:
   except Exception:
     return mp(default)
 
+class LRUCache:
+  """ A bounded key-value cache which evicts least-recently used entries.
+  Operations are guarded by a lock, so the cache may be shared between
+  threads. `hits` and `misses` count the outcomes of
+  [get](#pylightnix.utils.LRUCache.get) calls. """
+  def __init__(self, maxsize:int)->None:
+    assert maxsize>=0, f"Cache size should be non-negative, not {maxsize}"
+    self.maxsize=maxsize
+    self.hits=0
+    self.misses=0
+    self._data:OrderedDict=OrderedDict()
+    self._lock=Lock()
+
+  def get(self, key:Any, default:Any=None)->Any:
+    with self._lock:
+      if key in self._data:
+        self._data.move_to_end(key)
+        self.hits+=1
+        return self._data[key]
+      self.misses+=1
+      return default
+
+  def put(self, key:Any, val:Any)->None:
+    with self._lock:
+      if self.maxsize==0:
+        return
+      self._data[key]=val
+      self._data.move_to_end(key)
+      while len(self._data)>self.maxsize:
+        self._data.popitem(last=False)
+
+  def invalidate(self, pred:Callable[[Any],bool])->None:
+    """ Drop the entries which keys satisfy the predicate `pred` """
+    with self._lock:
+      for key in [k for k in self._data if pred(k)]:
+        del self._data[key]
+
+  def clear(self)->None:
+    """ Drop all the entries and reset the counters """
+    with self._lock:
+      self._data.clear()
+      self.hits=0
+      self.misses=0
+
+  def __len__(self)->int:
+    return len(self._data)
+
 def tryreadjson(json_path:str)->Optional[Any]:
   none:Optional[Any]=None
   return trycatch(partial(readjson,json_path=json_path),none,lambda x:x)
@@ -1,9 +1,10 @@
-from os import (makedirs, replace, listdir, stat, chmod, system, environ,
-                remove, readlink)
+from os import (makedirs, utime, replace, listdir, stat, chmod, system, environ,
+                remove, readlink, symlink, pipe as os_pipe, walk, getpid,
+                _exit as os_exit)
 from stat import S_IEXEC, S_IWRITE, S_IREAD
 from os.path import (basename, join, isfile, isdir, islink, relpath, abspath,
-                     dirname )
-from shutil import rmtree
+                     dirname, getsize )
+from shutil import rmtree, copy as shutil_copy
 
 from hypothesis import (given, assume, example, note, settings, event,
                         HealthCheck, reproduce_failure, Phase, Verbosity)
@@ -29,15 +30,27 @@ from calendar import timegm
 
 from random import randint
 
-from time import sleep
+from time import sleep, perf_counter, time
 
 from functools import partial
 
 from inspect import stack as inspect_stack
 
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from threading import Thread, Barrier, Lock
+
+from tarfile import (open as tarfile_open, TarInfo, SYMTYPE, LNKTYPE,
+                     CHRTYPE)
+from multiprocessing import get_context as mp_get_context
+from socket import gethostname, socket
+from json import load as json_load, dump as json_dump
+from logging import getLogger
+from asyncio import (run as asyncio_run, sleep as asyncio_sleep, wait_for,
+                     Event as AsyncEvent, create_task, CancelledError)
+from itertools import chain
+from errno import EXDEV
+
 def get_executable(name:str, not_found_message:str)->str:
   e=find_executable(name)
   assert e is not None, not_found_message
   return e
-
-
@@ -11,7 +11,9 @@ from pylightnix import (Registry, Build, Path, fsinit, DRef, Context,
 from tests.imports import (rmtree, join, makedirs, listdir, Callable,
                            contextmanager, List, Dict,  Popen, PIPE, gettempdir,
                            mkdtemp, remove, settings, HealthCheck,
-                           inspect_stack)
+                           inspect_stack, ThreadingHTTPServer,
+                           SimpleHTTPRequestHandler, Thread, isfile, getsize,
+                           partial)
 
 
 
@@ -85,13 +87,14 @@ def mkstage(config:dict,
             nmatch:int=1,
             mustfail:bool=False,
             S:Optional[StorageSettings]=None,
+            resources:Optional[Dict[str,float]]=None,
             )->DRef:
   """ Sets up a test stage """
   return mkdrv(setup_test_config(config),
                output_matcher(setup_test_match(nmatch)),
                output_realizer(setup_test_realize(
                  nrrefs, starttime, nondet, mustfail)),
-               r)
+               r, resources)
 
 def pipe_stdout(args:List[str], **kwargs)->str:
   return Popen(args, stdout=PIPE, **kwargs).stdout.read().decode() # type:ignore
@@ -123,3 +126,58 @@ def mkstageP(config:dict,
 
 def callername()->str:
    return inspect_stack()[1][3]
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+  """ Static file handler which supports single HTTP byte ranges. Received
+  `Range` headers are recorded in `server.ranges`. """
+  def _serve(self, body:bool)->None:
+    path=self.translate_path(self.path)
+    if not isfile(path):
+      self.send_error(404)
+      return
+    size=getsize(path)
+    start,end,status=0,size-1,200
+    rng=self.headers.get('Range')
+    self.server.ranges.append(rng) # type:ignore
+    if rng is not None:
+      a,b=rng[len('bytes='):].split('-')
+      start,end,status=int(a),(int(b) if b else size-1),206
+      if start>=size:
+        self.send_error(416)
+        return
+    self.send_response(status)
+    self.send_header('Accept-Ranges','bytes')
+    self.send_header('Content-Length',str(end-start+1))
+    if status==206:
+      self.send_header('Content-Range',f'bytes {start}-{end}/{size}')
+    self.end_headers()
+    if body:
+      with open(path,'rb') as f:
+        f.seek(start)
+        self.wfile.write(f.read(end-start+1))
+
+  def do_GET(self)->None:
+    self._serve(True)
+
+  def do_HEAD(self)->None:
+    self._serve(False)
+
+  def log_message(self, *args)->None:
+    pass
+
+@contextmanager
+def setup_httpserver(root:str):
+  """ Serve files of the `root` directory over HTTP on a random local port.
+  Yield the server, its URL is `server.url` """
+  server=ThreadingHTTPServer(('127.0.0.1',0),
+                             partial(RangeRequestHandler, directory=root))
+  server.ranges=[] # type:ignore
+  server.url=f"http://127.0.0.1:{server.server_address[1]}" # type:ignore
+  t=Thread(target=server.serve_forever, daemon=True)
+  t.start()
+  try:
+    yield server
+  finally:
+    server.shutdown()
+    server.server_close()
@@ -4,20 +4,29 @@ from pylightnix import (instantiate, DRef, RRef, Path, mklogdir, dirhash,
                         Registry, mkcontext, mkdref, mkrref, unrref, undref,
                         realize1, rref2dref, mkconfig, Build, Context,
                         build_outpath, mkdrv, rref2path, alldrefs,
-                        selfref, allrrefs, realizeMany, fstmpdir)
+                        selfref, allrrefs, realizeMany, fstmpdir, dirchmod,
+                        rrefdeps, store_reindex, drefrrefs, realize,
+                        fsconfig_update, realizeParallel, fsstorage,
+                        dref2path, fsconfig)
 
 from tests.imports import (given, Any, Callable, join, Optional, islink,
                            isfile, islink, List, randint, sleep, rmtree,
                            system, S_IWRITE, S_IREAD, S_IEXEC, chmod, Popen,
-                           PIPE, settings, reproduce_failure, Phase, note)
+                           PIPE, settings, reproduce_failure, Phase, note,
+                           listdir, isdir, stat, Thread, os_pipe,
+                           walk, tarfile_open, socket, environ, json_load,
+                           time, basename, json_dump, shutil_copy)
 
 from tests.generators import (
     rrefs, drefs, configs, dicts, rootstages )
 
 from tests.setup import ( ShouldHaveFailed, setup_storage2, mkstage, mkstage,
-                         pipe_stdout )
+                         pipe_stdout, setup_httpserver )
 
-from pylightnix.arch import (spack,sunpack)
+from pylightnix.arch import (spack,sunpack,spack_stream,sunpack_stream,
+                             copyclosure, store_sync, store_sync_recv,
+                             store_publish, substitute)
+from io import BytesIO
 
 
 
@@ -76,3 +85,316 @@ def test_pack2(stages)->None:
   assert set(allrrefs(S=S1)) == set(allrrefs(S=S2))
   note('OK!')
 
+
+
+@settings(max_examples=10, phases=[Phase.generate])
+@given(stages=rootstages())
+def test_pack_native(stages)->None:
+  archives=[]
+  closure=set()
+  with setup_storage2('test_pack_native_src') as S1:
+    for nstage,stage in enumerate(stages):
+      rrefs=realizeMany(instantiate(stage,S=S1))
+      for nrref,rref in enumerate(rrefs):
+        ap=Path(join(fstmpdir(S1),f'archive_{nstage:02d}_{nrref:02d}.tar.xz'))
+        spack([rref], ap, S=S1)
+        archives.append(ap)
+        closure|=rrefdeps([rref],S1)|{rref}
+
+    with setup_storage2('test_pack_native_dst') as S2:
+      store_reindex(S2)
+      for ap in archives:
+        sunpack(Path(ap), S=S2)
+        sunpack(Path(ap), S=S2)
+      assert set(alldrefs(S=S1)) == set(alldrefs(S=S2))
+      assert closure == set(allrrefs(S=S2))
+      store_reindex(S2)
+      assert closure == set(allrrefs(S=S2))
+
+
+def test_pack_native_corrupted()->None:
+  with setup_storage2('test_pack_corrupted_src') as S1, \
+       setup_storage2('test_pack_corrupted_dst') as S2:
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+      return mkstage({'name':'n2', 'maman':s1,
+                      'promise':[selfref,'artifact']}, r)
+    rref2=realize1(instantiate(_stage,S=S1))
+    [rref1]=list(rrefdeps([rref2],S1))
+    dirchmod(rref2path(rref2,S1),'rw')
+    with open(join(rref2path(rref2,S1),'artifact'),'w') as f:
+      f.write('corrupted')
+    buf=BytesIO()
+    spack_stream([rref2], buf, 'gz', S=S1)
+    buf.seek(0)
+    try:
+      sunpack_stream(buf, S=S2)
+      raise ShouldHaveFailed('Corrupted realization was unpacked')
+    except AssertionError:
+      pass
+    assert set(allrrefs(S=S2))==set()
+    assert [f for f in listdir(fsstorage(S2)) if f.endswith('.tmp')]==[]
+
+def test_pack_dedup()->None:
+  with setup_storage2('test_pack_dedup_src') as S1, \
+       setup_storage2('test_pack_dedup_dst') as S2:
+    fsconfig_update(S1,dedup='hardlink',dedup_min_size=0)
+    r1=realize1(instantiate(mkstage,{'name':'1'},nondet=lambda i:42,S=S1))
+    r2=realize1(instantiate(mkstage,{'name':'2'},nondet=lambda i:42,S=S1))
+    assert stat(join(rref2path(r1,S1),'artifact')).st_ino== \
+           stat(join(rref2path(r2,S1),'artifact')).st_ino
+    ap=Path(join(fstmpdir(S1),'archive.tar'))
+    spack([r1,r2], ap, S=S1)
+    sunpack(ap, S=S2)
+    assert set(allrrefs(S2))=={r1,r2}
+    for rref in [r1,r2]:
+      with open(join(rref2path(rref,S2),'artifact')) as f:
+        assert f.read()=='42'
+
+
+def test_copyclosure()->None:
+  with setup_storage2('test_copyclosure_src') as S1, \
+       setup_storage2('test_copyclosure_dst') as S2, \
+       setup_storage2('test_copyclosure_dst2') as S3:
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+      s2=mkstage({'name':'n2', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+      s3=mkstage({'name':'n3', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+      return [s2,s3]
+    _,_,ctx=realize(instantiate(_stage,S=S1))
+    roots=[rrefs[0] for d,rrefs in ctx.items()
+           if 'n1' not in d and rrefs is not None]
+    store_reindex(S2)
+    copyclosure(roots,S1,S2)
+    assert set(allrrefs(S2))==set(allrrefs(S1))
+    assert set(alldrefs(S2))==set(alldrefs(S1))
+    for rref in allrrefs(S1):
+      a1=join(rref2path(rref,S1),'artifact')
+      assert stat(a1).st_ino==stat(join(rref2path(rref,S2),'artifact')).st_ino
+    copyclosure(roots,S1,S2)
+    store_reindex(S2)
+    assert set(allrrefs(S2))==set(allrrefs(S1))
+    copyclosure(roots[:1],S1,S3,hardlink=False)
+    assert set(allrrefs(S3))==rrefdeps(roots[:1],S1)|set(roots[:1])
+    for rref in allrrefs(S3):
+      a1=join(rref2path(rref,S1),'artifact')
+      assert stat(a1).st_ino!=stat(join(rref2path(rref,S3),'artifact')).st_ino
+
+def test_store_sync()->None:
+  with setup_storage2('test_store_sync_src') as S1, \
+       setup_storage2('test_store_sync_dst') as S2:
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+      s2=mkstage({'name':'n2', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+      s3=mkstage({'name':'n3', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+      return [s2,s3]
+    _,_,ctx=realize(instantiate(_stage,S=S1))
+    roots=sorted([rrefs[0] for d,rrefs in ctx.items()
+                  if 'n1' not in d and rrefs is not None])
+
+    def _sync(roots_:List[RRef], compression:str)->List[RRef]:
+      r1,w1=os_pipe(); r2,w2=os_pipe()
+      with open(r1,'rb') as fin1, open(w1,'wb') as fout1, \
+           open(r2,'rb') as fin2, open(w2,'wb') as fout2:
+        t=Thread(target=store_sync_recv, args=(fin1,fout2,S2))
+        t.start()
+        received=store_sync(roots_,S1,(fin2,fout1),compression)
+        t.join()
+      return received
+
+    received=_sync(roots[:1],'')
+    assert set(received)==rrefdeps(roots[:1],S1)|set(roots[:1])
+    assert set(allrrefs(S2))==set(received)
+    received=_sync(roots,'gz')
+    assert received==[roots[1]]
+    assert set(allrrefs(S2))==set(allrrefs(S1))
+    assert set(alldrefs(S2))==set(alldrefs(S1))
+    assert _sync(roots,'')==[]
+    for rref in allrrefs(S1):
+      with open(join(rref2path(rref,S1),'artifact')) as f1, \
+           open(join(rref2path(rref,S2),'artifact')) as f2:
+        assert f1.read()==f2.read()
+
+def test_store_sync_local()->None:
+  with setup_storage2('test_store_sync_local_src') as S1, \
+       setup_storage2('test_store_sync_local_dst') as S2:
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+      return mkstage({'name':'n2', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+    rref=realize1(instantiate(_stage,S=S1))
+    assert set(store_sync([rref],S1,S2))==set(allrrefs(S1))
+    assert store_sync([rref],S1,S2)==[]
+
+def test_store_sync_dedup()->None:
+  with setup_storage2('test_store_sync_dedup_src') as S1, \
+       setup_storage2('test_store_sync_dedup_dst') as S2:
+    fsconfig_update(S1,dedup='hardlink',dedup_min_size=0)
+    rref1=realize1(instantiate(mkstage,{'name':'1'},nondet=lambda i:42,S=S1))
+    rref2=realize1(instantiate(mkstage,{'name':'2'},nondet=lambda i:42,S=S1))
+    r1,w1=os_pipe(); r2,w2=os_pipe()
+    with open(r1,'rb') as fin1, open(w1,'wb') as fout1, \
+         open(r2,'rb') as fin2, open(w2,'wb') as fout2:
+      t=Thread(target=store_sync_recv, args=(fin1,fout2,S2))
+      t.start()
+      received=store_sync([rref1,rref2],S1,(fin2,fout1))
+      t.join()
+    assert set(received)=={rref1,rref2}
+    assert set(allrrefs(S2))=={rref1,rref2}
+    for rref in [rref1,rref2]:
+      with open(join(rref2path(rref,S2),'artifact')) as f:
+        assert f.read()=='42'
+
+def test_substitute()->None:
+  with setup_storage2('test_substitute_src') as S1, \
+       setup_storage2('test_substitute_dst') as S2, \
+       setup_storage2('test_substitute_dst2') as S3, \
+       setup_storage2('test_substitute_cache') as C:
+    cache=fsstorage(C)
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+      return mkstage({'name':'n2', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+    def _stage3(r):
+      return mkstage({'name':'n3', 'papa':_stage(r),
+                      'promise':[selfref,'artifact']}, r)
+    rref=realize1(instantiate(_stage,S=S1))
+    store_publish(allrrefs(S1),cache,S=S1)
+    assert substitute(cache,rref2dref(rref),{},S2)==[]
+
+    fsconfig_update(S2,substituters=[cache])
+    _,_,ctx=realize(instantiate(_stage3,S=S2))
+    assert rref in set(allrrefs(S2))
+    assert set(allrrefs(S1))<=set(allrrefs(S2))
+    assert len(set(allrrefs(S2)))==len(set(allrrefs(S1)))+1
+
+    with setup_httpserver(cache) as server:
+      fsconfig_update(S3,substituters=['http://127.0.0.1:1/none',server.url])
+      _,_,ctx=realizeParallel(instantiate(_stage,S=S3))
+      assert set(allrrefs(S3))==set(allrrefs(S1))
+
+def test_substitute_dedup()->None:
+  with setup_storage2('test_substitute_dedup_src') as S1, \
+       setup_storage2('test_substitute_dedup_dst') as S2, \
+       setup_storage2('test_substitute_dedup_cache') as C:
+    cache=fsstorage(C)
+    fsconfig_update(S1,dedup='hardlink',dedup_min_size=0)
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r,
+                 nondet=lambda i:42)
+      return mkstage({'name':'n2', 'maman':s1,
+                      'promise':[selfref,'artifact']}, r, nondet=lambda i:42)
+    rref2=realize1(instantiate(_stage,S=S1))
+    [rref1]=list(rrefdeps([rref2],S1))
+    assert stat(join(rref2path(rref1,S1),'artifact')).st_ino== \
+           stat(join(rref2path(rref2,S1),'artifact')).st_ino
+    store_publish(allrrefs(S1),cache,S=S1)
+    fsconfig_update(S2,substituters=[cache])
+    assert realize1(instantiate(_stage,S=S2))==rref2
+    assert set(allrrefs(S2))=={rref1,rref2}
+    for rref in [rref1,rref2]:
+      with open(join(rref2path(rref,S2),'artifact')) as f:
+        assert f.read()=='42'
+
+def test_substitute_corrupted()->None:
+  with setup_storage2('test_substitute_corrupted_src') as S1, \
+       setup_storage2('test_substitute_corrupted_dst') as S2, \
+       setup_storage2('test_substitute_corrupted_cache') as C:
+    cache=fsstorage(C)
+    def _stage(r):
+      return mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+    rref=realize1(instantiate(_stage,S=S1))
+    store_publish([rref],cache,compression='',S=S1)
+    archive=[join(root,f) for root,_,files in walk(cache)
+             for f in files if f.endswith('.tar')][0]
+    with tarfile_open(archive) as t:
+      offset=[m.offset_data for m in t.getmembers()
+              if m.name.endswith('/artifact')][0]
+    with open(archive,'r+b') as f:
+      f.seek(offset)
+      f.write(b'X')
+    fsconfig_update(S2,substituters=[cache])
+    rref2=realize1(instantiate(_stage,S=S2))
+    assert rref2==rref # Rebuilt locally, the test realizer is deterministic
+    rhash,_,_=unrref(rref2)
+    assert sorted(listdir(dref2path(rref2dref(rref2),S2)))==\
+      sorted(['config.json',rhash])
+
+def test_substitute_mismatch()->None:
+  with setup_storage2('test_substitute_mismatch_src') as S1, \
+       setup_storage2('test_substitute_mismatch_dst') as S2, \
+       setup_storage2('test_substitute_mismatch_cache') as C:
+    cache=fsstorage(C)
+    def _stage(r):
+      s1=mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+      return mkstage({'name':'n2', 'maman':s1, 'promise':[selfref,'artifact']}, r)
+    rref=realize1(instantiate(_stage,S=S1))
+    rref1=[r for r in allrrefs(S1) if r!=rref][0]
+    store_publish(allrrefs(S1),cache,S=S1)
+    folder=join(cache,basename(dref2path(rref2dref(rref),S1)))
+    folder1=join(cache,basename(dref2path(rref2dref(rref1),S1)))
+    index_path=join(folder,'index.json')
+    with open(index_path) as f:
+      index=json_load(f)
+    context=index['rrefs'][rref]['context']
+
+    index['rrefs'][rref]['context']={}
+    with open(index_path,'w') as f:
+      json_dump(index,f)
+    try:
+      substitute(cache,rref2dref(rref),{},S2)
+      raise ShouldHaveFailed('Context mismatch should be detected')
+    except AssertionError:
+      pass
+    assert list(allrrefs(S2))==[] and list(alldrefs(S2))==[]
+
+    archive=index['rrefs'][rref]['archive']
+    shutil_copy(join(folder1,archive.replace(unrref(rref)[0],
+                                             unrref(rref1)[0])),
+                join(folder,archive))
+    index['rrefs'][rref]['context']=context
+    with open(index_path,'w') as f:
+      json_dump(index,f)
+    try:
+      substitute(cache,rref2dref(rref),context,S2)
+      raise ShouldHaveFailed('Roots mismatch should be detected')
+    except AssertionError:
+      pass
+    assert list(allrrefs(S2))==[] and list(alldrefs(S2))==[]
+
+def test_substitute_timeout()->None:
+  with setup_storage2('test_substitute_timeout') as S:
+    def _stage(r):
+      return mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r)
+    with socket() as sock:
+      sock.bind(('127.0.0.1',0))
+      sock.listen(1) # Accepts connections, but never responds
+      url=f"http://127.0.0.1:{sock.getsockname()[1]}"
+      fsconfig_update(S,substituters=[url],substituters_timeout=0.5)
+      t0=time()
+      realize1(instantiate(_stage,S=S))
+      assert time()-t0<10
+
+def test_substitute_environ()->None:
+  with setup_storage2('test_substitute_environ') as S:
+    assert fsconfig(S)['substituters']==[]
+    environ['PYLIGHTNIX_SUBSTITUTERS']='/a /b'
+    try:
+      assert fsconfig(S)['substituters']==['/a','/b']
+    finally:
+      del environ['PYLIGHTNIX_SUBSTITUTERS']
+
+def test_publish_concurrent()->None:
+  with setup_storage2('test_publish_concurrent') as S, \
+       setup_storage2('test_publish_concurrent_cache') as C:
+    cache=fsstorage(C)
+    def _stage(r):
+      return mkstage({'name':'n1', 'promise':[selfref,'artifact']}, r,
+                     nondet=lambda n:n, nrrefs=8, nmatch=8)
+    rrefs=realizeMany(instantiate(_stage,S=S))
+    assert len(set(rrefs))==8
+    ts=[Thread(target=store_publish, args=([rref],cache), kwargs={'S':S})
+        for rref in rrefs]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    folder=join(cache,basename(dref2path(rref2dref(rrefs[0]),S)))
+    with open(join(folder,'index.json')) as f:
+      assert set(json_load(f)['rrefs'].keys())==set(rrefs)
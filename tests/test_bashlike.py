@@ -4,7 +4,8 @@ from pylightnix import (DRef, RRef, lsref, catref, instantiate, realize1,
                         repl_build, build_outpath, find, diff, timestring,
                         parsetime, linkdref, linkrref, linkrrefs, readlink,
                         undref, islink, rrefbstart, fstmpdir, Stage, Optional,
-                        Registry)
+                        Registry, store_reindex, hasstoredb, alldrefs,
+                        allrrefs, alldrefs_, drefrrefs)
 
 from tests.setup import (ShouldHaveFailed, mkstage, mkstage,
                          setup_storage2 )
@@ -124,6 +125,30 @@ def test_find():
     # rrefs=find(newer=now)
     # assert rrefs==[rref2]
 
+def test_storedb():
+  with setup_storage2('test_storedb') as S:
+    s1=wrapstage(config={'name':'1'}, nondet=lambda i:42)
+    s2=wrapstage(config={'name':'2'}, nondet=lambda i:33)
+    rref1=realize1(instantiate(s1,S=S))
+    usage=du(S=S)
+    assert not hasstoredb(S)
+    store_reindex(S)
+    assert hasstoredb(S)
+    assert du(S=S)==usage
+    rref2=realize1(instantiate(s2,S=S))
+    assert set(alldrefs(S))==set(alldrefs_(S))
+    assert set(allrrefs(S))=={rref1,rref2}
+    assert find(name='2',S=S)==[rref2]
+    usage=du(S=S)
+    assert usage[rref2dref(rref2)][1][rref2]>0
+    rmref(rref2dref(rref2),S=S)
+    assert set(allrrefs(S))=={rref1}
+    assert set(alldrefs(S))=={rref2dref(rref1)}
+    rmref(rref1,S=S)
+    assert set(allrrefs(S))==set()
+    store_reindex(S)
+    assert set(alldrefs(S))=={rref2dref(rref1)}
+
 def test_diff():
   with setup_storage2('test_diff') as S:
     s1=wrapstage(config={'name':'1'},nondet=lambda i:42)
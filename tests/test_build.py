@@ -8,11 +8,12 @@ from pylightnix import (instantiate, DRef, RRef, Path, mklogdir, dirhash,
                         build_cattrs, build_name, tryread, trywrite, match_only,
                         realizeMany, build_outpaths, scanref_dict, cfgdict,
                         mklens, isrref, Config, partial,
-                        path2rref, BuildError)
+                        path2rref, BuildError, build_pool_shutdown,
+                        build_pool)
 
 from tests.imports import ( given, Any, Callable, join, Optional, islink,
     isfile, List, randint, sleep, rmtree, system, S_IWRITE, S_IREAD, S_IEXEC,
-    chmod, Popen, PIPE )
+    chmod, Popen, PIPE, getpid, os_exit, getLogger )
 
 from tests.generators import (
     rrefs, drefs, configs, dicts )
@@ -96,3 +97,53 @@ def test_build_exception()->None:
       assert e.dref==clo.targets[0]
       assert str(e.exception)=='An intended failure'
 
+
+
+def _isolated_realize(b:Build)->None:
+  getLogger('tests.isolated').warning(f"Building {b.dref}")
+  if build_cattrs(b).mode=='fail':
+    raise ValueError("An intended failure")
+  if build_cattrs(b).mode=='crash':
+    os_exit(3)
+  with open(join(build_outpath(b),'pid'),'w') as f:
+    f.write(str(getpid()))
+
+def test_build_isolated(caplog)->None:
+  with setup_storage2('test_build_isolated') as S:
+    def _stage(mode:str, r:Optional[Registry]=None)->DRef:
+      return mkdrv(mkconfig({'mode':mode}), match_only(),
+                   build_wrapper(_isolated_realize, isolation='process'), r)
+    build_pool_shutdown()
+    pool=build_pool(max_workers=2, preload=['json'])
+    try:
+      assert build_pool()==pool
+      assert build_pool(max_workers=2, preload=['json'])==pool
+      for kwargs in [{'max_workers':3},{'preload':[]}]:
+        try:
+          build_pool(**kwargs) # type:ignore
+          raise ShouldHaveFailed(f"Running pool doesn't match {kwargs}")
+        except AssertionError:
+          pass
+      rref1=realize1(instantiate(_stage,'ok',S=S))
+      pid=tryread(Path(join(rref2path(rref1,S),'pid')))
+      assert pid is not None and int(pid)!=getpid()
+      assert any('Building' in r.getMessage() for r in caplog.records
+                 if r.name=='tests.isolated')
+      for mode in ['fail','crash']:
+        try:
+          realize1(instantiate(_stage,mode,S=S))
+          raise ShouldHaveFailed(f"Mode {mode} should fail")
+        except BuildError as e:
+          if mode=='fail':
+            assert isinstance(e.exception, ValueError)
+      rref2=realize1(instantiate(_stage,'ok2',S=S))
+      assert tryread(Path(join(rref2path(rref2,S),'pid'))) is not None
+    finally:
+      build_pool_shutdown()
+
+def test_build_isolated_pickle()->None:
+  try:
+    build_wrapper(lambda b: None, isolation='process')
+    raise ShouldHaveFailed("Lambdas can't be pickled")
+  except AssertionError as e:
+    assert 'pickle' in str(e)
@@ -12,12 +12,17 @@ from pylightnix import (instantiate, DRef, RRef, Path, SPath, mklogdir, dirhash,
                         linkdref, rrefdeps, drefrrefs, allrrefs, match_only,
                         drefrrefs, drefrrefsC, rrefctx, context_deref,
                         rrefattrs, rrefbstart, fsstorage, current_registry,
-                        realize, current_storage, Tuple)
+                        realize, current_storage, Tuple, metacache_stats,
+                        rmref, drefcfg_, fsinit, fsconfig, gc, linkrref,
+                        fstmpdir, gc_evict, rrefatime, du, fsconfig_update,
+                        store_dedup, fsblobs, dirsize, fsconfigpath,
+                        store_reindex)
 
 from tests.imports import (given, Any, Callable, join, Optional, islink, isfile,
                            islink, isdir, dirname, List, randint, sleep, rmtree,
                            system, S_IWRITE, S_IREAD, S_IEXEC, chmod, Popen,
-                           PIPE, data, readlink)
+                           PIPE, data, readlink, makedirs, utime, stat,
+                           listdir, EXDEV, json_dump, replace)
 
 from tests.generators import (rrefs, drefs, configs, dicts, rootstages,
                               settings)
@@ -325,6 +330,113 @@ def test_gc_semantics()->None:
     assert rm_rrefs=={r3}
 
 
+def test_gc()->None:
+  with setup_storage2('test_gc') as S:
+    r=Registry(S)
+    d1=mkstage({'name':'1'},r)
+    d2=mkstage({'name':'2','maman':d1},r,nrrefs=2,nmatch=2,nondet=lambda i:i)
+    d3=mkstage({'name':'3'},r)
+    [r2a,r2b]=realizeMany(instantiate(d2,r=r))
+    r3=realize1(instantiate(d3,r=r))
+    [r1]=list(drefrrefs(d1,S))
+    keep=Path(join(fstmpdir(S),'keep'))
+    makedirs(keep)
+    linkrref(r2a,keep,S=S)
+    total=gc([keep],interactive=False,verbose=False,dry_run=True,S=S)
+    assert total>0
+    assert set(allrrefs(S))=={r2a,r2b,r3,r1}
+    assert gc([keep],interactive=False,verbose=False,max_workers=2,S=S)==total
+    assert set(alldrefs(S))=={d1,d2}
+    assert set(allrrefs(S))=={r2a,r1}
+
+def test_gc_evict()->None:
+  with setup_storage2('test_gc_evict') as S:
+    r=Registry(S)
+    d1=mkstage({'name':'1'},r)
+    d2=mkstage({'name':'2','maman':d1},r)
+    d3=mkstage({'name':'3'},r)
+    r2=realize1(instantiate(d2,r=r))
+    r3=realize1(instantiate(d3,r=r))
+    [r1]=list(drefrrefs(d1,S))
+    assert rrefatime(r2,S)>1000
+    for t,rref in enumerate([r1,r3,r2]):
+      utime(rref2path(rref,S),(1000+t,1000+t))
+    sizes={rref:sz for _,(_,rr) in du(S=S).items() for rref,sz in rr.items()}
+    total=sum(sizes.values())
+    assert gc_evict(([],[]),budget=total,S=S)==[]
+    assert gc_evict(([],[r2]),budget=0,S=S)==[(r3,sizes[r3])]
+    assert gc_evict(([],[]),budget=total-1,S=S)==[(r1,sizes[r1]),(r2,sizes[r2])]
+    store_reindex(S)
+    assert gc_evict(([],[]),budget=total-1,S=S)==[(r1,sizes[r1]),(r2,sizes[r2])]
+    assert [x for x,_ in gc_evict(([],[]),max_age=0,S=S)]==[r1,r2,r3]
+    mklens(r3,S=S).syspath
+    assert rrefatime(r3,S)>2000
+    assert [x for x,_ in gc_evict(([],[]),budget=0,S=S)]==[r1,r2,r3]
+    assert gc([],interactive=False,verbose=False,budget=total-1,S=S)>0
+    assert set(allrrefs(S))=={r3}
+
+def test_dedup()->None:
+  def _inode(rref,S):
+    return stat(join(rref2path(rref,S),'artifact')).st_ino
+  with setup_storage2('test_dedup') as S:
+    fsconfig_update(S,dedup='hardlink',dedup_min_size=0)
+    r1=realize1(instantiate(mkstage,{'name':'1'},nondet=lambda i:42,S=S))
+    r2=realize1(instantiate(mkstage,{'name':'2'},nondet=lambda i:42,S=S))
+    r3=realize1(instantiate(mkstage,{'name':'3'},nondet=lambda i:33,S=S))
+    assert _inode(r1,S)==_inode(r2,S)
+    assert _inode(r1,S)!=_inode(r3,S)
+    assert mklens(r2,S=S).artifact.contents=='42'
+    assert set(alldrefs(S))=={rref2dref(r) for r in [r1,r2,r3]}
+    total=gc([],interactive=False,verbose=False,dry_run=True,S=S)
+    assert total<sum(dirsize(rref2path(r,S)) for r in [r1,r2,r3]), \
+      "Shared files should be counted once"
+    assert sum(sz for _,sz in gc_evict(([],[]),budget=0,S=S))==total
+    [(r,sz)]=gc_evict(([],[r1,r3]),budget=0,S=S)
+    assert r==r2 and sz<dirsize(rref2path(r2,S)), \
+      "Files shared with the kept realizations are not freed"
+    nblobs=len(listdir(fsblobs(S)))
+    assert gc([],interactive=False,verbose=False,S=S)>0
+    assert len(listdir(fsblobs(S)))==0 and nblobs>0
+  with setup_storage2('test_store_dedup') as S:
+    r1=realize1(instantiate(mkstage,{'name':'1'},nondet=lambda i:42,S=S))
+    r2=realize1(instantiate(mkstage,{'name':'2'},nondet=lambda i:42,S=S))
+    assert _inode(r1,S)!=_inode(r2,S)
+    assert store_dedup(S=S)>0
+    assert _inode(r1,S)==_inode(r2,S)
+    assert store_dedup(S=S)==0
+
+def test_dedup_rollback()->None:
+  """ A failed commit doesn't make the shared blobs writable """
+  import pylightnix.core
+  with setup_storage2('test_dedup_rollback') as S:
+    fsconfig_update(S,dedup='hardlink',dedup_min_size=0)
+    realize1(instantiate(mkstage,{'name':'1'},nondet=lambda i:42,S=S))
+    replace_=pylightnix.core.replace
+    def _replace(src,dst):
+      if str(src).endswith('.tmp') and str(dst).startswith(fsstorage(S)):
+        raise OSError(EXDEV,'Injected failure')
+      return replace_(src,dst)
+    clo:Any=instantiate(mkstage,{'name':'2'},nondet=lambda i:42,S=S)
+    pylightnix.core.replace=_replace # type:ignore
+    try:
+      realize1(clo)
+      raise ShouldHaveFailed('Commit should fail')
+    except OSError as e:
+      assert e.errno==EXDEV
+    finally:
+      pylightnix.core.replace=replace_
+    for b in listdir(fsblobs(S)):
+      assert not stat(join(fsblobs(S),b)).st_mode & S_IWRITE
+
+def test_readonly_top()->None:
+  with setup_storage2('test_readonly_top') as S:
+    fsconfig_update(S,readonly='top')
+    rref=realize1(instantiate(mkstage,{'name':'1'},S=S))
+    assert not stat(rref2path(rref,S)).st_mode & S_IWRITE
+    assert stat(join(rref2path(rref,S),'artifact')).st_mode & S_IWRITE
+    rmref(rref,S)
+    assert rref not in set(allrrefs(S))
+
 @settings(max_examples=10)
 @given(dref=drefs())
 def test_path2dref(dref):
@@ -388,3 +500,41 @@ def test_current_storage():
     assert len(list(alldrefs(S1)))==2
     assert len(list(alldrefs(S2)))==1
 
+def test_metacache()->None:
+  with setup_storage2('test_metacache') as S:
+    rref=realize1(instantiate(mkstage,{'a':'1'},S=S))
+    dref=rref2dref(rref)
+    ctx=rrefctx(rref,S)
+    h,m=metacache_stats()
+    assert rrefctx(rref,S)==ctx
+    assert cfgdict(drefcfg_(dref,S))==cfgdict(drefcfg_(dref,S))
+    h2,m2=metacache_stats()
+    assert h2>=h+2 and m2<=m+1
+    cfgdict(drefcfg_(dref,S))['a']='2'
+    assert cfgdict(drefcfg_(dref,S))['a']=='1'
+    rmref(rref,S)
+    try:
+      rrefctx(rref,S)
+      raise ShouldHaveFailed('Removed realization should not be cached')
+    except FileNotFoundError:
+      pass
+
+def test_dirhash_version()->None:
+  with setup_storage2('test_dirhash_version0') as S0:
+    rref0=realize1(instantiate(mkstage,{'a':'1'},S=S0))
+    assert fsconfig(S0)['dirhash_version']==0
+  with setup_storage2('test_dirhash_version1') as S1:
+    fsinit(S1, dirhash_version=1)
+    assert fsconfig(S1)['dirhash_version']==1
+    rref1=realize1(instantiate(mkstage,{'a':'1'},S=S1))
+  assert rref2dref(rref0)==rref2dref(rref1)
+  assert rref0!=rref1
+
+def test_fsconfig_external()->None:
+  with setup_storage2('test_fsconfig_external') as S:
+    assert fsconfig(S)['lock_timeout']!=0.5
+    # Another process updates the settings, the cache of this one stays intact
+    with open(fsconfigpath(S)+'.tmp','w') as f:
+      json_dump({'lock_timeout':0.5},f)
+    replace(fsconfigpath(S)+'.tmp',fsconfigpath(S))
+    assert fsconfig(S)['lock_timeout']==0.5
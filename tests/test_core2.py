@@ -7,13 +7,24 @@ from pylightnix import (instantiate, DRef, RRef, Path, SPath, drefdeps,
                         PromiseException, output_matcher, output_realizer,
                         cfgsp, drefcfg_, rootrrefs, rootdrefs, match_exact,
                         match_latest, timestring, rrefbstart, parsetime,
-                        mkregistry, realize)
+                        mkregistry, realize, realizeParallel, drefdepsmap,
+                        drefdeps1, drefdependents, rrefdependents,
+                        drefdependentsmap, rrefdependentsmap,
+                        store_reindex, dreflock, dreflock_acquire,
+                        dreflock_release, dreflockpath, fsconfig_update,
+                        fstmpdir, selfref, realize_async, async_realizer,
+                        async_matcher, mkconfig, cfgdict, Derivation,
+                        PYLIGHTNIX_LOCK_POLL, Closure, isclosure)
 
 from tests.imports import (given, Any, Callable, join, Optional, islink,
                            isfile, islink, List, randint, sleep, rmtree,
                            system, S_IWRITE, S_IREAD, S_IEXEC, chmod, Popen,
                            PIPE, data, event, settings, reproduce_failure,
-                           lists, remove, isfile, isdir, note, partial)
+                           lists, remove, isfile, isdir, note, partial,
+                           mp_get_context, gethostname, Thread, mkdtemp,
+                           listdir, asyncio_run, asyncio_sleep, AsyncEvent,
+                           wait_for, create_task, CancelledError, chain,
+                           Lock, Dict, perf_counter)
 
 from tests.generators import (rrefs, drefs, configs, dicts, rootstages,
                               integers, composite, hierarchies, sampled_from)
@@ -282,3 +293,348 @@ def test_dry_run(h,data):
         assert dref in ctx_part
 
 
+
+
+@given(stages=rootstages())
+def test_drefdepsmap(stages):
+  """ Check that the closure dependency index agrees with `drefdeps` """
+  with setup_storage2('test_drefdepsmap') as S:
+    for stage in stages:
+      _,clo=instantiate(stage,S=S)
+      assert clo.deps==drefdepsmap(clo.targets,S)
+      assert set(clo.deps.keys())==drefdeps(clo.targets,S)|set(clo.targets)
+      for dref,deps in clo.deps.items():
+        assert drefdeps1([dref],S)<=deps
+        assert deps==drefdeps([dref],S)
+
+def test_closure_nodeps()->None:
+  """ Closures built without the dependency index are still realizable """
+  with setup_storage2('test_closure_nodeps') as S:
+    def _stage(r:Registry)->DRef:
+      n1=mkstage({'name':'1', 'promise':[selfref,'artifact']},r)
+      return mkstage({'name':'2', 'maman':n1, 'promise':[selfref,'artifact']},r)
+    clo=instantiate(_stage,S=S)[1]
+    clo2=Closure(clo.result,clo.targets,clo.derivations,S)
+    assert clo2.deps is None
+    assert isclosure(clo2)
+    _,_,ctx1=realize(clo2)
+    _,_,ctx2=realizeParallel(clo2)
+    assert ctx1==ctx2
+    assert len(ctx1)==2
+
+@given(stages=rootstages())
+def test_dependents(stages):
+  """ Check that dependents queries agree with the forward dependencies, both
+  with and without the storage index """
+  with setup_storage2('test_dependents') as S:
+    for stage in stages:
+      realizeMany(instantiate(stage,S=S))
+    def _check():
+      drefs=list(alldrefs(S))
+      rrefs=list(allrrefs(S))
+      for dref in drefs:
+        assert drefdependents([dref],S)=={d for d in drefs
+                                          if dref in drefdeps([d],S)}
+      for rref in rrefs:
+        assert rrefdependents([rref],S)=={r for r in rrefs
+                                          if rref in rrefdeps([r],S)}
+      return (rootdrefs(S),rootrrefs(S),drefdependentsmap(S),
+              rrefdependentsmap(S))
+    roots=_check()
+    store_reindex(S)
+    assert _check()==roots
+
+def test_dependents_scan()->None:
+  """ Without the storage index, dependents queries read every config once,
+  regardless of the depth of the dependency graph """
+  import pylightnix.core
+  with setup_storage2('test_dependents_scan') as S:
+    def _stage(r:Registry)->DRef:
+      d=mkstage({'name':'0'},r)
+      for i in range(1,6):
+        d=mkstage({'name':str(i),'maman':d},r)
+      return d
+    rref=realize1(instantiate(_stage,S=S))
+    drefs=list(alldrefs(S))
+    [root]=[d for d in drefs if drefdeps1([d],S)==set()]
+    drefdeps1_=pylightnix.core.drefdeps1
+    ncalls=[0]
+    def _drefdeps1(*args,**kwargs):
+      ncalls[0]+=1
+      return drefdeps1_(*args,**kwargs)
+    pylightnix.core.drefdeps1=_drefdeps1 # type:ignore
+    try:
+      assert len(drefdependents([root],S))==len(drefs)-1
+      assert ncalls[0]==len(drefs)
+      ncalls[0]=0
+      assert len(rrefdependents(list(allrrefs(S)),S))==len(drefs)-1
+      assert ncalls[0]==len(drefs)
+    finally:
+      pylightnix.core.drefdeps1=drefdeps1_ # type:ignore
+
+@settings(max_examples=10)
+@given(stages=rootstages(), executor=sampled_from(['thread','process']))
+def test_realize_parallel(stages,executor):
+  """ Check that `realizeParallel` produces the same contexts as `realize` """
+  with setup_storage2('test_realize_parallel_seq') as S1, \
+       setup_storage2('test_realize_parallel_par') as S2:
+    for stage in stages:
+      _,_,ctx1=realize(instantiate(stage,S=S1))
+      _,_,ctx2=realizeParallel(instantiate(stage,S=S2), max_workers=4,
+                               executor=executor)
+      assert ctx1==ctx2
+      _,_,ctx3=realizeParallel(instantiate(stage,S=S2), max_workers=4,
+                               executor=executor)
+      assert ctx2==ctx3
+
+
+def test_realize_locks()->None:
+  """ Check that concurrent realizations of a derivation are serialized and
+  the late arrivals reuse the result """
+  with setup_storage2('test_realize_locks') as S:
+    counter=join(fstmpdir(S),'counter')
+    def _nondet(n):
+      with open(counter,'a') as f:
+        f.write('x')
+      sleep(0.3)
+      return randint(0,1000000)
+    def _stage(r):
+      return mkstage({'name':'locked', 'promise':[selfref,'artifact']}, r,
+                     nondet=_nondet)
+    def _realize():
+      realize1(instantiate(_stage,S=S))
+    ps=[mp_get_context('fork').Process(target=_realize) for _ in range(4)]
+    ts=[Thread(target=lambda: realizeParallel(instantiate(_stage,S=S)))
+        for _ in range(2)]
+    for p in ps: p.start()
+    for t in ts: t.start()
+    for p in ps: p.join()
+    for t in ts: t.join()
+    assert all(p.exitcode==0 for p in ps)
+    assert len(list(allrrefs(S)))==1
+    with open(counter) as f:
+      assert f.read()=='x'
+
+def test_realize_locks_timeout()->None:
+  with setup_storage2('test_realize_locks_timeout') as S:
+    def _stage(r):
+      return mkstage({'name':'locked', 'promise':[selfref,'artifact']}, r)
+    dref:DRef=instantiate(_stage,S=S)[0]
+    fsconfig_update(S,lock_timeout=0.3)
+    with dreflock(dref,S):
+      realizers:List[Callable[[Any],Any]]=[realize1, realizeParallel]
+      for realize_ in realizers:
+        try:
+          realize_(instantiate(_stage,S=S))
+          raise ShouldHaveFailed('Lock timeout is expected')
+        except AssertionError as e:
+          assert 'Timeout' in str(e)
+    realize1(instantiate(_stage,S=S))
+
+def test_realize_locks_stale()->None:
+  with setup_storage2('test_realize_locks_stale') as S:
+    def _stage(r):
+      return mkstage({'name':'locked', 'promise':[selfref,'artifact']}, r)
+    dref:DRef=instantiate(_stage,S=S)[0]
+    fd=dreflock_acquire(dref,S)
+    assert fd is not None
+    assert dreflock_acquire(dref,S,timeout=0.3) is None
+    p=Popen(['true']); p.wait()
+    with open(dreflockpath(dref,S),'w') as f:
+      f.write(f"{gethostname()} {p.pid}") # Pretend the holder is dead
+    fd2=dreflock_acquire(dref,S,timeout=5)
+    assert fd2 is not None
+    dreflock_release(fd2)
+    dreflock_release(fd)
+
+def test_realize_assert_realized()->None:
+  with setup_storage2('test_realize_assert_realized') as S, \
+       setup_storage2('test_realize_assert_realized_default'):
+    def _stage(r):
+      return mkstage({'name':'unrealized', 'promise':[selfref,'artifact']}, r)
+    dref:DRef=instantiate(_stage,S=S)[0]
+    try:
+      realize1(instantiate(_stage,S=S), assert_realized=[dref])
+      raise ShouldHaveFailed('The stage is not realized')
+    except AssertionError as e:
+      assert 'was assumed to be already realized' in str(e)
+      assert 'unrealized' in str(e)
+
+
+def test_realize_resources()->None:
+  """ Check that `realizeParallel` keeps the declared resources within the
+  budget and that resources don't affect the DRefs """
+  with setup_storage2('test_realize_resources') as S:
+    lock=Lock()
+    used:Dict[str,float]={'cpu':0, 'gpu':0}
+    peak:Dict[str,float]={'cpu':0, 'gpu':0}
+    def _nondet(res:Dict[str,float])->Callable[[int],int]:
+      def _f(n:int)->int:
+        with lock:
+          for k,v in res.items():
+            used[k]+=v
+            peak[k]=max(peak[k],used[k])
+        sleep(0.2)
+        with lock:
+          for k,v in res.items():
+            used[k]-=v
+        return 0
+      return _f
+    reses:List[Dict[str,float]]=[{'cpu':2}, {'cpu':2, 'gpu':1},
+                                 {'cpu':1, 'gpu':1}, {'cpu':3}, {'cpu':1}, {}]
+    def _stage(r:Registry)->List[DRef]:
+      return [mkstage({'name':f'res{i}', 'promise':[selfref,'artifact']}, r,
+                      nondet=_nondet(res), resources=res)
+              for i,res in enumerate(reses)]
+    def _stage_nores(r:Registry)->List[DRef]:
+      return [mkstage({'name':f'res{i}', 'promise':[selfref,'artifact']}, r)
+              for i,_ in enumerate(reses)]
+    drefs,_,ctx=realizeParallel(instantiate(_stage,S=S), max_workers=6,
+                                budget={'cpu':4, 'gpu':1})
+    assert drefs==instantiate(_stage_nores,S=S)[0]
+    drv=Derivation(drefs[0],match_only(),lambda S,d,c,ra:[]) # type:ignore
+    assert drv.resources is None
+    assert all(ctx[d] is not None for d in drefs) # type:ignore
+    assert peak['cpu']==4
+    assert peak['gpu']==1
+
+    try:
+      realizeParallel(instantiate(_stage,S=S), budget={'cpu':2})
+      raise ShouldHaveFailed('Budget is too small')
+    except AssertionError:
+      pass
+
+    try:
+      mkstage({'name':'bad'}, mkregistry(S), resources={'cpu':-1})
+      raise ShouldHaveFailed('Negative resources')
+    except AssertionError:
+      pass
+
+def test_realize_resources_mem()->None:
+  """ Check that the memory declarations are enforced in worker processes """
+  with setup_storage2('test_realize_resources_mem') as S:
+    def _realizer(S,dref,ctx,rarg):
+      buf=bytearray(512*2**20)
+      return []
+    def _stage(r:Registry)->DRef:
+      return mkdrv(mkconfig({'name':'greedy'}), match_only(), _realizer, r,
+                   resources={'mem':256*2**20})
+    try:
+      realizeParallel(instantiate(_stage,S=S), executor='process')
+      raise ShouldHaveFailed('Memory limit is not enforced')
+    except MemoryError:
+      pass
+
+def test_realize_resources_mem_small()->None:
+  """ Small memory declarations limit the growth of the worker, not its total
+  address space """
+  with setup_storage2('test_realize_resources_mem_small') as S:
+    def _realizer(S,dref,ctx,rarg):
+      buf=bytearray(16*2**20)
+      try:
+        buf2=bytearray(128*2**20)
+        assert False, 'Memory limit is not enforced'
+      except MemoryError:
+        pass
+      return [Path(mkdtemp(dir=fstmpdir(S)))]
+    def _stage(r:Registry)->DRef:
+      return mkdrv(mkconfig({'name':'modest'}), match_only(), _realizer, r,
+                   resources={'mem':64*2**20})
+    realizeParallel(instantiate(_stage,S=S), executor='process')
+
+
+def test_realize_async()->None:
+  with setup_storage2('test_realize_async') as S, \
+       setup_storage2('test_realize_async_seq') as S2:
+    evs:dict={}
+    async def _realizer(S, dref:DRef, ctx:Context, ra:RealizeArg)->List[Path]:
+      cfg=cfgdict(drefcfg_(dref,S))
+      # Independent derivations wait for each other, so they should run
+      # concurrently
+      evs[cfg['name']].set()
+      await wait_for(evs[cfg['peer']].wait(), timeout=10)
+      o=Path(mkdtemp(dir=fstmpdir(S)))
+      with open(join(o,'artifact'),'w') as f:
+        f.write(cfg['name'])
+      return [o]
+    async def _matcher(S, rrefs:List[RRef])->Optional[List[RRef]]:
+      await asyncio_sleep(0)
+      return rrefs if len(rrefs)>0 else None
+    def _stage(r:Registry)->DRef:
+      s0=mkstage({'name':'sync'}, r)
+      a=mkdrv(mkconfig({'name':'a', 'peer':'b', 's0':s0}),
+              async_matcher(_matcher), async_realizer(_realizer), r)
+      b=mkdrv(mkconfig({'name':'b', 'peer':'a', 's0':s0}),
+              _matcher, _realizer, r) # type:ignore
+      return mkstage({'name':'c', 'a':a, 'b':b}, r)
+    async def _main():
+      evs.update({'a':AsyncEvent(), 'b':AsyncEvent()})
+      return await realize_async(instantiate(_stage,S=S), max_workers=2)
+    _,clo,ctx=asyncio_run(_main())
+    assert len(ctx)==4
+    assert all(v is not None and len(v)==1 for v in ctx.values())
+    _,_,ctx2=asyncio_run(_main())
+    assert ctx==ctx2
+    assert set(allrrefs(S))==set(chain.from_iterable(ctx.values())) # type:ignore
+
+def test_realize_async_cancel()->None:
+  with setup_storage2('test_realize_async_cancel') as S:
+    async def _realizer(S, dref:DRef, ctx:Context, ra:RealizeArg)->List[Path]:
+      o=Path(mkdtemp(dir=fstmpdir(S)))
+      with open(join(o,'artifact'),'w') as f:
+        f.write('0')
+      await asyncio_sleep(100)
+      return [o]
+    def _sync_realizer(S, dref:DRef, ctx:Context, ra:RealizeArg)->List[Path]:
+      o=Path(mkdtemp(dir=fstmpdir(S)))
+      sleep(0.5)
+      return [o]
+    def _stage(r:Registry)->DRef:
+      s0=mkdrv(mkconfig({'name':'slow_async'}), match_only(),
+               async_realizer(_realizer), r)
+      s1=mkdrv(mkconfig({'name':'slow_sync'}), match_only(), _sync_realizer, r)
+      return mkstage({'name':'top', 's0':s0, 's1':s1}, r)
+    async def _main():
+      t=create_task(realize_async(instantiate(_stage,S=S)))
+      await asyncio_sleep(0.2)
+      assert len(listdir(fstmpdir(S)))==2
+      t.cancel()
+      try:
+        await t
+        raise ShouldHaveFailed('Cancellation is expected')
+      except CancelledError:
+        pass
+    asyncio_run(_main())
+    sleep(0.6)
+    assert listdir(fstmpdir(S))==[]
+    assert list(allrrefs(S))==[]
+    for dref in alldrefs(S):
+      fd=dreflock_acquire(dref,S,timeout=0)
+      assert fd is not None
+      dreflock_release(fd)
+
+def test_realize_async_stale()->None:
+  """ Check that breaking a stale lock doesn't block the event loop """
+  with setup_storage2('test_realize_async_stale') as S:
+    def _stage(r):
+      return mkstage({'name':'locked', 'promise':[selfref,'artifact']}, r)
+    dref:DRef=instantiate(_stage,S=S)[0]
+    fd=dreflock_acquire(dref,S)
+    assert fd is not None
+    p=Popen(['true']); p.wait()
+    with open(dreflockpath(dref,S),'w') as f:
+      f.write(f"{gethostname()} {p.pid}") # Pretend the holder is dead
+    async def _main()->float:
+      t=create_task(realize_async(instantiate(_stage,S=S)))
+      maxgap=0.0
+      while not t.done():
+        t0=perf_counter()
+        await asyncio_sleep(0.01)
+        maxgap=max(maxgap,perf_counter()-t0)
+      await t
+      return maxgap
+    try:
+      assert asyncio_run(_main())<PYLIGHTNIX_LOCK_POLL
+    finally:
+      dreflock_release(fd)
+    assert len(list(allrrefs(S)))==1
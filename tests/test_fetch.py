@@ -72,3 +72,21 @@ def test_fetchlocal2():
     assert isfile(join(rref2path(rref,S),'mockdata'))
     assert isfile(mklens(rref,S=S).out_path.syspath)
 
+
+
+def test_fetchlocal_hardlink():
+  with setup_storage2('test_fetchlocal_hardlink') as S:
+    mockdata=join(fstmpdir(S),'mockdata')
+    with open(mockdata,'w') as f:
+      f.write('dogfood')
+
+    wanted_sha256=pipe_stdout([SHA256SUM, "mockdata"],
+                              cwd=fstmpdir(S)).split()[0]
+
+    rref=realize1(instantiate(fetchlocal, path=mockdata, sha256=wanted_sha256,
+                             mode='as-is', hardlink=True, S=S))
+    assert isrref(rref)
+    assert stat(mklens(rref,S=S).out_path.syspath).st_ino==stat(mockdata).st_ino
+    rref2=realize1(instantiate(fetchlocal, path=mockdata, sha256=wanted_sha256,
+                             mode='as-is', S=S))
+    assert rref2==rref, "`hardlink` should not affect the configuration"
@@ -1,11 +1,16 @@
 from pylightnix import ( DRef, RRef, lsref, catref, instantiate, realize1,
                         unrref, fetchurl, fetchurl2, isrref, rref2path, isfile,
-                        mklens, selfref, basename, fstmpdir )
+                        mklens, selfref, basename, fstmpdir, urldownload,
+                        filedigest, sha1, prefetch, fetchlocal, realize, Registry,
+                        mkregistry, Tuple, Closure, fetchcache_get,
+                        fetchcache_evict, dirrm, Path, BuildError )
 
 from tests.imports import (TemporaryDirectory, join, stat, chmod, S_IEXEC,
-    system, Popen, PIPE, get_executable)
+    system, Popen, PIPE, get_executable, isfile, listdir, environ, remove,
+    List, makedirs, walk)
 
-from tests.setup import (ShouldHaveFailed, setup_storage2, pipe_stdout)
+from tests.setup import (ShouldHaveFailed, setup_storage2, pipe_stdout,
+                         setup_httpserver, mkstage)
 
 
 SHA256SUM=get_executable('sha256sum', 'Please install `sha256sum` tool from `coreutils` package')
@@ -60,3 +65,180 @@ def test_fetchurl2_file():
     assert isfile(mklens(rref,S=S).out.syspath)
     assert basename(mklens(rref,S=S).out.syspath)=="mockdata.foo"
 
+    makedirs(join(tmp,'sp ace'))
+    mockdata2=join(tmp,'sp ace','mockdata.foo')
+    with open(mockdata2,'w') as f:
+      f.write('dogfood')
+    rref2=realize1(instantiate(fetchurl2,
+                               url=f"file://{join(tmp,'sp%20ace','mockdata.foo')}",
+                               sha256=wanted_sha256,
+                               name='quoted',
+                               S=S))
+    assert open(mklens(rref2,S=S).out.syspath).read()=='dogfood'
+    rref3=realize1(instantiate(fetchurl2, url=mockdata2, name='local', S=S))
+    assert open(mklens(rref3,S=S).out.syspath).read()=='dogfood'
+
+
+
+def test_urldownload():
+  with setup_storage2('test_urldownload') as S:
+    tmp=fstmpdir(S)
+    data=bytes(range(256))*1000
+    with open(join(tmp,'data'),'wb') as f:
+      f.write(data)
+    h=filedigest(join(tmp,'data'))
+    with setup_httpserver(tmp) as server:
+      url=f"{server.url}/data"
+      assert urldownload(url,join(tmp,'d1'))==h
+      assert urldownload(url,join(tmp,'d2'),nconnections=4)==h
+      assert open(join(tmp,'d2'),'rb').read()==data
+      assert [f for f in listdir(tmp) if f.startswith('d2.')]==[]
+      assert urldownload(url,join(tmp,'d2'),sha1)==filedigest(join(tmp,'d2'),sha1)
+      with open(join(tmp,'d3'),'wb') as f:
+        f.write(data[:1000])
+      server.ranges.clear()
+      assert urldownload(url,join(tmp,'d3'))==h
+      assert server.ranges==['bytes=1000-'], "Download should be resumed"
+      assert urldownload(url,join(tmp,'d3'))==h
+      with open(join(tmp,'d4.1'),'wb') as f:
+        f.write(data[64000:65000])
+      server.ranges.clear()
+      assert urldownload(url,join(tmp,'d4'),nconnections=4)==h
+      assert 'bytes=65000-127999' in server.ranges, "Part should be resumed"
+
+
+def test_fetchurl2_python():
+  with setup_storage2('test_fetchurl2_python') as S:
+    tmp=fstmpdir(S)
+    with open(join(tmp,'mockdata'),'w') as f:
+      f.write('dogfood'*10000)
+    wanted_sha256=filedigest(join(tmp,'mockdata'))
+    with setup_httpserver(tmp) as server:
+      rref=realize1(instantiate(fetchurl2,
+                               url=f"{server.url}/mockdata",
+                               sha256=wanted_sha256,
+                               backend='python',
+                               nconnections=3,
+                               S=S))
+    assert isrref(rref)
+    assert filedigest(mklens(rref,S=S).out.syspath)==wanted_sha256
+
+
+def test_prefetch():
+  with setup_storage2('test_prefetch') as S:
+    tmp=fstmpdir(S)
+    hashes=[]
+    for i in range(3):
+      with open(join(tmp,f'data{i}'),'w') as f:
+        f.write(f'dogfood{i}')
+      hashes.append(filedigest(join(tmp,f'data{i}')))
+    with setup_httpserver(tmp) as server:
+      def _stage(r:Registry)->DRef:
+        fetches=[fetchurl2(url=f"{server.url}/data{i}", sha256=hashes[i],
+                           backend='python', r=r) for i in range(3)]
+        local=fetchlocal(path=join(tmp,'data0'), sha256=hashes[0],
+                         mode='as-is', r=r)
+        return mkstage({'name':'user','fetches':fetches,'local':local},r=r)
+      closure:Tuple[DRef,Closure]=instantiate(_stage,S=S)
+      ctx=prefetch(closure, max_parallel=3)
+      assert len(ctx)==3
+      assert len(server.ranges)==3
+      _,_,ctx2=realize(closure, assert_realized=list(ctx.keys()))
+      assert all([ctx2[d]==ctx[d] for d in ctx.keys()])
+      assert len(server.ranges)==3, "Prefetched data should not be downloaded"
+      assert prefetch(closure)==ctx
+
+
+def test_fetchcache():
+  import pylightnix.stages.fetchcache
+  with setup_storage2('test_fetchcache1') as S1, \
+       setup_storage2('test_fetchcache2') as S2:
+    tmp=fstmpdir(S1)
+    cache=join(tmp,'cache')
+    with open(join(tmp,'mockdata'),'w') as f:
+      f.write('dogfood')
+    wanted_sha256=filedigest(join(tmp,'mockdata'))
+    environ['PYLIGHTNIX_FETCH_CACHE']=cache
+    try:
+      with setup_httpserver(tmp) as server:
+        def _realize(S):
+          return realize1(instantiate(fetchurl2, url=f"{server.url}/mockdata",
+                                      sha256=wanted_sha256, backend='python',
+                                      S=S))
+        rref1=_realize(S1)
+        assert len(server.ranges)==1
+        assert isfile(join(cache,'sha256',wanted_sha256))
+        rref2=_realize(S2)
+        assert rref1==rref2
+        assert len(server.ranges)==1, "Cached file should not be downloaded"
+        assert filedigest(mklens(rref2,S=S2).out.syspath)==wanted_sha256
+        assert stat(mklens(rref2,S=S2).out.syspath).st_ino!= \
+               stat(join(cache,'sha256',wanted_sha256)).st_ino
+
+        wanted_sha1=filedigest(join(tmp,'mockdata'),sha1)
+        def _realize2(sha1_):
+          return realize1(instantiate(fetchurl2, url=f"{server.url}/mockdata",
+                                      sha256=wanted_sha256, sha1=sha1_,
+                                      backend='python', S=S2))
+        _realize2(wanted_sha1)
+        try:
+          _realize2('0'*40)
+          raise ShouldHaveFailed('Cached file should match both hashes')
+        except BuildError:
+          pass
+        assert len(server.ranges)==1, "Cached file should not be downloaded"
+
+        assert not fetchcache_get('sha256','0'*64,join(tmp,'a'))
+        def _utime(*args,**kwargs):
+          raise PermissionError('Owned by another user')
+        utime_=pylightnix.stages.fetchcache.utime
+        pylightnix.stages.fetchcache.utime=_utime # type:ignore
+        try:
+          assert fetchcache_get('sha256',wanted_sha256,join(tmp,'c'))
+        finally:
+          pylightnix.stages.fetchcache.utime=utime_ # type:ignore
+        remove(join(cache,'sha256',wanted_sha256))
+        with open(join(cache,'sha256',wanted_sha256),'w') as f:
+          f.write('corrupted')
+        assert not fetchcache_get('sha256',wanted_sha256,join(tmp,'b'))
+        assert not isfile(join(cache,'sha256',wanted_sha256))
+        assert not isfile(join(tmp,'b'))
+
+        with open(join(cache,'sha256',wanted_sha256),'w') as f:
+          f.write('dogfood')
+        assert fetchcache_evict(100)==0
+        assert fetchcache_evict(0)==1
+        assert not isfile(join(cache,'sha256',wanted_sha256))
+    finally:
+      del environ['PYLIGHTNIX_FETCH_CACHE']
+
+def test_fetchcache_concurrent():
+  """ Concurrent downloads of the same file share the partial download """
+  with setup_storage2('test_fetchcache_concurrent') as S:
+    tmp=fstmpdir(S)
+    with open(join(tmp,'mockdata'),'w') as f:
+      f.write('dogfood'*100000)
+    wanted_sha256=filedigest(join(tmp,'mockdata'))
+    environ['PYLIGHTNIX_FETCH_CACHE']=join(tmp,'cache')
+    try:
+      with setup_httpserver(tmp) as server:
+        def _stage(r:Registry)->List[DRef]:
+          return [fetchurl2(name=f'mockdata{i}', url=f"{server.url}/mockdata",
+                            sha256=wanted_sha256, backend='python', r=r)
+                  for i in range(4)] + \
+                 [fetchurl(name='mockdata', url=f"{server.url}/mockdata",
+                           sha256=wanted_sha256, mode='', backend='python',
+                           r=r)]
+        ctx=prefetch(instantiate(_stage,S=S))
+        assert len(ctx)==5
+        for rrefs in ctx.values():
+          assert rrefs is not None
+          for path in lsref(rrefs[0],S):
+            if path=='mockdata':
+              assert filedigest(join(rref2path(rrefs[0],S),path))==\
+                wanted_sha256
+        assert len(server.ranges)==1
+        assert [f for _,_,fs in walk(join(tmp,'cache')) for f in fs
+                if f.endswith('.lock')]==[]
+    finally:
+      del environ['PYLIGHTNIX_FETCH_CACHE']
@@ -18,7 +18,7 @@ from pylightnix import (DRef, RRef, Path, Build, Registry, mklens, mkdrv,
                         selfref, match_some, build_wrapper, instantiate,
                         realize1, isrref, isdref, build_cattrs, build_outpath,
                         build_path, mkconfig, assert_valid_rref, isrefpath,
-                        isclosure, match_only)
+                        isclosure, match_only, realize, allrrefs)
 
 from tests.imports import (given, Any, Callable, join, Optional, islink,
                            isfile, List, randint, sleep, rmtree, system,
@@ -121,5 +121,10 @@ def test_lens_closures():
 
     rref=realize1(mklens(clo,S=S).maman.papa.closure)
     assert mklens(rref,S=S).x.val==33
+    _,_,ctx=realize(mklens(clo,S=S).maman.papa.closure)
+    assert len(ctx)==1
+    assert len(list(allrrefs(S)))==1
+    _,_,ctx=realize(mklens(clo,S=S).maman.closure)
+    assert len(ctx)==2
     assert open(mklens(rref,S=S).selfref.syspath).read()=='0'
 
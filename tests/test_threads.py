@@ -0,0 +1,92 @@
+from pylightnix import (instantiate, DRef, RRef, Path, Registry, mkregistry,
+                        realize1, realize, mkrealization, mkdrv_, mkconfig,
+                        selfref, allrrefs, alldrefs, fsstorage, fstmpdir,
+                        dref2path, mkcontext, realizeParallel,
+                        fsconfig_update, fsconfig)
+
+from tests.imports import (join, listdir, List, Thread, mkdtemp, walk,
+                           Barrier, Lock)
+
+from tests.setup import (setup_storage2, mkstage)
+
+
+def _run(nthreads:int, f)->List:
+  """ Call `f(i)` from `nthreads` threads simultaneously. Return the results,
+  re-raise the first exception """
+  barrier=Barrier(nthreads)
+  results:List=[None]*nthreads
+  errors:List=[]
+  def _thread(i:int)->None:
+    try:
+      barrier.wait()
+      results[i]=f(i)
+    except BaseException as e:
+      errors.append(e)
+  ts=[Thread(target=_thread, args=(i,)) for i in range(nthreads)]
+  for t in ts: t.start()
+  for t in ts: t.join()
+  if len(errors)>0:
+    raise errors[0]
+  return results
+
+def _tmpnames(S)->List[str]:
+  return [join(root,d) for root,dirs,_ in walk(fsstorage(S))
+          for d in dirs if d.endswith('.tmp')]
+
+
+def test_threads_mkdrv()->None:
+  with setup_storage2('test_threads_mkdrv') as S:
+    drefs=_run(300, lambda i: mkdrv_(mkconfig({'name':'same', 'i':i%3}),S))
+    assert len(set(drefs))==3
+    assert set(alldrefs(S))==set(drefs)
+    assert _tmpnames(S)==[]
+
+def test_threads_mkrealization()->None:
+  with setup_storage2('test_threads_mkrealization') as S:
+    dref=mkdrv_(mkconfig({'name':'same'}),S)
+    def _mkrealization(i:int)->RRef:
+      o=Path(mkdtemp(dir=fstmpdir(S)))
+      with open(join(o,'artifact'),'w') as f:
+        f.write(str(i%2))
+      return mkrealization(dref,mkcontext(),o,S)
+    rrefs=_run(200, _mkrealization)
+    assert len(set(rrefs))==2
+    assert set(allrrefs(S))==set(rrefs)
+    assert _tmpnames(S)==[]
+
+
+def test_threads_fsconfig_update()->None:
+  with setup_storage2('test_threads_fsconfig_update') as S:
+    _run(100, lambda i: fsconfig_update(S,lock_timeout=i))
+    assert fsconfig(S)['lock_timeout'] in range(100)
+    assert [f for f in listdir(fsstorage(S)) if f.endswith('.tmp')]==[]
+
+
+def test_threads_registry()->None:
+  """ Threads sharing one registry instantiate and realize overlapping stages.
+  Each derivation is realized once. """
+  with setup_storage2('test_threads_registry') as S:
+    lock=Lock()
+    calls:List[int]=[]
+    def _nondet(n:int)->int:
+      with lock:
+        calls.append(n)
+      return 0
+    def _stage(i:int, r:Registry)->DRef:
+      s1=mkstage({'name':'common', 'promise':[selfref,'artifact']}, r,
+                 nondet=_nondet)
+      return mkstage({'name':'leaf', 'i':i%10, 'maman':s1,
+                      'promise':[selfref,'artifact']}, r, nondet=_nondet)
+    r=mkregistry(S)
+    def _realize(i:int)->RRef:
+      if i%2==0:
+        return realize1(instantiate(_stage,i,r=r))
+      dref,_,ctx=realizeParallel(instantiate(_stage,i,r=r))
+      rrefs=ctx[dref] # type:ignore
+      assert rrefs is not None
+      return rrefs[0]
+    rrefs=_run(200, _realize)
+    assert len(set(rrefs))==10
+    assert len(calls)==11
+    assert len(list(allrrefs(S)))==11
+    assert _tmpnames(S)==[]
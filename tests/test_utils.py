@@ -6,12 +6,16 @@ from pylightnix import (instantiate, DRef, RRef, Path, mklogdir, dirhash,
                         timestring, parsetime, traverse_dict, isrref, isdref,
                         scanref_dict, filehash, readjson, writejson, kahntsort,
                         fstmpdir, pyobjhash, getsourcelines, parse, dedent,
-                        ast_dump)
+                        ast_dump, LRUCache, filechunks, filedigest,
+                        PYLIGHTNIX_HASH_CHUNK, dirchmod, dirrm, filecopy,
+                        extract_archive, assert_tarmember_safe, getumask)
 
 from tests.imports import (given, text, isdir, isfile, join, from_regex,
                            islink, get_executable, run, dictionaries, binary,
                            one_of, integers, timegm, gmtime, settings,
-                           HealthCheck)
+                           HealthCheck, makedirs, replace, stat, S_IWRITE,
+                           symlink, listdir, system, chmod, TarInfo, SYMTYPE,
+                           LNKTYPE, CHRTYPE)
 
 from tests.generators import (rrefs, drefs, configs, dicts, prims,
                               dicts_with_refs, intdags, intdags_permutations)
@@ -137,6 +141,63 @@ def test_dirhash3(d)->None:
     h=dirhash(path)
     assert (p.stdout[:len(h)].decode('utf-8'))==h
 
+@given(b=binary(), n=integers(min_value=1, max_value=16))
+def test_filechunks(b, n)->None:
+  with setup_storage2('filechunks') as S:
+    path=join(fstmpdir(S),'a')
+    with open(path,'wb') as f:
+      f.write(b)
+    chunks=list(filechunks(path, chunk_size=n))
+    assert b''.join(chunks)==b
+    assert all([len(c)<=n for c in chunks])
+
+def test_dirhash_large()->None:
+  with setup_storage2('dirhash_large') as S:
+    path=fstmpdir(S)
+    with open(join(path,'a'),'wb') as f:
+      f.write(bytes(range(256))*(PYLIGHTNIX_HASH_CHUNK//100))
+    p=run([SHA256SUM, join(path,'a')], stdout=-1, check=True, cwd=path)
+    h=dirhash(path)
+    assert (p.stdout[:len(h)].decode('utf-8'))==h
+    assert filedigest(join(path,'a'))==h
+
+@given(b=binary())
+def test_filecopy(b)->None:
+  with setup_storage2('filecopy') as S:
+    path=fstmpdir(S)
+    with open(join(path,'a'),'wb') as f:
+      f.write(b)
+    h=filedigest(join(path,'a'))
+    assert filecopy(join(path,'a'),join(path,'b'))==h
+    assert open(join(path,'b'),'rb').read()==b
+    assert filecopy(join(path,'a'),join(path,'c'),hardlink=True)==h
+    assert stat(join(path,'c')).st_ino==stat(join(path,'a')).st_ino
+    try:
+      filecopy(join(path,'a'),join(path,'b'))
+      raise ShouldHaveFailed('filecopy should not overwrite files')
+    except FileExistsError:
+      pass
+
+@given(d=dicts())
+def test_dirhash_v1(d)->None:
+  with setup_storage2('dirhash_v1') as S:
+    path=fstmpdir(S)
+    makedirs(join(path,'sub'))
+    for n,(k,v) in enumerate(d.items()):
+      with open(join(path,'sub' if n%2 else '',f'f{n}'),'w') as f:
+        f.write(str(v))
+    h1=dirhash(path,version=1,nworkers=1)
+    assert_valid_hash(h1)
+    assert dirhash(path,version=1,nworkers=4)==h1
+    with open(join(path,'a'),'w') as f:
+      f.write('1')
+    h2=dirhash(path,version=1)
+    replace(join(path,"a"),join(path,"b"))
+    h3=dirhash(path,version=1)
+    assert dirhash(path,version=1,nworkers=4)==h3
+    assert dirhash(path,version=0)!=h3, "Versions should differ"
+    assert len({h1,h2,h3})==3, "Version 1 should depend on file names"
+
 @given(d=dicts())
 def test_dirhash4(d)->None:
   with setup_storage2('dirhash4') as S:
@@ -212,3 +273,94 @@ def test_pyobjhash()->None:
   f2=_f
   assert pyobjhash([f1]) == pyobjhash([f2])
 
+def test_lrucache()->None:
+  c=LRUCache(2)
+  c.put('a',1)
+  c.put('b',2)
+  assert c.get('a')==1
+  c.put('c',3)
+  assert c.get('b') is None
+  assert c.get('a')==1 and c.get('c')==3
+  assert (c.hits,c.misses)==(3,1)
+  c.invalidate(lambda k: k=='a')
+  assert c.get('a') is None and len(c)==1
+  c.clear()
+  assert len(c)==0 and (c.hits,c.misses)==(0,0)
+
+def test_dirchmod()->None:
+  with setup_storage2('dirchmod') as S:
+    path=Path(join(fstmpdir(S),'a'))
+    makedirs(join(path,'b','c'))
+    for f in [join(path,'f'),join(path,'b','c','f')]:
+      with open(f,'w') as h:
+        h.write('1')
+    symlink(join(path,'f'),join(path,'b','l'))
+    def _writable(p:str)->bool:
+      return bool(stat(p).st_mode & S_IWRITE)
+    dirchmod(path,'rotop')
+    assert not _writable(path)
+    assert _writable(join(path,'b')) and _writable(join(path,'f'))
+    dirchmod(path,'ro')
+    assert not any([_writable(join(path,*p)) for p in
+                    [[],['f'],['b'],['b','c'],['b','c','f']]])
+    dirchmod(path,'rw')
+    assert all([_writable(join(path,*p)) for p in
+                [[],['f'],['b'],['b','c'],['b','c','f']]])
+    dirchmod(path,'ro')
+    dirrm(path)
+    assert not isdir(path)
+
+def test_extract_archive()->None:
+  with setup_storage2('extract_archive') as S:
+    tmp=fstmpdir(S)
+    makedirs(join(tmp,'src','d','e'))
+    for f in [join('src','a'),join('src','d','b'),join('src','d','e','c')]:
+      with open(join(tmp,f),'w') as h:
+        h.write(f)
+    chmod(join(tmp,'src','a'),0o755)
+    assert system(f"tar -C '{tmp}/src' -czf '{tmp}/one.tar.gz' d")==0
+    assert system(f"tar -C '{tmp}/src' -cjf '{tmp}/many.tar.bz2' a d")==0
+    assert system(f"cd '{tmp}/src' && python -m zipfile -c ../z.zip a d")==0
+    assert system(f"gzip -k '{tmp}/src/a' && mv '{tmp}/src/a.gz' '{tmp}'")==0
+    def _out(n)->str:
+      o=join(tmp,'out',n)
+      makedirs(o)
+      return o
+    assert extract_archive(join(tmp,'one.tar.gz'),_out('1'))
+    assert listdir(join(tmp,'out','1'))==['d']
+    assert open(join(tmp,'out','1','d','e','c')).read()==join('src','d','e','c')
+    assert extract_archive(join(tmp,'many.tar.bz2'),_out('2'))
+    assert listdir(join(tmp,'out','2'))==['many']
+    assert isfile(join(tmp,'out','2','many','d','b'))
+    assert stat(join(tmp,'out','2','many')).st_mode&0o777==0o777&~getumask()
+    assert extract_archive(join(tmp,'z.zip'),_out('3'),nworkers=3)
+    assert sorted(listdir(join(tmp,'out','3','z')))==['a','d']
+    assert open(join(tmp,'out','3','z','d','e','c')).read()==join('src','d','e','c')
+    assert stat(join(tmp,'out','3','z','a')).st_mode&0o777==0o755
+    assert extract_archive(join(tmp,'a.gz'),_out('4'))
+    assert open(join(tmp,'out','4','a')).read()==join('src','a')
+    assert not extract_archive(join(tmp,'src','a'),_out('5'))
+    assert listdir(join(tmp,'out','5'))==[]
+
+def test_assert_tarmember_safe()->None:
+  with setup_storage2('assert_tarmember_safe') as S:
+    tmp=fstmpdir(S)
+    makedirs(join(tmp,'d'))
+    symlink('/etc',join(tmp,'d','l'))
+    def _m(name:str, typ:bytes=b'0', linkname:str='')->TarInfo:
+      m=TarInfo(name)
+      m.type=typ
+      m.linkname=linkname
+      return m
+    for m in [_m('a'), _m('d/a'), _m('d/s',SYMTYPE,'../a'),
+              _m('h',LNKTYPE,'d/a')]:
+      assert_tarmember_safe(m,tmp)
+    for m in [_m('/a'), _m('../a'), _m('d/../../a'), _m('d/l/a'),
+              _m('s',SYMTYPE,'../a'), _m('s',SYMTYPE,'/etc'),
+              _m('d/s',SYMTYPE,'l'), _m('h',LNKTYPE,'../a'),
+              _m('c',CHRTYPE)]:
+      try:
+        assert_tarmember_safe(m,tmp)
+        raise ShouldHaveFailed(f"Member '{m.name}' should be rejected")
+      except AssertionError:
+        pass